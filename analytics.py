@@ -0,0 +1,152 @@
+"""
+Class performance aggregates for the instructor dashboard.
+
+Aggregates are maintained incrementally: a refresh reads only the history
+records written since the previous one (`iter_records_after` on the history
+store) and adds them to running counts per student, per case and per week.
+The counts and the read position are kept in `history/.analytics/`, so a
+restart does not rescan the archive either.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from config import get_secret
+from feedback import parse_feedback
+from history import HISTORY_DIR, get_history_store
+
+ANALYTICS_FILE = HISTORY_DIR / ".analytics" / "aggregates.json"
+SCORES = ("1", "2", "3", "4", "5")
+
+
+def _bucket():
+    return {"attempts": 0, "scored": 0, "score_sum": 0, "turns": 0, "scores": dict.fromkeys(SCORES, 0)}
+
+
+def _empty(backend):
+    return {
+        "backend": backend,
+        "position": None,
+        "updated_at": None,
+        "total": _bucket(),
+        "students": {},
+        "cases": {},
+        "weeks": {},
+    }
+
+
+def _add(bucket, score, turns):
+    bucket["attempts"] += 1
+    bucket["turns"] += turns
+    if score is not None:
+        bucket["scored"] += 1
+        bucket["score_sum"] += score
+        bucket["scores"][str(score)] = bucket["scores"].get(str(score), 0) + 1
+
+
+def _week(timestamp):
+    try:
+        year, week, _ = datetime.fromisoformat(timestamp).isocalendar()
+    except (TypeError, ValueError):
+        return "?"
+    return f"{year}-W{week:02d}"
+
+
+class ClassAnalytics:
+    def __init__(self, store, path=ANALYTICS_FILE, refresh_interval=30):
+        self.store = store
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._backend = f"{type(store).__name__}:{getattr(store, 'db_path', getattr(store, 'history_dir', ''))}"
+        self._data = self._load()
+        self._checked = 0.0
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("backend") == self._backend:
+                return data
+        except (OSError, json.JSONDecodeError):
+            pass
+        return _empty(self._backend)
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def refresh(self, force=False):
+        """Folds in records saved since the last refresh; returns how many."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked < self.refresh_interval:
+                return 0
+            self._checked = now
+            added = 0
+            for record in self.store.iter_records_after(self._data["position"]):
+                self._add_record(record)
+                self._data["position"] = self.store.position(record)
+                added += 1
+            if added:
+                self._data["updated_at"] = datetime.now().isoformat(timespec="seconds")
+                self._save()
+            return added
+
+    def reset(self):
+        with self._lock:
+            self._data = _empty(self._backend)
+            self._checked = 0.0
+
+    def _add_record(self, record):
+        score = record.get("score")
+        if score is None and record.get("feedback"):
+            score = parse_feedback(record["feedback"])["score"]
+        turns = sum(1 for m in record.get("messages", []) if m.get("role") == "user")
+        data = self._data
+        _add(data["total"], score, turns)
+        _add(data["students"].setdefault(record.get("student_email", "?"), _bucket()), score, turns)
+        _add(data["cases"].setdefault(record.get("patient", "?"), _bucket()), score, turns)
+        _add(data["weeks"].setdefault(_week(record.get("timestamp")), _bucket()), score, turns)
+
+    # ── views ───────────────────────────────────────────────
+
+    def snapshot(self):
+        with self._lock:
+            return copy.deepcopy(self._data)
+
+    def rows(self, group, key_name):
+        # One row per student / case / week with derived averages.
+        data = self.snapshot()
+        rows = []
+        for key, bucket in sorted(data[group].items()):
+            rows.append({
+                key_name: key,
+                "опити": bucket["attempts"],
+                "средна оценка": round(bucket["score_sum"] / bucket["scored"], 2) if bucket["scored"] else None,
+                "средно реплики": round(bucket["turns"] / bucket["attempts"], 1),
+                **{f"оценка {s}": bucket["scores"].get(s, 0) for s in SCORES},
+            })
+        return rows
+
+
+_analytics = None
+_analytics_lock = threading.Lock()
+
+
+def get_class_analytics():
+    global _analytics
+    with _analytics_lock:
+        if _analytics is None:
+            _analytics = ClassAnalytics(
+                get_history_store(),
+                refresh_interval=float(get_secret("ANALYTICS_REFRESH_SECONDS", 30)),
+            )
+        return _analytics
@@ -4,11 +4,28 @@ Streamlit + OpenAI API
 """
 
 import streamlit as st
-import json
-import os
-from openai import OpenAI
-from datetime import datetime
-from pathlib import Path
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import functools
+import threading
+import time
+
+from analytics import get_class_analytics
+from cases import get_case_catalog
+from config import get_secret
+from context import new_context_window
+from feedback import SECTION_TITLES, SECTIONS, parse_feedback
+from feedback_cache import get_feedback_cache
+from jobs import DONE, FAILED, JobQueueFull, get_feedback_jobs
+from llm_client import get_shared_client
+from metrics import call_context
+from reply_cache import get_reply_cache, reply_cache_enabled
+from roster import get_registry
+from router import get_router, route
+from scheduler import QuotaExceeded, on_queue_wait
+from sessions import get_session_store
+from tracing import get_tracer
+from transcript_analysis import analysis_enabled, analyze_transcript
+import instructor_views
 
 # ─────────────────────────────────────────────────────────────
 # PAGE CONFIG
@@ -20,6 +37,16 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Every rerun is traced stage by stage (tracing.py); an admin can flag the
+# next rerun of their own session for a cProfile capture.
+tracer = get_tracer()
+_run_ctx = get_script_run_ctx()
+tracer.begin(
+    _run_ctx.session_id if _run_ctx else "—",
+    st.session_state.get("user_email"),
+    profile=st.session_state.pop("trace_profile", False),
+)
+
 # ─────────────────────────────────────────────────────────────
 # CLINICAL UI — Full CSS Override
 # ─────────────────────────────────────────────────────────────
@@ -277,51 +304,21 @@ st.markdown("""
     }
 </style>
 """, unsafe_allow_html=True)
+tracer.mark("css")
 
 
 # ─────────────────────────────────────────────────────────────
 # HELPER FUNCTIONS
 # ─────────────────────────────────────────────────────────────
 
-def get_secret(key, default=""):
-    try:
-        return st.secrets[key]
-    except Exception:
-        return os.getenv(key, default)
-
-
-def load_patients():
-    patients_file = Path(__file__).parent / "patients.json"
-    with open(patients_file, "r", encoding="utf-8") as f:
-        return json.load(f)
+def is_instructor(email):
+    instructors = str(get_secret("INSTRUCTOR_EMAILS", ""))
+    return email in {e.strip().lower() for e in instructors.split(",") if e.strip()}
 
 
-def load_students():
-    students_file = Path(__file__).parent / "students.txt"
-    try:
-        with open(students_file, "r", encoding="utf-8") as f:
-            return [
-                line.strip().lower()
-                for line in f
-                if line.strip() and not line.startswith("#")
-            ]
-    except FileNotFoundError:
-        return []
-
-
-def check_login(email, course_code):
-    correct_code = get_secret("COURSE_CODE", "pharma2025")
-    if course_code != correct_code:
-        return False, "Невалиден код за достъп."
-
-    students = load_students()
-    if not students:
-        return True, ""
-
-    if email.lower().strip() in students:
-        return True, ""
-    else:
-        return False, "Този имейл не е регистриран в системата."
+def is_admin(email):
+    admins = str(get_secret("ADMIN_EMAILS", ""))
+    return email in {e.strip().lower() for e in admins.split(",") if e.strip()}
 
 
 def get_openai_client():
@@ -329,13 +326,29 @@ def get_openai_client():
     if not api_key:
         st.error("Системна грешка: Липсва API конфигурация. Свържете се с администратора.")
         st.stop()
-    return OpenAI(api_key=api_key)
+    return get_shared_client(
+        api_key,
+        max_concurrency=int(get_secret("OPENAI_MAX_CONCURRENCY", 16)),
+        max_retries=int(get_secret("OPENAI_MAX_RETRIES", 4)),
+        timeout=float(get_secret("OPENAI_TIMEOUT", 60)),
+        base_url=get_secret("OPENAI_BASE_URL", "") or None,
+        requests_per_hour=int(get_secret("STUDENT_REQUESTS_PER_HOUR", 120)),
+        tokens_per_hour=int(get_secret("STUDENT_TOKENS_PER_HOUR", 200000)),
+        async_gateway=str(get_secret("MODEL_GATEWAY", "threads")).strip().lower() == "async",
+    )
+
+
+def patient_context(client, messages, system_prompt, window, model):
+    if window is None:
+        return [{"role": "system", "content": system_prompt}] + messages
+    return window.prepare(client, messages, system_prompt, model)
 
 
-def chat_with_patient(client, messages, system_prompt):
-    full_messages = [{"role": "system", "content": system_prompt}] + messages
-    response = client.chat.completions.create(
-        model=get_secret("MODEL_NAME", "gpt-4o"),
+def chat_with_patient(client, messages, system_prompt, window=None):
+    model = route("patient")["model"]
+    full_messages = patient_context(client, messages, system_prompt, window, model)
+    response = get_router().create(
+        client, "patient",
         messages=full_messages,
         temperature=0.7,
         max_tokens=800,
@@ -343,94 +356,49 @@ def chat_with_patient(client, messages, system_prompt):
     return response.choices[0].message.content
 
 
-def generate_feedback(client, messages, patient_data):
-    conversation_text = "\n".join([
-        f"{'ФАРМАЦЕВТ' if m['role'] == 'user' else 'ПАЦИЕНТ'}: {m['content']}"
-        for m in messages
-    ])
-
-    feedback_prompt = patient_data.get("feedback_prompt", DEFAULT_FEEDBACK_PROMPT)
-
-    prompt = f"""{feedback_prompt}
-
----
-ИНФОРМАЦИЯ ЗА ПАЦИЕНТА:
-Име: {patient_data['name']}
-Възраст: {patient_data.get('age', 'неизвестна')}
-Описание: {patient_data.get('description', '')}
-Ключова информация: {patient_data.get('key_info', '')}
-
----
-ТРАНСКРИПТ НА КОНСУЛТАЦИЯТА:
-
-{conversation_text}
-
----
-ВАЖНО: Обратната връзка трябва да е на БЪЛГАРСКИ език.
-Отговорът трябва да съдържа точно 3 секции, разделени с |||
-Не слагай заглавие на секция преди съдържанието.
-
-Секция 1: Клинична оценка (правилност на решенията, безопасност)
-|||
-Секция 2: Комуникативни умения (въпроси, емпатия, структура)
-|||
-Секция 3: Препоръки за подобрение (конкретен план)
-"""
-
-    response = client.chat.completions.create(
-        model=get_secret("MODEL_NAME", "gpt-4o"),
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3,
-        max_tokens=3000,
+def stream_chat_with_patient(client, messages, system_prompt, timings, window=None):
+    # Yields the reply as it arrives; time to first token and total latency
+    # (seconds) are written into `timings` once the stream is consumed.
+    model = route("patient")["model"]
+    started = time.perf_counter()
+    full_messages = patient_context(client, messages, system_prompt, window, model)
+    stream = get_router().stream(
+        client, "patient",
+        messages=full_messages,
+        temperature=0.7,
+        max_tokens=800,
     )
-    return response.choices[0].message.content
-
-
-def save_conversation(email, patient_name, messages, feedback=""):
-    history_dir = Path(__file__).parent / "history"
-    history_dir.mkdir(exist_ok=True)
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_email = email.replace("@", "_at_").replace(".", "_")
-    safe_patient = patient_name.replace(" ", "_")
-    filename = f"{safe_email}_{safe_patient}_{timestamp}.json"
-
-    record = {
-        "student_email": email,
-        "patient": patient_name,
-        "timestamp": datetime.now().isoformat(),
-        "messages": messages,
-        "feedback": feedback,
-    }
-
-    with open(history_dir / filename, "w", encoding="utf-8") as f:
-        json.dump(record, f, ensure_ascii=False, indent=2)
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if "ttft" not in timings:
+                timings["ttft"] = time.perf_counter() - started
+            yield delta
+    timings["total"] = time.perf_counter() - started
+    timings.setdefault("ttft", timings["total"])
 
 
-DEFAULT_FEEDBACK_PROMPT = """Ти си експерт по фармацевтична комуникация и оценител на комуникативни умения.
-Анализирай следния разговор между фармацевт-студент и симулиран пациент.
+def show_queue_position(placeholder):
+    ctx = get_script_run_ctx()
 
-Предостави ПОДРОБНА обратна връзка по следните области:
+    def update(position, eta):
+        # Hedged requests wait on a router thread, which needs the session's
+        # script context to draw.
+        add_script_run_ctx(threading.current_thread(), ctx)
+        if position:
+            placeholder.caption(f"В опашка: {position}-и по ред · около {eta:.0f} с")
+    return update
 
-КЛИНИЧНА ОЦЕНКА:
-- Правилност на препоръката
-- Задал ли е студентът ключовите въпроси
-- Безопасност на решенията
-- Пропуснати важни аспекти
 
-КОМУНИКАТИВНИ УМЕНИЯ:
-- Отворени въпроси (брой и примери)
-- Затворени въпроси (брой и уместност)
-- Обобщаване и парафразиране
-- Емпатичен отговор
-- Използване на разбираем език
+def quota_message(error):
+    minutes = max(1, round(error.retry_in / 60))
+    return f"{error} Можете да продължите след около {minutes} мин."
 
-ПРЕПОРЪКИ ЗА ПОДОБРЕНИЕ:
-- Какво е направено добре (конкретни примери)
-- Какво може да се подобри (конкретни предложения)
-- Обща оценка по скала от 1 до 5
 
-Бъди конструктивен, справедлив и балансиран. Започни с положителното."""
+def streaming_enabled():
+    return str(get_secret("STREAM_REPLIES", "true")).strip().lower() not in ("0", "false", "no", "off")
 
 
 # ─────────────────────────────────────────────────────────────
@@ -440,12 +408,24 @@ if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 if "user_email" not in st.session_state:
     st.session_state.user_email = ""
+if "course" not in st.session_state:
+    st.session_state.course = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "feedback_text" not in st.session_state:
     st.session_state.feedback_text = ""
+if "feedback_score" not in st.session_state:
+    st.session_state.feedback_score = None
 if "current_patient" not in st.session_state:
     st.session_state.current_patient = None
+if "turn_timings" not in st.session_state:
+    st.session_state.turn_timings = []
+if "context_window" not in st.session_state:
+    st.session_state.context_window = new_context_window()
+if "feedback_job" not in st.session_state:
+    st.session_state.feedback_job = None
+if "resume_checked" not in st.session_state:
+    st.session_state.resume_checked = set()
 
 
 # ─────────────────────────────────────────────────────────────
@@ -475,10 +455,12 @@ if not st.session_state.authenticated:
                 if not email or not course_code:
                     st.error("Моля, попълнете и двете полета.")
                 else:
-                    ok, msg = check_login(email, course_code)
-                    if ok:
+                    with tracer.span("login"):
+                        course, msg = get_registry().check_login(email, course_code)
+                    if course:
                         st.session_state.authenticated = True
                         st.session_state.user_email = email.strip().lower()
+                        st.session_state.course = course.id
                         st.rerun()
                     else:
                         st.error(msg)
@@ -486,6 +468,8 @@ if not st.session_state.authenticated:
         st.markdown("<br>", unsafe_allow_html=True)
         st.caption("При проблеми с достъпа се обърнете към преподавателя на курса.")
 
+    tracer.mark("login_screen")
+    tracer.finish()
     st.stop()
 
 
@@ -493,8 +477,46 @@ if not st.session_state.authenticated:
 # MAIN APPLICATION
 # ─────────────────────────────────────────────────────────────
 
-patients = load_patients()
+catalog = get_case_catalog()
+course = get_registry().courses.get(st.session_state.course)
+if course is None:
+    # The course was removed from the configuration since login.
+    st.session_state.authenticated = False
+    st.rerun()
+course_cases = {e["name"] for e in catalog.entries() if course.allows(e)}
 client = get_openai_client()
+feedback_jobs = get_feedback_jobs()
+session_store = get_session_store()
+tracer.mark("catalog")
+
+if not course_cases:
+    st.error("Няма налични пациентски казуси.")
+    for problem in catalog.errors():
+        st.caption(problem)
+    tracer.finish()
+    st.stop()
+
+if "default_case" not in st.session_state:
+    # Open the case the student was last working on, if it is still in progress.
+    latest_case = session_store.latest(st.session_state.user_email)
+    st.session_state.default_case = (
+        latest_case if latest_case in course_cases
+        else next(name for name in catalog.names() if name in course_cases)
+    )
+
+
+def reset_consultation():
+    client.cancel(st.session_state.user_email)  # a reply still being generated
+    if st.session_state.feedback_job:
+        feedback_jobs.discard(st.session_state.feedback_job)
+    if st.session_state.current_patient:
+        session_store.clear(st.session_state.user_email, st.session_state.current_patient)
+    st.session_state.messages = []
+    st.session_state.feedback_text = ""
+    st.session_state.feedback_score = None
+    st.session_state.turn_timings = []
+    st.session_state.context_window = new_context_window()
+    st.session_state.feedback_job = None
 
 
 # ── SIDEBAR ──────────────────────────────────────────────────
@@ -502,14 +524,33 @@ with st.sidebar:
     st.markdown("#### Панел за управление")
     st.divider()
 
+    # Case search (only the lightweight index is needed until a case is opened)
+    search_text = st.text_input("ТЪРСЕНЕ", placeholder="име, оплакване, етикет")
+    tag_filter, difficulty_filter = [], None
+    course_tags = catalog.tags(course_cases)
+    course_difficulties = catalog.difficulties(course_cases)
+    if course_tags:
+        tag_filter = st.multiselect("ЕТИКЕТИ", course_tags)
+    if course_difficulties:
+        difficulty_filter = st.selectbox(
+            "ТРУДНОСТ", [None, *course_difficulties], format_func=lambda d: d or "Всички"
+        )
+    matches = catalog.search(search_text, tag_filter, difficulty_filter, names=course_cases)
+    current_case = st.session_state.current_patient or st.session_state.default_case
+    if not matches:
+        st.caption("Няма казуси, отговарящи на търсенето.")
+        matches = catalog.search(names={current_case} & course_cases) or catalog.search(names=course_cases)[:1]
+
     # Patient selector
-    patient_labels = [f"{p['name']}, {p.get('age', '?')} г." for p in patients]
-    selected_idx = st.selectbox(
+    labels = {e["name"]: f"{e['name']}, {e['age'] or '?'} г." for e in matches}
+    case_names = list(labels)
+    selected_name = st.selectbox(
         "ПАЦИЕНТСКИ КАЗУС",
-        range(len(patients)),
-        format_func=lambda i: patient_labels[i],
+        case_names,
+        index=case_names.index(current_case) if current_case in labels else 0,
+        format_func=labels.get,
     )
-    selected_patient = patients[selected_idx]
+    selected_patient = catalog.get(selected_name)
 
     # Scenario description
     st.info(selected_patient.get("scenario_hint", ""))
@@ -517,42 +558,123 @@ with st.sidebar:
     # Reset on patient change
     if st.session_state.current_patient != selected_patient["name"]:
         st.session_state.current_patient = selected_patient["name"]
+        st.session_state.resume_checked.discard(selected_patient["name"])
         st.session_state.messages = []
         st.session_state.feedback_text = ""
+        st.session_state.feedback_score = None
+        st.session_state.turn_timings = []
+        st.session_state.context_window = new_context_window()
+        st.session_state.feedback_job = None
 
     st.divider()
 
     # Session controls
     if st.button("Нова сесия"):
-        st.session_state.messages = []
-        st.session_state.feedback_text = ""
+        reset_consultation()
         st.rerun()
 
-    # Message count
-    msg_count = len([m for m in st.session_state.messages if m["role"] == "user"])
-    st.caption(f"Съобщения в тази сесия: {msg_count}")
-
     st.divider()
     st.caption(f"Потребител: {st.session_state.user_email}")
+    if len(get_registry().courses) > 1:
+        st.caption(f"Курс: {course.title}")
+
+    views = ["Консултация"]
+    if is_instructor(st.session_state.user_email):
+        views += ["Резултати на курса", "Разходи и латентност"]
+    if is_admin(st.session_state.user_email):
+        views.append("Профилиране")
+    view = st.radio("ИЗГЛЕД", views) if len(views) > 1 else views[0]
 
     if st.button("Изход"):
+        client.cancel(st.session_state.user_email)
         for key in list(st.session_state.keys()):
             del st.session_state[key]
         st.rerun()
+tracer.mark("sidebar")
+tracer.tag(view=view)
+
+
+# ── INSTRUCTOR VIEWS ─────────────────────────────────────────
+
+if view == "Резултати на курса":
+    instructor_views.render_analytics(get_class_analytics())
+    tracer.mark("course_results")
+    tracer.finish()
+    st.stop()
+
+if view == "Разходи и латентност":
+    instructor_views.render_metrics(
+        client.stats.snapshot(), get_feedback_cache().stats(), client.scheduler.snapshot(),
+        get_router().snapshot(), get_reply_cache().stats() if reply_cache_enabled() else None,
+    )
+    tracer.mark("metrics_view")
+    tracer.finish()
+    st.stop()
+
+if view == "Профилиране":
+    instructor_views.render_traces(tracer)
+    tracer.finish()
+    st.stop()
+
+
+# ── RESUME AFTER RELOAD ──────────────────────────────────────
+
+# A page reload clears session state, but a submitted assessment keeps
+# running (or has already finished) in the worker pool, and unfinished
+# consultations are kept in the session store.
+if selected_patient["name"] not in st.session_state.resume_checked:
+    st.session_state.resume_checked.add(selected_patient["name"])
+    if not st.session_state.feedback_job and len(st.session_state.messages) <= 1:
+        job = feedback_jobs.latest_for(st.session_state.user_email, selected_patient["name"])
+        if job and job["status"] != FAILED:
+            job = feedback_jobs.resume(client, job["id"])
+            st.session_state.feedback_job = job["id"]
+            st.session_state.messages = job["messages"]
+            st.session_state.turn_timings = job["turn_timings"]
+            if job["status"] == DONE:
+                st.session_state.feedback_text = job["feedback"]
+                st.session_state.feedback_score = job.get("score")
+        else:
+            saved = session_store.load(st.session_state.user_email, selected_patient["name"])
+            if saved and len(saved["messages"]) > 1:
+                st.session_state.messages = saved["messages"]
+                st.session_state.turn_timings = saved["turn_timings"]
+                st.toast("Продължавате незавършената си консултация.")
+tracer.mark("resume")
 
 
 # ── CHAT AREA ────────────────────────────────────────────────
 
-st.markdown(f"## Консултация — {selected_patient['name']}")
-st.divider()
+# The chat and the feedback panel are fragments: sending a message reruns only
+# the chat fragment instead of the whole script (CSS, sidebar, case loading,
+# every other widget), and no second full rerun follows the reply. Setting
+# UI_FRAGMENTS = "false" restores whole-script reruns (used by bench_rerun.py
+# for the before/after comparison).
 
-# Initialize with patient's opening message
-if not st.session_state.messages:
-    opening = selected_patient.get("opening_message", "Здравейте, имам нужда от помощ.")
-    st.session_state.messages.append({"role": "assistant", "content": opening})
+def fragments_enabled():
+    return str(get_secret("UI_FRAGMENTS", "true")).strip().lower() not in ("0", "false", "no", "off")
+
+
+def panel(func):
+    if not fragments_enabled():
+        return func
+
+    @functools.wraps(func)
+    def traced():
+        # A fragment rerun is a rerun of its own as far as tracing goes.
+        ctx = get_script_run_ctx()
+        if ctx is None or not ctx.fragment_ids_this_run:
+            return func()
+        tracer.begin(ctx.session_id, st.session_state.user_email, kind=func.__name__)
+        try:
+            return func()
+        finally:
+            tracer.finish()
+
+    return st.fragment(traced)
 
-# Render messages
-for msg in st.session_state.messages:
+
+def render_message(msg):
     if msg["role"] == "user":
         with st.chat_message("user", avatar=None):
             st.markdown(f"**Фармацевт:** {msg['content']}")
@@ -561,9 +683,189 @@ for msg in st.session_state.messages:
             st.markdown(f"**Пациент:** {msg['content']}")
 
 
+def render_turn_stats():
+    msg_count = len([m for m in st.session_state.messages if m["role"] == "user"])
+    parts = [f"Съобщения в тази сесия: {msg_count}"]
+
+    # Response latency (time to first token / full reply)
+    if st.session_state.turn_timings:
+        last = st.session_state.turn_timings[-1]
+        avg_ttft = sum(t["ttft"] for t in st.session_state.turn_timings) / len(st.session_state.turn_timings)
+        parts.append(
+            f"време за отговор: {last['ttft']:.1f} с до първи символ, "
+            f"{last['total']:.1f} с общо (средно {avg_ttft:.1f} с)"
+        )
+        if last.get("cached"):
+            parts.append("отговор от кеша на началните реплики")
+        if "prompt_tokens_sent" in last:
+            parts.append(f"контекст: {last['prompt_tokens_sent']} от {last['prompt_tokens_full']} токена")
+    st.caption(" · ".join(parts))
+
+
+def save_progress():
+    with tracer.span("save_progress"):
+        session_store.save(
+            st.session_state.user_email,
+            selected_patient["name"],
+            st.session_state.messages,
+            st.session_state.turn_timings,
+        )
+
+
+def cached_opener_reply():
+    # A stored reply to a common opening line, or None (see reply_cache.py).
+    if not reply_cache_enabled():
+        return None
+    return get_reply_cache().lookup(
+        selected_patient["system_prompt"], route("patient")["model"], st.session_state.messages
+    )
+
+
+def answer_turn(user_input):
+    # Renders the student's message and the patient's reply as new bubbles.
+    # Returns False when the turn had to be dropped.
+    st.session_state.messages.append({"role": "user", "content": user_input})
+    turn_context = call_context(
+        kind="patient_turn",
+        student=st.session_state.user_email,
+        patient=selected_patient["name"],
+    )
+
+    with st.chat_message("user", avatar=None):
+        st.markdown(f"**Фармацевт:** {user_input}")
+    with st.chat_message("assistant", avatar=None):
+        placeholder = st.empty()
+        started = time.perf_counter()
+        try:
+            with turn_context, on_queue_wait(show_queue_position(placeholder)), tracer.span("model_call"):
+                response = cached_opener_reply()
+                if response is not None:
+                    timings = {"streamed": False, "cached": True, "ttft": 0.0, "total": 0.0}
+                elif streaming_enabled():
+                    timings = {"streamed": True}
+                    response = ""
+                    for token in stream_chat_with_patient(
+                        client,
+                        st.session_state.messages,
+                        selected_patient["system_prompt"],
+                        timings,
+                        st.session_state.context_window,
+                    ):
+                        response += token
+                        placeholder.markdown(f"**Пациент:** {response}▌")
+                else:
+                    with st.spinner(""):
+                        response = chat_with_patient(
+                            client,
+                            st.session_state.messages,
+                            selected_patient["system_prompt"],
+                            st.session_state.context_window,
+                        )
+                    elapsed = time.perf_counter() - started
+                    timings = {"streamed": False, "ttft": elapsed, "total": elapsed}
+            placeholder.markdown(f"**Пациент:** {response}")
+        except QuotaExceeded as e:
+            placeholder.empty()
+            st.warning(quota_message(e))
+            st.session_state.messages.pop()
+            return False
+        except Exception as e:
+            placeholder.empty()
+            st.error(f"Грешка при комуникация с AI: {e}")
+            st.session_state.messages.pop()
+            return False
+
+    if not timings.get("cached"):
+        if reply_cache_enabled():
+            get_reply_cache().store(
+                selected_patient["system_prompt"], route("patient")["model"],
+                st.session_state.messages, response,
+            )
+        timings.update(st.session_state.context_window.last_report or {})
+    st.session_state.messages.append({"role": "assistant", "content": response})
+    st.session_state.turn_timings.append(timings)
+    save_progress()
+    return True
+
+
+@panel
+def chat_panel():
+    history = st.container()
+    consulting = not st.session_state.feedback_text and not st.session_state.feedback_job
+    user_input = st.chat_input("Напишете съобщение към пациента...") if consulting else None
+
+    with history:
+        with tracer.span("render_messages"):
+            for msg in st.session_state.messages:
+                render_message(msg)
+        if user_input and answer_turn(user_input) and not fragments_enabled():
+            st.rerun()
+
+    if not consulting:
+        return
+
+    render_turn_stats()
+
+    # Assessment button (only after enough messages)
+    if len(st.session_state.messages) >= 4:
+        if st.button("Приключване и оценка на консултацията"):
+            try:
+                st.session_state.feedback_job = feedback_jobs.submit(
+                    client,
+                    st.session_state.user_email,
+                    selected_patient,
+                    st.session_state.messages,
+                    st.session_state.turn_timings,
+                )
+                st.rerun(scope="app")
+            except JobQueueFull as e:
+                st.error(str(e))
+
+
+st.markdown(f"## Консултация — {selected_patient['name']}")
+st.divider()
+
+# Initialize with patient's opening message
+if not st.session_state.messages:
+    opening = selected_patient.get("opening_message", "Здравейте, имам нужда от помощ.")
+    st.session_state.messages.append({"role": "assistant", "content": opening})
+
+chat_panel()
+tracer.mark("chat")
+
+
 # ── FEEDBACK DISPLAY ─────────────────────────────────────────
 
-if st.session_state.feedback_text:
+def render_feedback_tabs(sections, partial_key=None, partial_text=""):
+    tabs = st.tabs([SECTION_TITLES[name] for name in SECTIONS])
+    for tab, name in zip(tabs, SECTIONS):
+        with tab:
+            if name in sections:
+                st.markdown(sections[name])
+            elif name == partial_key:
+                st.markdown(partial_text + "▌")
+            else:
+                st.caption("Очаква се...")
+
+
+def render_transcript_facts():
+    # Local, instant pre-analysis; the model's assessment follows.
+    if not analysis_enabled():
+        return
+    facts = analyze_transcript(st.session_state.messages, selected_patient)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Отворени въпроси", f"{facts['open_questions']} от {facts['questions']}")
+    col2.metric("Емпатични изрази", facts["empathy"])
+    col3.metric("Обобщения", facts["summaries"])
+    if facts["key_points"]:
+        col4.metric("Ключова информация", f"{facts['key_points_covered']} от {len(facts['key_points'])}")
+        with st.expander("Обсъдена ключова информация"):
+            for point in facts["key_points"]:
+                st.markdown(f"{'✅' if point['covered'] else '⬜'} {point['point']}")
+
+
+@panel
+def feedback_panel():
     st.divider()
 
     st.markdown("""
@@ -573,66 +875,62 @@ if st.session_state.feedback_text:
     </div>
     """, unsafe_allow_html=True)
 
-    parts = st.session_state.feedback_text.split("|||")
-
-    if len(parts) >= 3:
-        tab1, tab2, tab3 = st.tabs([
-            "Клинична оценка",
-            "Комуникативни умения",
-            "Препоръки за подобрение"
-        ])
-        with tab1:
-            st.markdown(parts[0].strip())
-        with tab2:
-            st.markdown(parts[1].strip())
-        with tab3:
-            st.markdown(parts[2].strip())
+    render_transcript_facts()
+
+    result = parse_feedback(st.session_state.feedback_text)
+    score = st.session_state.feedback_score or result["score"]
+
+    if score:
+        st.markdown(f"**Обща оценка: {score} / 5**")
+
+    if result["sections"]:
+        render_feedback_tabs(result["sections"])
     else:
         # Fallback: show as single block
-        st.markdown(st.session_state.feedback_text)
+        st.markdown(result["text"])
 
     st.divider()
     st.caption('Натиснете "Нова сесия" в панела отляво, за да започнете нов разговор.')
 
 
-# ── INPUT + ASSESSMENT TRIGGER ───────────────────────────────
-
-if not st.session_state.feedback_text:
-    # Chat input
-    if user_input := st.chat_input("Напишете съобщение към пациента..."):
-        st.session_state.messages.append({"role": "user", "content": user_input})
+if st.session_state.feedback_text:
+    with tracer.span("feedback_panel"):
+        feedback_panel()
+
+
+# ── PENDING ASSESSMENT ───────────────────────────────────────
+
+@st.fragment(run_every=1)
+def feedback_job_status():
+    job = feedback_jobs.get(st.session_state.feedback_job)
+    if job is None:
+        st.session_state.feedback_job = None
+        st.rerun(scope="app")
+    elif job["status"] == DONE:
+        st.session_state.feedback_text = job["feedback"]
+        st.session_state.feedback_score = job.get("score")
+        st.rerun(scope="app")
+    elif job["status"] == FAILED:
+        st.error(f"Грешка при генериране на обратна връзка: {job['error']}")
+        if st.button("Опитай отново"):
+            feedback_jobs.discard(job["id"])
+            st.session_state.feedback_job = None
+            st.rerun(scope="app")
+    else:
+        progress = job.get("progress")
+        if progress and (progress["sections"] or progress["partial_key"]):
+            # Sections appear one by one as the structured answer streams in.
+            render_feedback_tabs(
+                progress["sections"], progress["partial_key"], progress["partial_text"]
+            )
+        else:
+            with st.spinner("Генериране на обратна връзка..."):
+                st.caption("Оценката се изготвя във фонов режим — можете да презаредите страницата без да я загубите.")
 
-        with st.spinner(""):
-            try:
-                response = chat_with_patient(
-                    client,
-                    st.session_state.messages,
-                    selected_patient["system_prompt"]
-                )
-                st.session_state.messages.append({"role": "assistant", "content": response})
-            except Exception as e:
-                st.error(f"Грешка при комуникация с AI: {e}")
-                st.session_state.messages.pop()
 
-        st.rerun()
+if st.session_state.feedback_job and not st.session_state.feedback_text:
+    st.divider()
+    render_transcript_facts()
+    feedback_job_status()
 
-    # Assessment button (only after enough messages)
-    if len(st.session_state.messages) >= 4:
-        st.markdown("<br>", unsafe_allow_html=True)
-        if st.button("Приключване и оценка на консултацията"):
-            with st.spinner("Генериране на обратна връзка..."):
-                try:
-                    feedback = generate_feedback(
-                        client, st.session_state.messages, selected_patient
-                    )
-                    st.session_state.feedback_text = feedback
-
-                    save_conversation(
-                        st.session_state.user_email,
-                        selected_patient["name"],
-                        st.session_state.messages,
-                        feedback
-                    )
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Грешка при генериране на обратна връзка: {e}")
+tracer.finish()
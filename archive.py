@@ -0,0 +1,155 @@
+"""
+Compressed, append-only segment files for old consultation records.
+
+`python history.py maintain` moves the per-consultation JSON files of past
+days into one segment per day (or month) under `history/archive/`:
+
+    2025-03-04.seg      gzip members, one per record, written back to back
+    2025-03-04.idx      one JSON line per record: source file name, segment
+                        file, byte offset and length, student, case, time
+
+A record is read by seeking to its offset and decompressing one member, so
+random access does not unpack the whole segment, and the student / case /
+time in the index let queries skip records without reading them. New lines
+are only ever appended; when a record is appended again (a re-grade), the
+later index line wins. Retention and anonymisation rewrite a whole segment
+into a new file and then swap the index.
+"""
+
+import gzip
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+INDEX_FIELDS = ("student_email", "patient", "timestamp")
+
+
+class SegmentArchive:
+    def __init__(self, root):
+        self.root = Path(root)
+        self._lock = threading.RLock()
+        self._indexes = {}  # segment -> (mtime_ns, size, {source: entry})
+
+    # ── reading ─────────────────────────────────────────────
+
+    def segments(self):
+        if not self.root.exists():
+            return []
+        return sorted(path.stem for path in self.root.glob("*.idx"))
+
+    def index(self, segment):
+        """{source: entry} of a segment, cached until the index file changes."""
+        path = self.root / f"{segment}.idx"
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            cached = self._indexes.get(segment)
+            if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                return cached[2]
+        entries = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by a crash
+                entries[entry["source"]] = entry
+        with self._lock:
+            self._indexes[segment] = (stat.st_mtime_ns, stat.st_size, entries)
+        return entries
+
+    def entries(self):
+        for segment in self.segments():
+            for entry in self.index(segment).values():
+                yield {**entry, "segment": segment}
+
+    def read(self, entry):
+        with open(self.root / entry["file"], "rb") as f:
+            f.seek(entry["offset"])
+            data = f.read(entry["length"])
+        record = json.loads(gzip.decompress(data))
+        record["source"] = entry["source"]
+        return record
+
+    # ── writing ─────────────────────────────────────────────
+
+    def append(self, segment, records):
+        """Append records (each with a `source`) to a segment; returns how many."""
+        if not records:
+            return 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            current = self.index(segment)
+            seg_file = next(iter(current.values()))["file"] if current else f"{segment}.seg"
+            lines = []
+            with open(self.root / seg_file, "ab") as seg:
+                for record in records:
+                    data = gzip.compress(
+                        json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                    )
+                    offset = seg.tell()
+                    seg.write(data)
+                    lines.append(self._entry(record, seg_file, offset, len(data)))
+                seg.flush()
+                os.fsync(seg.fileno())
+            # The index is written after the data it points to.
+            with open(self.root / f"{segment}.idx", "a", encoding="utf-8") as idx:
+                idx.writelines(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+                idx.flush()
+                os.fsync(idx.fileno())
+        return len(records)
+
+    def rewrite(self, segment, transform):
+        """Pass every record through `transform` (returns the record or None
+        to drop it) and write the segment anew; returns (kept, changed, dropped)."""
+        with self._lock:
+            entries = self.index(segment)
+            old_files = {e["file"] for e in entries.values()}
+            seg_file = f"{segment}.{uuid.uuid4().hex[:8]}.seg"
+            lines = []
+            kept = changed = dropped = 0
+            with open(self.root / seg_file, "wb") as seg:
+                for entry in sorted(entries.values(), key=lambda e: e["source"]):
+                    record = self.read(entry)
+                    before = json.dumps(record, ensure_ascii=False, sort_keys=True)
+                    record = transform(record)
+                    if record is None:
+                        dropped += 1
+                        continue
+                    kept += 1
+                    changed += json.dumps(record, ensure_ascii=False, sort_keys=True) != before
+                    data = gzip.compress(
+                        json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                    )
+                    lines.append(self._entry(record, seg_file, seg.tell(), len(data)))
+                    seg.write(data)
+                seg.flush()
+                os.fsync(seg.fileno())
+
+            index_path = self.root / f"{segment}.idx"
+            if kept:
+                tmp = index_path.with_suffix(".idx.tmp")
+                with open(tmp, "w", encoding="utf-8") as idx:
+                    idx.writelines(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+                os.replace(tmp, index_path)
+            else:
+                os.remove(self.root / seg_file)
+                index_path.unlink(missing_ok=True)
+            for name in old_files - {seg_file}:
+                (self.root / name).unlink(missing_ok=True)
+            self._indexes.pop(segment, None)
+        return kept, changed, dropped
+
+    def _entry(self, record, seg_file, offset, length):
+        entry = {"source": record["source"], "file": seg_file, "offset": offset, "length": length}
+        entry.update({field: record.get(field, "") for field in INDEX_FIELDS})
+        return entry
+
+    def size(self):
+        if not self.root.exists():
+            return 0
+        return sum(path.stat().st_size for path in self.root.iterdir() if path.is_file())
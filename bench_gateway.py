@@ -0,0 +1,190 @@
+"""
+Concurrency benchmark: threaded client vs. async gateway.
+
+Opens N simultaneous streaming consultations against the mock model server
+and records, per client model, whether all of them completed, the peak
+memory of the process and the number of OS threads it needed:
+
+    python bench_gateway.py --conversations 100 400 1600 --memory-mb 512
+
+    threads   one blocked thread per conversation (llm_client.RateLimitedClient)
+    facade    the gateway called the way the app calls it: one thread per
+              conversation blocked on the gateway's synchronous
+              `chat.completions.create` while the request runs on its loop
+    async     one coroutine per conversation on the gateway loop (`astream`);
+              no app code takes this path yet, it shows what a fully async
+              caller would gain
+
+Each run happens in a fresh process so the memory numbers do not mix; the
+mock server runs in its own process too. The summary shows, for each model,
+the largest N that completed without errors within the memory budget.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from config import BASE_DIR
+from metrics import percentile
+
+MODES = ("threads", "facade", "async")
+MESSAGES = [{"role": "user", "content": "От колко време имате тази кашлица?"}]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _client(base_url, conversations, mode):
+    from llm_client import get_shared_client
+
+    return get_shared_client(
+        "mock", base_url=base_url, max_concurrency=conversations,
+        max_connections=conversations, timeout=120, async_gateway=mode != "threads",
+    )
+
+
+def _run_threads(client, conversations):
+    from metrics import call_context
+
+    latencies, errors = [], []
+    peak_threads = [0]
+
+    def conversation(i):
+        started = time.perf_counter()
+        try:
+            with call_context(kind="patient_turn", student=f"bench{i}"):
+                for _ in client.chat.completions.create(model="mock", messages=MESSAGES, stream=True):
+                    peak_threads[0] = max(peak_threads[0], threading.active_count())
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(type(e).__name__)
+
+    workers = [threading.Thread(target=conversation, args=(i,)) for i in range(conversations)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors, peak_threads[0]
+
+
+def _run_async(client, conversations):
+    import asyncio
+
+    latencies, errors = [], []
+    peak_threads = [0]
+
+    async def conversation(i):
+        started = time.perf_counter()
+        try:
+            tags = {"kind": "patient_turn", "student": f"bench{i}"}
+            async for _ in client.astream(tags=tags, model="mock", messages=MESSAGES):
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(type(e).__name__)
+
+    async def everyone():
+        await asyncio.gather(*(conversation(i) for i in range(conversations)))
+
+    client.submit(everyone()).result()
+    return latencies, errors, peak_threads[0]
+
+
+def worker(mode, conversations, base_url):
+    # One measurement, in its own process; prints a JSON row.
+    client = _client(base_url, conversations, mode)
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    run = _run_async if mode == "async" else _run_threads
+    latencies, errors, peak_threads = run(client, conversations)
+    latencies.sort()
+    print(json.dumps({
+        "mode": mode,
+        "conversations": conversations,
+        "completed": len(latencies),
+        "errors": len(errors),
+        "wall_time": round(time.perf_counter() - started, 2),
+        "p95_latency": round(percentile(latencies, 95), 2) if latencies else None,
+        "peak_threads": peak_threads,
+        "baseline_mb": round(baseline, 1),
+        "peak_mb": round(peak_rss_mb(), 1),
+    }))
+
+
+def start_mock(args):
+    port = args.port
+    server = subprocess.Popen(
+        [sys.executable, str(BASE_DIR / "mock_llm_server.py"), "--port", str(port),
+         "--latency", str(args.latency), "--tokens-per-sec", str(args.tokens_per_sec)],
+        stdout=subprocess.DEVNULL,
+    )
+    time.sleep(1.0)
+    return f"http://127.0.0.1:{port}/v1", server
+
+
+def run(args):
+    base_url, server = start_mock(args)
+    rows = []
+    try:
+        for conversations in args.conversations:
+            for mode in MODES:
+                result = subprocess.run(
+                    [sys.executable, __file__, "--worker", mode,
+                     "--conversations", str(conversations), "--base-url", base_url],
+                    capture_output=True, text=True, env={**os.environ, "STATE_BACKEND": "memory"},
+                )
+                if result.returncode != 0:
+                    # Typically out of threads or memory: that is the limit.
+                    rows.append({"mode": mode, "conversations": conversations, "completed": 0,
+                                 "errors": conversations, "failure": result.stderr.strip().splitlines()[-1:]})
+                else:
+                    rows.append(json.loads(result.stdout.strip().splitlines()[-1]))
+                print(json.dumps(rows[-1], ensure_ascii=False), file=sys.stderr)
+    finally:
+        server.terminate()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent conversations per process: threads vs async gateway")
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    parser.add_argument("--conversations", type=int, nargs="+", default=[100, 400, 1600])
+    parser.add_argument("--memory-mb", type=float, default=512, help="memory budget per process")
+    parser.add_argument("--latency", type=float, default=0.4)
+    parser.add_argument("--tokens-per-sec", type=float, default=40.0)
+    parser.add_argument("--port", type=int, default=8998)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.conversations[0], args.base_url)
+        return
+
+    rows = run(args)
+    print(f"{'mode':>8}{'N':>7}{'ok':>7}{'err':>6}{'threads':>9}{'peak MB':>9}{'p95 s':>8}")
+    for r in rows:
+        print(f"{r['mode']:>8}{r['conversations']:>7}{r['completed']:>7}{r['errors']:>6}"
+              f"{r.get('peak_threads', '—'):>9}{r.get('peak_mb', '—'):>9}{r.get('p95_latency') or '—':>8}")
+    for mode in MODES:
+        sustained = [
+            r["conversations"] for r in rows
+            if r["mode"] == mode and not r["errors"] and r.get("peak_mb", float("inf")) <= args.memory_mb
+        ]
+        print(f"{mode}: up to {max(sustained) if sustained else 0} concurrent conversations "
+              f"within {args.memory_mb:.0f} MB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
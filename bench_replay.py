@@ -0,0 +1,454 @@
+"""
+Deterministic replay benchmark of the consultation pipeline.
+
+Replays consultations through the same code the app runs for every turn and
+assessment — context window and prompt assembly, the shared client with its
+scheduler and metrics, the model router, feedback prompt, parsing and saving
+— against an in-process scripted model: each call returns the reply recorded
+in the transcript after a fixed latency, so two runs do the same work.
+By default the paths the app uses by default are replayed: patient replies
+streamed through the router (`STREAM_REPLIES`, `--replies`) and the
+structured assessment streamed through `FeedbackStreamParser`
+(`FEEDBACK_FORMAT`, `--feedback-format`); the scripted model streams too,
+word by word after the same latency.
+
+    python bench_replay.py --turns 5 20 50 --cases 1 5 --save-baseline benchmarks/baseline.json
+    python bench_replay.py --compare benchmarks/baseline.json
+
+Transcripts come from the history store (recorded consultations of each case)
+and, for cases without history or with `--no-history`, from a synthetic
+conversation built from `patients.json`. Every transcript is cut or cycled to
+the requested number of student turns. For each (turns, cases) point the
+report has, per stage, the CPU time and the memory allocated (tracemalloc
+peak, measured in a separate pass so it does not skew the timings), and the
+end-to-end latency of a whole consultation.
+
+`--save-baseline` writes the results as JSON; `--compare` runs again and
+flags every metric that got slower or bigger by more than `--tolerance`,
+exiting with status 1 so it can guard a CI job. Consultations are saved and
+metrics logged into a temporary directory, never the live installation.
+"""
+
+import argparse
+import hashlib
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import metrics
+from cases import get_case_catalog
+from config import get_secret
+from context import new_context_window
+from feedback import (
+    build_feedback_prompt,
+    generate_feedback,
+    generate_structured_feedback,
+    parse_feedback,
+    structured_feedback_enabled,
+)
+from history import JsonHistoryStore, SqliteHistoryStore, get_history_store, make_record
+from llm_client import RateLimitedClient
+from loadtest import STUDENT_LINES
+from metrics import call_context, percentile
+from mock_llm_server import FEEDBACK_REPLY, PATIENT_REPLIES
+from router import get_router, route
+
+STAGES = ("patient_prompt", "patient_call", "feedback_prompt", "feedback_call", "parse_feedback", "save")
+STUDENT = "bench@example.bg"
+SUMMARY_REPLY = "Фармацевтът е попитал за симптомите и приеманите лекарства."
+
+# Compared between runs: (section, metric)
+COMPARED = (("stages", "cpu_ms_p50"), ("stages", "alloc_kb_p50"), ("end_to_end", "wall_ms_p50"))
+
+
+# ── scripted model ──────────────────────────────────────────
+
+class ReplayBackend:
+    """Stands in for the OpenAI client: answers from a script, after a fixed delay."""
+
+    def __init__(self, latency):
+        self.latency = latency  # kind of call -> seconds
+        self.patient_replies = deque()
+        self.feedback = FEEDBACK_REPLY
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def script(self, patient_replies, feedback):
+        self.patient_replies = deque(patient_replies)
+        self.feedback = feedback
+
+    def create(self, messages, stream=False, response_format=None, **kwargs):
+        kind = metrics.current_tags().get("kind")
+        if kind == "feedback":
+            content = self.feedback
+            if (response_format or {}).get("type") == "json_schema":
+                content = structured_reply(content)
+        elif kind == "context_summary":
+            content = SUMMARY_REPLY
+        else:
+            content = self.patient_replies.popleft()
+        time.sleep(self.latency.get(kind, 0.0))
+        prompt_chars = sum(len(m["content"]) for m in messages)
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_chars // 3 + 1, completion_tokens=len(content) // 3 + 1,
+            prompt_tokens_details=None,
+        )
+        if stream:
+            return ReplayStream(content, usage)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=usage,
+        )
+
+
+class ReplayStream:
+    # Word-sized chunks, then a usage-only chunk, as with `include_usage`.
+
+    def __init__(self, content, usage):
+        self.content = content
+        self.usage = usage
+
+    def __iter__(self):
+        for word in self.content.split(" "):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))], usage=None)
+        yield SimpleNamespace(choices=[], usage=self.usage)
+
+    def close(self):
+        pass
+
+
+def structured_reply(feedback):
+    # A recorded assessment in the JSON format the structured prompt asks for.
+    result = parse_feedback(feedback)
+    sections = result["sections"] or parse_feedback(FEEDBACK_REPLY)["sections"]
+    return json.dumps(dict(sections, score=result["score"] or 4), ensure_ascii=False)
+
+
+# ── transcripts ─────────────────────────────────────────────
+
+def _fit(items, n):
+    # Cut or cycle a list to exactly n items.
+    return [items[i % len(items)] for i in range(n)] if items else []
+
+
+def synthetic_transcript(case):
+    return {
+        "case": case["name"],
+        "student": list(STUDENT_LINES),
+        "patient": list(PATIENT_REPLIES),
+        "feedback": FEEDBACK_REPLY,
+    }
+
+
+def recorded_transcripts(case_names, per_case):
+    # {case: [transcript]} from the history store, oldest first.
+    found = {}
+    records = sorted(get_history_store().iter_records(), key=lambda r: (r.get("timestamp", ""), r.get("source", "")))
+    for record in records:
+        name = record.get("patient")
+        if name not in case_names or len(found.get(name, [])) >= per_case:
+            continue
+        messages = record.get("messages", [])
+        student = [m["content"] for m in messages if m["role"] == "user"]
+        patient = [m["content"] for m in messages if m["role"] == "assistant"]
+        if not student or not patient:
+            continue
+        found.setdefault(name, []).append({
+            "case": name,
+            "student": student,
+            "patient": patient,
+            "feedback": record.get("feedback") or FEEDBACK_REPLY,
+        })
+    return found
+
+
+def load_inputs(max_cases, per_case, use_history):
+    catalog = get_case_catalog()
+    cases = [catalog.get(name) for name in sorted(catalog.names())[:max_cases]]
+    cases = [case for case in cases if case]
+    recorded = recorded_transcripts({c["name"] for c in cases}, per_case) if use_history else {}
+    transcripts = {c["name"]: recorded.get(c["name"]) or [synthetic_transcript(c)] for c in cases}
+    return cases, transcripts
+
+
+def fingerprint(cases, transcripts):
+    # Identifies the replayed inputs, so a baseline is only compared like for like.
+    payload = json.dumps(
+        [[c["name"], c.get("system_prompt", ""), transcripts[c["name"]]] for c in cases],
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+# ── measuring ───────────────────────────────────────────────
+
+class Recorder:
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self.samples = {}  # stage -> [value]
+
+    @contextmanager
+    def stage(self, name):
+        if self.allocations:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            yield
+            self.samples.setdefault(name, []).append((tracemalloc.get_traced_memory()[1] - base) / 1024)
+            return
+        cpu, wall = time.process_time(), time.perf_counter()
+        yield
+        self.samples.setdefault(name, []).append(
+            ((time.process_time() - cpu) * 1000, (time.perf_counter() - wall) * 1000)
+        )
+
+
+def patient_reply(client, full_messages, streamed):
+    # The router call of chat_with_patient / stream_chat_with_patient (app.py).
+    kwargs = {"messages": full_messages, "temperature": 0.7, "max_tokens": 800}
+    if not streamed:
+        return get_router().create(client, "patient", **kwargs).choices[0].message.content
+    reply = ""
+    for chunk in get_router().stream(client, "patient", **kwargs):
+        if chunk.choices and chunk.choices[0].delta.content:
+            reply += chunk.choices[0].delta.content
+    return reply
+
+
+def replay(client, backend, store, case, transcript, turns, recorder, modes):
+    streamed = modes["replies"] == "stream"
+    structured = modes["feedback_format"] == "structured"
+    student = _fit(transcript["student"], turns)
+    backend.script(_fit(transcript["patient"], turns), transcript["feedback"])
+    window = new_context_window()
+    model = route("patient")["model"]
+    messages = []
+    with call_context(student=STUDENT, patient=case["name"]):
+        for line in student:
+            messages.append({"role": "user", "content": line})
+            with call_context(kind="patient_turn"):
+                with recorder.stage("patient_prompt"):
+                    full_messages = window.prepare(client, messages, case["system_prompt"], model)
+                with recorder.stage("patient_call"):
+                    response = patient_reply(client, full_messages, streamed)
+            messages.append({"role": "assistant", "content": response})
+
+        with call_context(kind="feedback"):
+            with recorder.stage("feedback_prompt"):
+                build_feedback_prompt(messages, case, structured=structured)
+            # Both build their prompt again, as in the app; the structured
+            # answer is parsed while it streams, so it has no parse stage.
+            with recorder.stage("feedback_call"):
+                if structured:
+                    result = generate_structured_feedback(client, messages, case)
+                else:
+                    text = generate_feedback(client, messages, case)
+        if not structured:
+            with recorder.stage("parse_feedback"):
+                result = parse_feedback(text)
+        with recorder.stage("save"):
+            store.save(make_record(
+                STUDENT, case["name"], messages, result["text"], None, result["score"], result["sections"],
+            ))
+
+
+def measure(client, backend, store, cases, transcripts, turns, repeat, modes):
+    timing = Recorder()
+    consultations = []
+    for _ in range(repeat):
+        for case in cases:
+            for transcript in transcripts[case["name"]]:
+                cpu, wall = time.process_time(), time.perf_counter()
+                replay(client, backend, store, case, transcript, turns, timing, modes)
+                consultations.append(((time.process_time() - cpu) * 1000, (time.perf_counter() - wall) * 1000))
+
+    allocations = Recorder(allocations=True)
+    tracemalloc.start()
+    try:
+        for case in cases:
+            for transcript in transcripts[case["name"]]:
+                replay(client, backend, store, case, transcript, turns, allocations, modes)
+    finally:
+        tracemalloc.stop()
+
+    stages = {}
+    for name in STAGES:
+        cpu = sorted(s[0] for s in timing.samples.get(name, []))
+        wall = sorted(s[1] for s in timing.samples.get(name, []))
+        alloc = sorted(allocations.samples.get(name, []))
+        if not cpu:
+            continue
+        stages[name] = {
+            "count": len(cpu),
+            "cpu_ms_p50": round(percentile(cpu, 50), 3),
+            "cpu_ms_p95": round(percentile(cpu, 95), 3),
+            "cpu_ms_total": round(sum(cpu), 2),
+            "wall_ms_p50": round(percentile(wall, 50), 3),
+            "alloc_kb_p50": round(percentile(alloc, 50), 1),
+            "alloc_kb_max": round(alloc[-1], 1),
+        }
+    cpu = sorted(c[0] for c in consultations)
+    wall = sorted(c[1] for c in consultations)
+    return {
+        "stages": stages,
+        "end_to_end": {
+            "consultations": len(wall),
+            "cpu_ms_p50": round(percentile(cpu, 50), 2),
+            "wall_ms_p50": round(percentile(wall, 50), 2),
+            "wall_ms_p95": round(percentile(wall, 95), 2),
+        },
+    }
+
+
+def run(args):
+    latency = {"patient_turn": args.patient_latency, "feedback": args.feedback_latency,
+               "context_summary": args.patient_latency}
+    modes = {"replies": args.replies, "feedback_format": args.feedback_format}
+    backend = ReplayBackend(latency)
+    client = RateLimitedClient(backend, max_retries=0)
+    all_cases, transcripts = load_inputs(max(args.cases), args.per_case, not args.no_history)
+    if not all_cases:
+        raise SystemExit("No valid cases in the catalog.")
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_replay_") as tmp:
+        # Call metrics go to the temporary directory too.
+        metrics.METRICS_DIR = Path(tmp) / "logs"
+        metrics.METRICS_FILE = metrics.METRICS_DIR / "metrics.jsonl"
+        if args.history_backend == "json":
+            store = JsonHistoryStore(Path(tmp) / "history")
+        else:
+            store = SqliteHistoryStore(Path(tmp) / "history.db")
+        for turns in args.turns:
+            for count in args.cases:
+                cases = all_cases[:count]
+                key = f"turns={turns} cases={len(cases)}"
+                results[key] = measure(client, backend, store, cases, transcripts, turns, args.repeat, modes)
+                print(f"{key}: {results[key]['end_to_end']['wall_ms_p50']:.1f} ms per consultation",
+                      file=sys.stderr)
+
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "turns": args.turns,
+            "cases": args.cases,
+            "repeat": args.repeat,
+            "patient_latency": args.patient_latency,
+            "feedback_latency": args.feedback_latency,
+            "history_backend": args.history_backend,
+            "replies": args.replies,
+            "feedback_format": args.feedback_format,
+            "inputs": fingerprint(all_cases, transcripts),
+            "context_budget": int(get_secret("CONTEXT_TOKEN_BUDGET", 4000)),
+        },
+        "results": results,
+    }
+
+
+# ── baselines ───────────────────────────────────────────────
+
+def compare(baseline, current, tolerance, min_ms):
+    """Rows of (point, stage, metric, before, after, ratio, regressed)."""
+    rows = []
+    for point, result in current["results"].items():
+        before = baseline["results"].get(point)
+        if before is None:
+            continue
+        for section, metric in COMPARED:
+            if section == "stages":
+                pairs = [(name, before["stages"].get(name), values) for name, values in result["stages"].items()]
+            else:
+                pairs = [("consultation", before["end_to_end"], result["end_to_end"])]
+            for name, old, new in pairs:
+                if not old or metric not in old:
+                    continue
+                a, b = old[metric], new[metric]
+                ratio = b / a if a else float("inf") if b else 1.0
+                # Differences below the noise floor are not regressions.
+                floor = min_ms if "_ms_" in metric else min_ms * 10
+                regressed = ratio > 1 + tolerance and b - a > floor
+                rows.append((point, name, metric, a, b, ratio, regressed))
+    return rows
+
+
+def print_report(report):
+    print(f"{'point':<22}{'stage':<16}{'cpu p50':>10}{'cpu p95':>10}{'wall p50':>10}{'alloc KB':>10}")
+    for point, result in report["results"].items():
+        for name, s in result["stages"].items():
+            print(f"{point:<22}{name:<16}{s['cpu_ms_p50']:>8.2f}ms{s['cpu_ms_p95']:>8.2f}ms"
+                  f"{s['wall_ms_p50']:>8.1f}ms{s['alloc_kb_p50']:>10.1f}")
+        e = result["end_to_end"]
+        print(f"{point:<22}{'consultation':<16}{e['cpu_ms_p50']:>8.2f}ms{'':>10}{e['wall_ms_p50']:>8.1f}ms")
+
+
+def default_replies():
+    # The app's streaming_enabled(); app.py is a Streamlit script and is not imported.
+    streamed = str(get_secret("STREAM_REPLIES", "true")).strip().lower() not in ("0", "false", "no", "off")
+    return "stream" if streamed else "whole"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded consultations against a scripted model")
+    parser.add_argument("--turns", type=int, nargs="+", default=[5, 20, 50], help="student turns per consultation")
+    parser.add_argument("--cases", type=int, nargs="+", default=[1, 5], help="number of cases replayed")
+    parser.add_argument("--per-case", type=int, default=3, help="recorded consultations per case")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--patient-latency", type=float, default=0.02, help="seconds per patient reply")
+    parser.add_argument("--feedback-latency", type=float, default=0.1, help="seconds per assessment")
+    parser.add_argument("--history-backend", choices=["sqlite", "json"],
+                        default=get_secret("HISTORY_BACKEND", "sqlite").lower())
+    parser.add_argument("--replies", choices=["stream", "whole"], default=default_replies(),
+                        help="patient replies streamed (STREAM_REPLIES) or in one piece")
+    parser.add_argument("--feedback-format", choices=["structured", "text"],
+                        default="structured" if structured_feedback_enabled() else "text")
+    parser.add_argument("--no-history", action="store_true",
+                        help="replay only synthetic conversations (same inputs on every machine)")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with a baseline written by --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown")
+    parser.add_argument("--min-ms", type=float, default=0.5, help="ignore differences below this (KB: x10)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        # Replay the same points as the baseline unless told otherwise.
+        for name in ("turns", "cases", "patient_latency", "feedback_latency", "history_backend",
+                     "replies", "feedback_format"):
+            if f"--{name.replace('_', '-')}" not in sys.argv and name in baseline["settings"]:
+                setattr(args, name, baseline["settings"][name])
+
+    report = run(args)
+    print_report(report)
+
+    if args.save_baseline:
+        path = Path(args.save_baseline)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Baseline written to {path}")
+
+    if baseline is not None:
+        if baseline["settings"]["inputs"] != report["settings"]["inputs"]:
+            print("Warning: the replayed transcripts differ from the baseline's (use --no-history "
+                  "for inputs that do not change).")
+        rows = compare(baseline, report, args.tolerance, args.min_ms)
+        regressions = [r for r in rows if r[6]]
+        print(f"\nCompared {len(rows)} metrics with {args.compare}: {len(regressions)} regressions")
+        for point, name, metric, a, b, ratio, _ in regressions:
+            print(f"  {point:<22}{name:<16}{metric:<14}{a:>10.2f} → {b:>10.2f}  ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
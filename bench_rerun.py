@@ -0,0 +1,106 @@
+"""
+Rerun-cost benchmark for app.py.
+
+Measures the server CPU time spent per chat interaction for consultations
+that already hold 5, 20 and 50 turns, with the chat fragments enabled
+(`UI_FRAGMENTS = "true"`) and disabled (the old whole-script reruns plus the
+extra `st.rerun()` after each reply). The model is the in-process mock
+server with no latency, so the numbers are rendering cost, not waiting.
+
+    python bench_rerun.py --turns 5 20 50 --repeat 5 --json rerun.json
+
+Note: `AppTest` has no browser, so a fragment rerun is executed as a run of
+the script in which only the fragment's widgets changed. The "fragments"
+column therefore still includes the top-level script, and is an upper bound
+for what a real browser session costs.
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from config import BASE_DIR
+from metrics import percentile
+from roster import DEFAULT_COURSE
+import mock_llm_server
+
+STUDENT_LINE = "Приемате ли някакви лекарства в момента?"
+
+
+def start_mock():
+    args = mock_llm_server.parse_args(["--port", "0", "--latency", "0", "--jitter", "0",
+                                       "--tokens-per-sec", "100000"])
+    server = mock_llm_server.serve(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1", server
+
+
+def prefilled_messages(turns):
+    messages = [{"role": "assistant", "content": mock_llm_server.PATIENT_REPLIES[0]}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": STUDENT_LINE})
+        messages.append({"role": "assistant", "content": mock_llm_server.PATIENT_REPLIES[i % 5]})
+    return messages
+
+
+def measure(base_url, turns, fragments, repeat):
+    from streamlit.testing.v1 import AppTest
+
+    samples = []
+    for _ in range(repeat):
+        at = AppTest.from_file(str(BASE_DIR / "app.py"), default_timeout=60)
+        at.secrets["OPENAI_API_KEY"] = "mock"
+        at.secrets["OPENAI_BASE_URL"] = base_url
+        at.secrets["UI_FRAGMENTS"] = "true" if fragments else "false"
+        at.session_state["authenticated"] = True
+        at.session_state["user_email"] = "bench@example.bg"
+        at.session_state["course"] = DEFAULT_COURSE
+        at.run()
+        at.session_state["messages"] = prefilled_messages(turns)
+        at.session_state["resume_checked"] = {at.session_state["current_patient"]}
+        at.run()
+
+        started = time.process_time()
+        at.chat_input[0].set_value(STUDENT_LINE).run()
+        samples.append(time.process_time() - started)
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+    samples.sort()
+    return {"p50": percentile(samples, 50), "max": samples[-1]}
+
+
+def run(args):
+    base_url, server = start_mock()
+    rows = []
+    try:
+        for turns in args.turns:
+            row = {"turns": turns}
+            for mode, fragments in (("full", False), ("fragments", True)):
+                row[mode] = measure(base_url, turns, fragments, args.repeat)
+            rows.append(row)
+    finally:
+        server.shutdown()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU time per chat interaction, fragments vs full reruns")
+    parser.add_argument("--turns", type=int, nargs="+", default=[5, 20, 50])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    rows = run(args)
+    print(f"{'turns':>6}{'full p50':>12}{'frag p50':>12}{'saved':>8}")
+    for r in rows:
+        full, frag = r["full"]["p50"], r["fragments"]["p50"]
+        saved = 1 - frag / full if full else 0.0
+        print(f"{r['turns']:>6}{full * 1000:>10.1f}ms{frag * 1000:>10.1f}ms{saved * 100:>7.0f}%")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Patient case catalog.
+
+Cases come from `patients.json` (a list of case objects, as before) and,
+optionally, from a `cases/` folder with one case per entry:
+
+    cases/kashlica-enalapril.json         a single case object
+    cases/kashlica-enalapril/case.json    the same, with the long prompts in
+    cases/kashlica-enalapril/system_prompt.md     separate files next to it
+    cases/kashlica-enalapril/feedback_prompt.md
+
+Every file is validated when it is first read and again whenever its mtime
+changes; invalid cases are left out and reported (see `catalog.errors` and
+`python cases.py`). The catalog keeps only a small index per case
+(name, age, hint, tags, difficulty); the full record with the prompts is
+loaded on demand and kept in a bounded LRU.
+"""
+
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from config import BASE_DIR, get_secret
+
+CASES_FILE = BASE_DIR / "patients.json"
+CASES_DIR = BASE_DIR / "cases"
+
+FIELDS = {
+    # name: (type, required)
+    "name": (str, True),
+    "system_prompt": (str, True),
+    "age": (int, False),
+    "scenario_hint": (str, False),
+    "description": (str, False),
+    "key_info": (str, False),
+    "opening_message": (str, False),
+    "feedback_prompt": (str, False),
+    "difficulty": (str, False),
+    "tags": (list, False),
+    "key_points": (list, False),
+}
+PROMPT_FILES = ("system_prompt", "feedback_prompt")
+INDEX_FIELDS = ("name", "age", "scenario_hint", "tags", "difficulty")
+
+# How often the sources are stat()ed for changes; a rerun in between reuses
+# the index as is.
+CHECK_INTERVAL = 2.0
+
+
+def validate_case(record, prompt_files=()):
+    # Returns a list of problems; an empty list means the case is usable.
+    # `prompt_files` names prompt fields supplied by separate files.
+    if not isinstance(record, dict):
+        return ["записът не е JSON обект"]
+    problems = []
+    for field, (kind, required) in FIELDS.items():
+        if field not in record:
+            if required and field not in prompt_files:
+                problems.append(f"липсва поле „{field}“")
+            continue
+        value = record[field]
+        if kind is int and isinstance(value, bool) or not isinstance(value, kind):
+            problems.append(f"полето „{field}“ трябва да е {kind.__name__}")
+        elif kind is str and field in ("name", "system_prompt") and not value.strip():
+            problems.append(f"полето „{field}“ е празно")
+        elif kind is list and not all(isinstance(tag, str) for tag in value):
+            problems.append(f"полето „{field}“ трябва да съдържа само текст")
+    return problems
+
+
+class CaseCatalog:
+    def __init__(self, cases_file=CASES_FILE, cases_dir=CASES_DIR, cached_records=64):
+        self.cases_file = cases_file
+        self.cases_dir = cases_dir
+        self.cached_records = cached_records
+        self._lock = threading.Lock()
+        self._files = {}  # path -> (mtime, [index entries], [errors])
+        self._index = OrderedDict()  # name -> index entry
+        self._errors = []
+        self._records = OrderedDict()  # (name, mtime) -> full record
+        self._checked = 0.0
+
+    # ── index ───────────────────────────────────────────────
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._index and now - self._checked < CHECK_INTERVAL:
+                return
+            self._checked = now
+
+            sources = self._sources()
+            changed = set(sources) != set(self._files)
+            for path, mtime in sources.items():
+                cached = self._files.get(path)
+                if cached is None or cached[0] != mtime:
+                    self._files[path] = (mtime, *self._read_index(path))
+                    changed = True
+            for path in set(self._files) - set(sources):
+                del self._files[path]
+            if changed:
+                self._rebuild()
+
+    def _sources(self):
+        sources = {}
+        candidates = [self.cases_file]
+        if self.cases_dir.is_dir():
+            for entry in sorted(self.cases_dir.iterdir()):
+                if entry.suffix == ".json":
+                    candidates.append(entry)
+                elif entry.is_dir() and (entry / "case.json").exists():
+                    candidates.append(entry / "case.json")
+        for path in candidates:
+            try:
+                mtime = path.stat().st_mtime
+                if path.name == "case.json":
+                    # Edits to the prompt files also invalidate the case.
+                    for field in PROMPT_FILES:
+                        prompt = path.parent / f"{field}.md"
+                        if prompt.exists():
+                            mtime = max(mtime, prompt.stat().st_mtime)
+                sources[path] = mtime
+            except FileNotFoundError:
+                continue
+        return sources
+
+    def _read_index(self, path):
+        entries, errors = [], []
+        try:
+            records = self._load_file(path)
+        except (OSError, json.JSONDecodeError) as e:
+            return entries, [f"{path.name}: {e}"]
+        for position, record in enumerate(records):
+            where = f"{path.name}" + (f" #{position + 1}" if len(records) > 1 else "")
+            problems = validate_case(record, self._prompt_files(path))
+            if problems:
+                errors.append(f"{where}: {'; '.join(problems)}")
+                continue
+            entry = {field: record.get(field) for field in INDEX_FIELDS}
+            entry["tags"] = entry["tags"] or []
+            entry["source"] = path
+            entry["position"] = position
+            entries.append(entry)
+        return entries, errors
+
+    def _rebuild(self):
+        index, errors = OrderedDict(), []
+        for path, (_, entries, file_errors) in self._files.items():
+            errors.extend(file_errors)
+            for entry in entries:
+                if entry["name"] in index:
+                    # Names key the history and saved sessions, so they must be unique.
+                    errors.append(f"{path.name}: казусът „{entry['name']}“ вече съществува")
+                    continue
+                index[entry["name"]] = entry
+        self._index = index
+        self._errors = errors
+
+    # ── records ─────────────────────────────────────────────
+
+    def _prompt_files(self, path):
+        if path.name != "case.json":
+            return ()
+        return tuple(field for field in PROMPT_FILES if (path.parent / f"{field}.md").exists())
+
+    def _load_file(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, list) else [data]
+
+    def get(self, name):
+        """Full case record (with prompts) by name, or None."""
+        self.refresh()
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None:
+                return None
+            key = (name, self._files[entry["source"]][0])
+            if key in self._records:
+                self._records.move_to_end(key)
+                return dict(self._records[key])
+
+        path = entry["source"]
+        record = self._load_file(path)[entry["position"]]
+        for field in self._prompt_files(path):
+            if field not in record:
+                record[field] = (path.parent / f"{field}.md").read_text(encoding="utf-8")
+
+        with self._lock:
+            self._records[key] = record
+            while len(self._records) > self.cached_records:
+                self._records.popitem(last=False)
+        return dict(record)
+
+    # ── queries ─────────────────────────────────────────────
+
+    def entries(self):
+        self.refresh()
+        with self._lock:
+            return list(self._index.values())
+
+    def names(self):
+        return [entry["name"] for entry in self.entries()]
+
+    def errors(self):
+        self.refresh()
+        with self._lock:
+            return list(self._errors)
+
+    def tags(self, names=None):
+        return sorted({
+            tag for entry in self.entries() for tag in entry["tags"]
+            if names is None or entry["name"] in names
+        })
+
+    def difficulties(self, names=None):
+        return sorted({
+            entry["difficulty"] for entry in self.entries()
+            if entry["difficulty"] and (names is None or entry["name"] in names)
+        })
+
+    def search(self, text="", tags=(), difficulty=None, names=None):
+        # Cases matching all given filters, in catalog order. `names`
+        # restricts the result to an allowed set of cases.
+        text = text.strip().lower()
+        found = []
+        for entry in self.entries():
+            if names is not None and entry["name"] not in names:
+                continue
+            if difficulty and entry["difficulty"] != difficulty:
+                continue
+            if tags and not set(tags) <= set(entry["tags"]):
+                continue
+            if text and text not in " ".join(
+                [entry["name"], entry["scenario_hint"] or "", *entry["tags"]]
+            ).lower():
+                continue
+            found.append(entry)
+        return found
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_case_catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = CaseCatalog(cached_records=int(get_secret("CASE_RECORDS_CACHED", 64)))
+            _catalog.refresh(force=True)
+        return _catalog
+
+
+def main():
+    # python cases.py  — list and validate all cases, non-zero exit on problems
+    catalog = CaseCatalog()
+    catalog.refresh(force=True)
+    for entry in catalog.entries():
+        tags = ", ".join(entry["tags"])
+        print(f"{entry['name']:<30} {entry['difficulty'] or '-':<10} {tags}")
+    errors = catalog.errors()
+    for error in errors:
+        print(f"ГРЕШКА: {error}", file=sys.stderr)
+    print(f"\n{len(catalog.entries())} казуса, {len(errors)} грешки")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+"""
+Configuration helpers shared by the app and its background workers.
+"""
+
+import os
+from pathlib import Path
+
+import streamlit as st
+
+BASE_DIR = Path(__file__).parent
+
+
+def get_secret(key, default=""):
+    try:
+        return st.secrets[key]
+    except Exception:
+        return os.getenv(key, default)
+
+
+# Runtime data (history, saved consultations, caches). Several app processes
+# or nodes share state by pointing this at the same (shared) directory.
+DATA_DIR = Path(get_secret("DATA_DIR", "") or BASE_DIR)
@@ -0,0 +1,124 @@
+"""
+Token-budgeted conversation context for patient turns.
+
+Each patient turn used to send the system prompt plus the whole transcript,
+so cost grew with every message. A `ContextWindow` (one per consultation,
+kept in session state) sends everything while it fits in the budget. Once it
+does not, turns older than the last `keep_turns` exchanges are folded into a
+running summary. Only the newly dropped turns are summarised, together with
+the previous summary, so the work is incremental.
+
+The request is ordered system prompt -> summary -> recent turns. The system
+prompt never changes and the summary changes only when a fold happens, which
+keeps a long stable prefix for provider-side prompt caching.
+"""
+
+from config import get_secret
+from metrics import call_context
+from router import get_router
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to a character estimate
+    tiktoken = None
+
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_HEADER = "РЕЗЮМЕ НА ДОСЕГАШНИЯ РАЗГОВОР (за твоя ориентация, не го цитирай):\n"
+
+SUMMARY_PROMPT = """Обобщи кратко (до 120 думи) досегашния разговор между фармацевт и пациент.
+Запиши какво е попитал фармацевтът, каква информация вече е разкрил пациентът
+и какво е било препоръчано. Пиши в трето лице, на БЪЛГАРСКИ език, без оценки."""
+
+_encoders = {}
+
+
+def count_tokens(text, model="gpt-4o"):
+    if tiktoken is None:
+        # Cyrillic text averages roughly three characters per token.
+        return len(text) // 3 + 1
+    encoder = _encoders.get(model)
+    if encoder is None:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoder = tiktoken.get_encoding("o200k_base")
+        _encoders[model] = encoder
+    return len(encoder.encode(text))
+
+
+def count_message_tokens(messages, model="gpt-4o"):
+    return sum(count_tokens(m["content"], model) + MESSAGE_OVERHEAD for m in messages)
+
+
+def format_transcript(messages):
+    return "\n".join(
+        f"{'ФАРМАЦЕВТ' if m['role'] == 'user' else 'ПАЦИЕНТ'}: {m['content']}"
+        for m in messages
+    )
+
+
+class ContextWindow:
+    def __init__(self, budget=4000, keep_turns=6):
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.summary = ""
+        self.folded = 0  # number of leading messages covered by the summary
+        self.last_report = None
+
+    def _assemble(self, messages, system_prompt):
+        prefix = [{"role": "system", "content": system_prompt}]
+        if self.summary:
+            prefix.append({"role": "system", "content": SUMMARY_HEADER + self.summary})
+        return prefix + messages[self.folded:]
+
+    def prepare(self, client, messages, system_prompt, model):
+        full_tokens = count_message_tokens(
+            [{"role": "system", "content": system_prompt}] + messages, model
+        )
+        if len(messages) < self.folded:
+            # The transcript was reset underneath us.
+            self.summary, self.folded = "", 0
+
+        assembled = self._assemble(messages, system_prompt)
+        keep_from = max(0, len(messages) - 2 * self.keep_turns)
+        if count_message_tokens(assembled, model) > self.budget and keep_from > self.folded:
+            try:
+                self._fold(client, messages[self.folded:keep_from])
+                self.folded = keep_from
+                assembled = self._assemble(messages, system_prompt)
+            except Exception:
+                # Summarising is an optimisation; never lose the turn over it.
+                pass
+
+        sent_tokens = count_message_tokens(assembled, model)
+        self.last_report = {
+            "prompt_tokens_full": full_tokens,
+            "prompt_tokens_sent": sent_tokens,
+            "folded_messages": self.folded,
+        }
+        return assembled
+
+    def _fold(self, client, dropped):
+        parts = []
+        if self.summary:
+            parts.append(f"ДОСЕГАШНО РЕЗЮМЕ:\n{self.summary}")
+        parts.append(f"НОВИ РЕПЛИКИ:\n{format_transcript(dropped)}")
+        with call_context(kind="context_summary"):
+            response = get_router().create(
+                client, "summary",
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": "\n\n".join(parts)},
+                ],
+                temperature=0.2,
+                max_tokens=300,
+            )
+        self.summary = response.choices[0].message.content.strip()
+
+
+def new_context_window():
+    return ContextWindow(
+        budget=int(get_secret("CONTEXT_TOKEN_BUDGET", 4000)),
+        keep_turns=int(get_secret("CONTEXT_KEEP_TURNS", 6)),
+    )
@@ -0,0 +1,134 @@
+"""
+Streaming export of the consultation history.
+
+Records are read from the history store one at a time and written straight
+to the output, so memory use does not grow with the size of the archive:
+
+    python export.py jsonl    -o semester.jsonl.gz
+    python export.py sessions -o sessions.csv --since 2025-02-01
+    python export.py turns    -o turns.csv.gz --patient "Мария Иванова"
+
+    jsonl      one full record (messages, feedback, timings) per line
+    sessions   CSV, one row per consultation (score, turns, feedback sections)
+    turns      CSV, one row per message, with the reply's latency
+
+Filters: --student, --patient, --since, --until (ISO dates, `until`
+exclusive). Output paths ending in `.gz` are compressed; CSV is written with
+a BOM so Excel opens the Cyrillic text correctly. The instructor page
+offers the same exports as downloads.
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import sys
+
+from history import get_history_store
+
+FORMATS = ("jsonl", "sessions", "turns")
+
+SESSION_FIELDS = [
+    "student_email", "patient", "timestamp", "score", "turns", "student_turns",
+    "avg_ttft", "feedback", "sections",
+]
+TURN_FIELDS = [
+    "student_email", "patient", "timestamp", "turn", "role", "content", "ttft", "total",
+]
+
+
+def session_row(record):
+    messages = record.get("messages", [])
+    timings = record.get("turn_timings") or []
+    ttfts = [t["ttft"] for t in timings if t.get("ttft") is not None]
+    return {
+        "student_email": record.get("student_email", ""),
+        "patient": record.get("patient", ""),
+        "timestamp": record.get("timestamp", ""),
+        "score": record.get("score"),
+        "turns": len(messages),
+        "student_turns": sum(1 for m in messages if m["role"] == "user"),
+        "avg_ttft": round(sum(ttfts) / len(ttfts), 3) if ttfts else None,
+        "feedback": record.get("feedback", ""),
+        "sections": json.dumps(record.get("feedback_sections") or {}, ensure_ascii=False),
+    }
+
+
+def turn_rows(record):
+    # The first message is the patient's opening line; every later patient
+    # reply has a timing entry, in order.
+    timings = record.get("turn_timings") or []
+    reply = -1
+    for index, message in enumerate(record.get("messages", [])):
+        timing = {}
+        if message["role"] == "assistant":
+            if reply >= 0 and reply < len(timings):
+                timing = timings[reply]
+            reply += 1
+        yield {
+            "student_email": record.get("student_email", ""),
+            "patient": record.get("patient", ""),
+            "timestamp": record.get("timestamp", ""),
+            "turn": index,
+            "role": message["role"],
+            "content": message["content"],
+            "ttft": timing.get("ttft"),
+            "total": timing.get("total"),
+        }
+
+
+def write_export(fmt, out, records):
+    """Write `records` to the binary file `out` in `fmt`; returns the record count."""
+    text = io.TextIOWrapper(out, encoding="utf-8-sig" if fmt != "jsonl" else "utf-8", newline="")
+    count = 0
+    try:
+        if fmt == "jsonl":
+            for record in records:
+                text.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+        else:
+            writer = csv.DictWriter(text, fieldnames=SESSION_FIELDS if fmt == "sessions" else TURN_FIELDS)
+            writer.writeheader()
+            for record in records:
+                if fmt == "sessions":
+                    writer.writerow(session_row(record))
+                else:
+                    writer.writerows(turn_rows(record))
+                count += 1
+    finally:
+        text.flush()
+        text.detach()  # leave `out` open for the caller
+    return count
+
+
+def export(fmt, out, student=None, patient=None, since=None, until=None, compress=False):
+    """Stream the matching history records into the binary file `out`."""
+    records = get_history_store().iter_matching(student, patient, since, until)
+    if not compress:
+        return write_export(fmt, out, records)
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        return write_export(fmt, gz, records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export consultation history")
+    parser.add_argument("format", choices=FORMATS)
+    parser.add_argument("-o", "--output", help="output file (default: stdout); .gz compresses")
+    parser.add_argument("--student")
+    parser.add_argument("--patient")
+    parser.add_argument("--since", help="ISO date, e.g. 2025-03-01")
+    parser.add_argument("--until")
+    args = parser.parse_args()
+
+    filters = dict(student=args.student, patient=args.patient, since=args.since, until=args.until)
+    if args.output:
+        with open(args.output, "wb") as out:
+            count = export(args.format, out, compress=args.output.endswith(".gz"), **filters)
+    else:
+        count = export(args.format, sys.stdout.buffer, **filters)
+    print(f"Exported {count} records.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+Feedback generation for finished consultations.
+
+Two output formats are supported (`FEEDBACK_FORMAT` secret):
+
+    structured (default)  JSON with `clinical`, `communication` and
+                          `recommendations` sections plus a 1-5 `score`,
+                          streamed and parsed section by section
+    text                  the original three free-text sections joined by |||
+
+Both end up as the same result dict (see `parse_feedback`), so the display
+and the history never need to care which format produced them.
+"""
+
+import json
+import re
+
+from config import get_secret
+from context import format_transcript
+from router import get_router
+from transcript_analysis import analysis_enabled, analyze_transcript, format_facts
+
+SECTIONS = ("clinical", "communication", "recommendations")
+
+SECTION_TITLES = {
+    "clinical": "Клинична оценка",
+    "communication": "Комуникативни умения",
+    "recommendations": "Препоръки за подобрение",
+}
+
+FEEDBACK_SCHEMA = {
+    "name": "consultation_feedback",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "clinical": {"type": "string"},
+            "communication": {"type": "string"},
+            "recommendations": {"type": "string"},
+            # Strict mode rejects minimum/maximum; coerce_score checks the range too.
+            "score": {"type": "integer", "enum": [1, 2, 3, 4, 5]},
+        },
+        "required": ["clinical", "communication", "recommendations", "score"],
+        "additionalProperties": False,
+    },
+}
+
+TEXT_FORMAT_INSTRUCTIONS = """Отговорът трябва да съдържа точно 3 секции, разделени с |||
+Не слагай заглавие на секция преди съдържанието.
+
+Секция 1: Клинична оценка (правилност на решенията, безопасност)
+|||
+Секция 2: Комуникативни умения (въпроси, емпатия, структура)
+|||
+Секция 3: Препоръки за подобрение (конкретен план)"""
+
+JSON_FORMAT_INSTRUCTIONS = """Върни САМО JSON обект със следните полета, в този ред:
+"clinical" – клинична оценка (правилност на решенията, безопасност), Markdown текст
+"communication" – комуникативни умения (въпроси, емпатия, структура), Markdown текст
+"recommendations" – препоръки за подобрение (конкретен план), Markdown текст
+"score" – обща оценка, цяло число от 1 до 5
+Не слагай заглавия на секциите в текста."""
+
+
+DEFAULT_FEEDBACK_PROMPT = """Ти си експерт по фармацевтична комуникация и оценител на комуникативни умения.
+Анализирай следния разговор между фармацевт-студент и симулиран пациент.
+
+Предостави ПОДРОБНА обратна връзка по следните области:
+
+КЛИНИЧНА ОЦЕНКА:
+- Правилност на препоръката
+- Задал ли е студентът ключовите въпроси
+- Безопасност на решенията
+- Пропуснати важни аспекти
+
+КОМУНИКАТИВНИ УМЕНИЯ:
+- Отворени въпроси (брой и примери)
+- Затворени въпроси (брой и уместност)
+- Обобщаване и парафразиране
+- Емпатичен отговор
+- Използване на разбираем език
+
+ПРЕПОРЪКИ ЗА ПОДОБРЕНИЕ:
+- Какво е направено добре (конкретни примери)
+- Какво може да се подобри (конкретни предложения)
+- Обща оценка по скала от 1 до 5
+
+Бъди конструктивен, справедлив и балансиран. Започни с положителното."""
+
+
+FACTS_INSTRUCTIONS = """Данните по-долу са изчислени автоматично и са точни: не преброявай
+въпросите и изразите отново, а ги използвай като основа за преценката си.
+Бъди кратък: до 5 изречения на секция, с конкретни примери от транскрипта."""
+
+
+def build_feedback_prompt(messages, patient_data, structured=False):
+    conversation_text = format_transcript(messages)
+
+    feedback_prompt = patient_data.get("feedback_prompt", DEFAULT_FEEDBACK_PROMPT)
+    format_instructions = JSON_FORMAT_INSTRUCTIONS if structured else TEXT_FORMAT_INSTRUCTIONS
+
+    facts = ""
+    if analysis_enabled():
+        facts = f"""
+---
+АВТОМАТИЧЕН АНАЛИЗ НА РЕПЛИКИТЕ НА СТУДЕНТА:
+{FACTS_INSTRUCTIONS}
+
+{format_facts(analyze_transcript(messages, patient_data))}
+"""
+
+    return f"""{feedback_prompt}
+
+---
+ИНФОРМАЦИЯ ЗА ПАЦИЕНТА:
+Име: {patient_data['name']}
+Възраст: {patient_data.get('age', 'неизвестна')}
+Описание: {patient_data.get('description', '')}
+Ключова информация: {patient_data.get('key_info', '')}
+{facts}
+---
+ТРАНСКРИПТ НА КОНСУЛТАЦИЯТА:
+
+{conversation_text}
+
+---
+ВАЖНО: Обратната връзка трябва да е на БЪЛГАРСКИ език.
+{format_instructions}
+"""
+
+
+def feedback_request(messages, patient_data, structured=False):
+    # Keyword arguments of the grading call, shared by all the variants below.
+    request = {
+        "messages": [{"role": "user", "content": build_feedback_prompt(messages, patient_data, structured)}],
+        "temperature": 0.3,
+        "max_tokens": feedback_max_tokens(),
+    }
+    if structured:
+        request["response_format"] = {"type": "json_schema", "json_schema": FEEDBACK_SCHEMA}
+    return request
+
+
+def generate_feedback(client, messages, patient_data):
+    response = get_router().create(client, "grading", **feedback_request(messages, patient_data))
+    return response.choices[0].message.content
+
+
+async def agenerate_feedback(gateway, messages, patient_data):
+    # Coroutine variant for the async gateway (gateway.py).
+    response = await get_router().acreate(gateway, "grading", **feedback_request(messages, patient_data))
+    return response.choices[0].message.content
+
+
+def feedback_max_tokens():
+    # With the counting done locally the answer is judgement only, and shorter.
+    return int(get_secret("FEEDBACK_MAX_TOKENS", 1500 if analysis_enabled() else 3000))
+
+
+def structured_feedback_enabled():
+    return str(get_secret("FEEDBACK_FORMAT", "structured")).strip().lower() != "text"
+
+
+def generate_structured_feedback(client, messages, patient_data, on_progress=None):
+    # Streams the JSON answer; `on_progress(snapshot)` is called whenever a
+    # section completes or grows, with the parser's current snapshot.
+    stream = get_router().stream(client, "grading", **feedback_request(messages, patient_data, structured=True))
+    parser = FeedbackStreamParser()
+    for chunk in stream:
+        if _feed(parser, chunk) and on_progress is not None:
+            on_progress(parser.snapshot())
+    return parse_feedback(parser.text)
+
+
+async def agenerate_structured_feedback(gateway, messages, patient_data, on_progress=None):
+    # Coroutine variant; `on_progress` is awaited.
+    stream = get_router().astream(gateway, "grading", **feedback_request(messages, patient_data, structured=True))
+    parser = FeedbackStreamParser()
+    async for chunk in stream:
+        if _feed(parser, chunk) and on_progress is not None:
+            await on_progress(parser.snapshot())
+    return parse_feedback(parser.text)
+
+
+def _feed(parser, chunk):
+    # True when the chunk carried text.
+    delta = chunk.choices[0].delta.content if chunk.choices else None
+    if delta:
+        parser.feed(delta)
+    return bool(delta)
+
+
+# ─────────────────────────────────────────────────────────────
+# PARSING
+# ─────────────────────────────────────────────────────────────
+
+class FeedbackStreamParser:
+    """Incremental parser for a flat JSON object arriving in pieces.
+
+    Only what the feedback schema needs is understood: string, number and
+    literal values at the top level. Anything else (nesting, junk) stops the
+    incremental parsing, and `parse_feedback` on the full text decides.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self.broken = False
+        self._pos = 0
+        self._state = "object"
+        self._key = None
+        self._start = 0
+        self._escape = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        while self._pos < len(text) and not self.broken:
+            ch = text[self._pos]
+            state = self._state
+            if state == "object":
+                # Skips anything before the opening brace, e.g. a ```json fence.
+                if ch == "{":
+                    self._state = "key"
+            elif state == "key":
+                if ch == '"':
+                    self._start, self._state = self._pos, "key_string"
+                elif ch == "}":
+                    self._state = "done"
+                elif not (ch.isspace() or ch == ","):
+                    self.broken = True
+            elif state in ("key_string", "value_string"):
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    # strict=False: models put raw newlines inside strings.
+                    try:
+                        literal = json.loads(text[self._start:self._pos + 1], strict=False)
+                    except json.JSONDecodeError:
+                        self.broken = True
+                        break
+                    if state == "key_string":
+                        self._key, self._state = literal, "colon"
+                    else:
+                        self.fields[self._key] = literal
+                        self._state = "key"
+            elif state == "colon":
+                if ch == ":":
+                    self._state = "value"
+                elif not ch.isspace():
+                    self.broken = True
+            elif state == "value":
+                if ch == '"':
+                    self._start, self._state = self._pos, "value_string"
+                elif ch in "{[":
+                    self.broken = True
+                elif not ch.isspace():
+                    self._start, self._state = self._pos, "value_literal"
+            elif state == "value_literal":
+                if ch in ",}" or ch.isspace():
+                    try:
+                        self.fields[self._key] = json.loads(text[self._start:self._pos])
+                    except json.JSONDecodeError:
+                        self.broken = True
+                    self._state = "done" if ch == "}" else "key"
+            self._pos += 1
+        return self.fields
+
+    def partial(self):
+        # (key, text so far) of a string value that is still arriving.
+        if self._state != "value_string":
+            return None, ""
+        raw = self.text[self._start:self._pos]
+        if raw.endswith("\\") and not raw.endswith("\\\\"):
+            raw = raw[:-1]
+        try:
+            return self._key, json.loads(raw + '"', strict=False)
+        except json.JSONDecodeError:
+            return self._key, ""
+
+    def snapshot(self):
+        key, text = self.partial()
+        return {"sections": dict(self.fields), "partial_key": key, "partial_text": text}
+
+
+SCORE_PATTERN = re.compile(r"\b([1-5](?:[.,]\d)?)\s*(?:/|от)\s*5\b")
+
+
+def coerce_score(value):
+    try:
+        score = round(float(str(value).replace(",", ".")))
+    except (TypeError, ValueError):
+        return None
+    return score if 1 <= score <= 5 else None
+
+
+def find_score(text):
+    match = SCORE_PATTERN.search(text or "")
+    return coerce_score(match.group(1)) if match else None
+
+
+def _strip_fences(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    return text.strip()
+
+
+def parse_feedback(text):
+    """Normalise any model answer into
+    ``{"sections": {clinical, communication, recommendations} or None,
+    "score": int or None, "text": str, "structured": bool}``.
+
+    JSON that passes validation is used as is; otherwise the ||| split of the
+    text format is tried, and failing that the answer is kept as one block.
+    """
+    text = text or ""
+    try:
+        data = json.loads(_strip_fences(text), strict=False)
+    except json.JSONDecodeError:
+        data = None
+
+    if isinstance(data, dict) and all(
+        isinstance(data.get(name), str) and data[name].strip() for name in SECTIONS
+    ):
+        sections = {name: data[name].strip() for name in SECTIONS}
+        score = coerce_score(data.get("score"))
+        if score is None:
+            score = find_score(sections["recommendations"])
+        return {"sections": sections, "score": score, "text": format_feedback_text(sections), "structured": True}
+
+    parts = text.split("|||")
+    if len(parts) >= 3:
+        sections = {name: part.strip() for name, part in zip(SECTIONS, parts)}
+        return {"sections": sections, "score": find_score(text), "text": text, "structured": False}
+
+    return {"sections": None, "score": find_score(text), "text": text.strip(), "structured": False}
+
+
+def format_feedback_text(sections):
+    # The ||| layout older records use, so saved feedback stays readable
+    # by anything that splits it.
+    return "\n|||\n".join(sections[name] for name in SECTIONS)
@@ -0,0 +1,129 @@
+"""
+Content-addressed cache for graded consultations.
+
+A retry after a failed or interrupted assessment would otherwise pay for the
+same 3000-token grading call again. Results are keyed by a hash of everything
+that determines the answer: the effective feedback prompt (which embeds the
+transcript and the case fields), the model and the output format. There are
+two tiers: an in-memory LRU and a bounded directory of JSON files under
+`cache/feedback/`, evicted oldest-first.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from config import DATA_DIR, get_secret
+from feedback import build_feedback_prompt
+
+CACHE_DIR = DATA_DIR / "cache" / "feedback"
+
+
+def feedback_cache_key(messages, patient_data, model, structured):
+    prompt = build_feedback_prompt(messages, patient_data, structured=structured)
+    payload = json.dumps(
+        {"prompt": prompt, "model": model, "structured": structured},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FeedbackCache:
+    def __init__(self, memory_entries=256, disk_entries=5000, cache_dir=CACHE_DIR):
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._disk_count = None
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return self._memory[key]
+
+        path = self.cache_dir / f"{key}.json"
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)  # mark as recently used for eviction
+        except (OSError, json.JSONDecodeError):
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self._stats["disk_hits"] += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._stats["stores"] += 1
+            self._remember(key, value)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / f"{key}.json"
+        is_new = not path.exists()
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")  # unique across processes
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        if is_new:
+            self._after_disk_insert()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    # ── internals ───────────────────────────────────────────
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _after_disk_insert(self):
+        with self._lock:
+            if self._disk_count is None:
+                self._disk_count = sum(1 for _ in self.cache_dir.glob("*.json"))
+            else:
+                self._disk_count += 1
+            if self._disk_count <= self.disk_entries:
+                return
+            # Evict down to 90% so the directory scan is not repeated on
+            # every insert once the cache is full.
+            files = sorted(self.cache_dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
+            excess = len(files) - int(self.disk_entries * 0.9)
+            for path in files[:max(excess, 0)]:
+                try:
+                    path.unlink()
+                    self._stats["evictions"] += 1
+                except FileNotFoundError:
+                    pass
+            self._disk_count = len(files) - max(excess, 0)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_feedback_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FeedbackCache(
+                memory_entries=int(get_secret("FEEDBACK_CACHE_MEMORY", 256)),
+                disk_entries=int(get_secret("FEEDBACK_CACHE_DISK", 5000)),
+            )
+        return _cache
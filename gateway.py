@@ -0,0 +1,296 @@
+"""
+Asyncio model gateway.
+
+With the default client (llm_client.RateLimitedClient) every model call runs
+in the calling thread: a script thread, a feedback worker or a hedging
+thread stays blocked on the network for the whole completion, and also
+while the call waits for a scheduler slot. The gateway instead runs all
+requests as coroutines of the async OpenAI client on one event loop in a
+background thread; an async caller (`acreate`, `astream`) holds no thread
+while it waits.
+
+It has the same interface as `RateLimitedClient` (the fair scheduler,
+quotas, retries and metrics are shared), so `chat_with_patient`,
+`generate_feedback`, the router and the context window use it unchanged:
+they submit a coroutine to the loop and wait for its result. These callers
+(patient replies and context summaries, from the Streamlit script thread)
+are synchronous, so each of them still blocks its own thread until the
+result arrives, as with the threaded client; what they gain is
+cancellation, not fewer threads. Feedback jobs (jobs.py) run as coroutines
+on the loop through `ModelRouter.acreate` / `astream` and hold no thread
+while they wait. A call is
+cancelled on the loop when the caller stops waiting for it (a stream that
+is closed early, a Streamlit script that is stopped), and all of a
+student's interactive calls can be cancelled with `cancel(student)` when
+the student resets the consultation or logs out.
+
+Enable it with `MODEL_GATEWAY = "async"`; `python bench_gateway.py`
+compares it with the threaded client.
+"""
+
+import asyncio
+import concurrent.futures
+import queue
+import threading
+import time
+
+import metrics
+from llm_client import RateLimitedClient
+from scheduler import DeadlineExceeded, current_budget, current_wait_callback
+
+INTERACTIVE_KINDS = {"patient_turn", "context_summary"}
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AsyncModelGateway(RateLimitedClient):
+    """`RateLimitedClient` whose requests are coroutines on a shared event loop."""
+
+    def __init__(self, client, max_retries=4, backoff_base=0.5, backoff_max=20.0, scheduler=None):
+        super().__init__(
+            client, max_retries=max_retries, backoff_base=backoff_base,
+            backoff_max=backoff_max, scheduler=scheduler,
+        )
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="model-gateway", daemon=True).start()
+        self._calls_lock = threading.Lock()
+        self._calls = {}  # concurrent future -> tags
+
+    # ── async API (coroutines run on the gateway loop) ──────
+
+    async def acreate(self, tags=None, handle=None, **kwargs):
+        """Non-streaming completion; `handle["ticket"]` is the scheduler ticket."""
+        tags = metrics.current_tags() if tags is None else tags
+        started = time.perf_counter()
+        attempts = [0]
+        ticket = None
+        try:
+            ticket = await self._aacquire(tags, handle)
+            result = await self._awith_retries(self.raw.chat.completions.create, attempts, handle, **kwargs)
+            usage = getattr(result, "usage", None)
+            await asyncio.to_thread(self._count_usage, ticket, usage)  # a shared-state write
+            metrics.record_call(
+                kwargs.get("model"), usage,
+                time.perf_counter() - started, attempts[0], tags=tags,
+            )
+            return result
+        except (Exception, asyncio.CancelledError) as e:
+            metrics.record_call(
+                kwargs.get("model"), None, time.perf_counter() - started,
+                attempts[0], error=type(e).__name__, tags=tags,
+            )
+            raise
+        finally:
+            if ticket is not None:
+                self._release(ticket)
+
+    async def astream(self, tags=None, handle=None, **kwargs):
+        """Streaming completion: an async generator of chunks."""
+        tags = metrics.current_tags() if tags is None else tags
+        kwargs["stream"] = True
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        started = time.perf_counter()
+        attempts = [0]
+        ticket = None
+        usage = None
+        first_token = None
+        error = None
+        try:
+            ticket = await self._aacquire(tags, handle)
+            stream = await self._awith_retries(self.raw.chat.completions.create, attempts, handle, **kwargs)
+            try:
+                async for chunk in stream:
+                    if first_token is None and getattr(chunk, "choices", None):
+                        first_token = time.perf_counter() - started
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                    yield chunk
+            finally:
+                await stream.close()
+            await asyncio.to_thread(self._count_usage, ticket, usage)
+        except (Exception, asyncio.CancelledError) as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if ticket is not None:
+                self._release(ticket)
+            metrics.record_call(
+                kwargs.get("model"), usage, time.perf_counter() - started,
+                attempts[0], error=error, tags=tags, stream=True, ttft=first_token,
+            )
+
+    # ── blocking facade (same as RateLimitedClient) ─────────
+
+    def create_chat_completion(self, **kwargs):
+        tags = metrics.current_tags()
+        if kwargs.get("stream"):
+            return _BridgedStream(self, tags, kwargs)
+        handle = {"budget": current_budget()}
+        future = self.submit(self.acreate(tags=tags, handle=handle, **kwargs), tags)
+        try:
+            while True:
+                try:
+                    return future.result(timeout=0.5)
+                except concurrent.futures.TimeoutError:
+                    if future.done():
+                        raise  # the call itself timed out (the same class since Python 3.11)
+                    self._report_position(handle)
+        finally:
+            future.cancel()  # no-op once finished; stops the call if the caller gave up
+
+    def submit(self, coro, tags=None):
+        """Run `coro` on the gateway loop; returns a `concurrent.futures.Future`."""
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        with self._calls_lock:
+            self._calls[future] = tags or {}
+        future.add_done_callback(self._forget)
+        return future
+
+    def cancel(self, student, kinds=INTERACTIVE_KINDS):
+        """Cancel the student's in-flight calls of these kinds; returns how many."""
+        with self._calls_lock:
+            futures = [
+                f for f, tags in self._calls.items()
+                if tags.get("student") == student and (kinds is None or tags.get("kind") in kinds)
+            ]
+        return sum(1 for f in futures if f.cancel())
+
+    # ── internals ───────────────────────────────────────────
+
+    def _forget(self, future):
+        with self._calls_lock:
+            self._calls.pop(future, None)
+
+    async def _aacquire(self, tags, handle):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        # The quota check may touch the shared state database, so it runs
+        # off the loop; the wait for a slot itself costs no thread.
+        enqueued = asyncio.ensure_future(asyncio.to_thread(
+            self.scheduler.enqueue, tags.get("student"), tags.get("kind"),
+            lambda: loop.call_soon_threadsafe(_resolve, granted),
+        ))
+        try:
+            ticket = await asyncio.shield(enqueued)
+        except asyncio.CancelledError:
+            # The place in line is taken anyway; give it back once it is.
+            enqueued.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or self._withdraw(f.result())
+            )
+            raise
+        if handle is not None:
+            handle["ticket"] = ticket
+        budget = (handle or {}).get("budget")
+        if ticket.granted is None:
+            self.stats.incr("limiter_waits")
+            timeout = None if budget is None else max(budget.remaining(), 0)
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), timeout)
+            except asyncio.TimeoutError:
+                self._withdraw(ticket)
+                raise DeadlineExceeded("Заявката изчака твърде дълго на опашката.") from None
+            except asyncio.CancelledError:
+                self._withdraw(ticket)
+                raise
+        try:
+            await asyncio.shield(asyncio.to_thread(self.scheduler.record_request, ticket))
+        except asyncio.CancelledError:
+            self._withdraw(ticket)
+            raise
+        self.stats.incr("in_flight")
+        if budget is not None:
+            budget.started()
+        return ticket
+
+    def _withdraw(self, ticket):
+        if not self.scheduler.cancel(ticket):
+            self.scheduler.release(ticket)
+
+    async def _awith_retries(self, fn, attempts, handle, **kwargs):
+        budget = (handle or {}).get("budget")
+        attempt = 0
+        while True:
+            attempts[0] = attempt
+            self._fit_timeout(budget, kwargs)
+            self.stats.incr("requests")
+            try:
+                return await fn(**kwargs)
+            except Exception as e:
+                retry_after = self._retry_after(e)
+                delay = retry_after or self._backoff(attempt + 1)
+                if retry_after is None or attempt >= self.max_retries or not self._has_time(budget, delay):
+                    self.stats.incr("errors")
+                    raise
+                attempt += 1
+                self.stats.incr("retries")
+                await asyncio.sleep(delay)
+
+    def _report_position(self, handle):
+        # Queue position updates are shown from the waiting (script) thread.
+        callback = current_wait_callback()
+        ticket = handle.get("ticket")
+        if callback is not None and ticket is not None and ticket.granted is None:
+            callback(*self.scheduler.position(ticket))
+
+
+class _BridgedStream:
+    # Iterates, in the calling thread, over a stream consumed on the loop.
+    # Like the OpenAI client, creation returns once the response has started.
+
+    def __init__(self, gateway, tags, kwargs):
+        self._gateway = gateway
+        self._handle = {"budget": current_budget()}
+        self._chunks = queue.Queue()
+        self._future = gateway.submit(self._pump(tags, kwargs), tags)
+        self._head = self._next()
+
+    async def _pump(self, tags, kwargs):
+        try:
+            async for chunk in self._gateway.astream(tags=tags, handle=self._handle, **kwargs):
+                self._chunks.put(chunk)
+        except asyncio.CancelledError:
+            self._chunks.put(_Failure(concurrent.futures.CancelledError()))
+            raise
+        except Exception as e:
+            self._chunks.put(_Failure(e))
+        finally:
+            self._chunks.put(_END)
+
+    def _next(self):
+        while True:
+            try:
+                item = self._chunks.get(timeout=0.5)
+            except queue.Empty:
+                if self._future.cancelled():
+                    raise concurrent.futures.CancelledError()
+                self._gateway._report_position(self._handle)
+                continue
+            if isinstance(item, _Failure):
+                self.close()
+                raise item.error
+            return item
+
+    def __iter__(self):
+        try:
+            item = self._head
+            while item is not _END:
+                yield item
+                item = self._next()
+        finally:
+            self.close()
+
+    def close(self):
+        self._future.cancel()
+
+    def __del__(self):
+        self.close()
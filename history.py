@@ -0,0 +1,710 @@
+"""
+Consultation history persistence.
+
+Records are written through a pluggable backend chosen with the
+`HISTORY_BACKEND` secret:
+
+    sqlite  (default)  single-file database `history/history.db` in WAL mode,
+                       indexed by student, patient and timestamp
+    json               the original layout, one JSON file per consultation;
+                       files of past days are compacted into compressed
+                       segments under `history/archive/` (archive.py) and
+                       read from there transparently
+
+Existing `history/*.json` files can be imported into the database with
+
+    python history.py migrate
+
+and the maintenance job (run it daily, e.g. from cron)
+
+    python history.py maintain [--dry-run]
+
+compacts old files (JSON backend) or the database file (SQLite), and applies
+the retention policy: after `HISTORY_ANONYMIZE_DAYS` days the student's
+e-mail is replaced with a stable pseudonym, after `HISTORY_RETENTION_DAYS`
+days the record is deleted (0 = never, for both).
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from archive import SegmentArchive
+from config import DATA_DIR, get_secret
+from state import connect
+
+HISTORY_DIR = DATA_DIR / "history"
+
+
+def make_record(email, patient_name, messages, feedback="", turn_timings=None,
+                score=None, feedback_sections=None):
+    return {
+        "student_email": email,
+        "patient": patient_name,
+        "timestamp": datetime.now().isoformat(),
+        "messages": messages,
+        "feedback": feedback,
+        "feedback_sections": feedback_sections,
+        "score": score,
+        "turn_timings": turn_timings or [],
+    }
+
+
+# ─────────────────────────────────────────────────────────────
+# JSON FILES (original layout)
+# ─────────────────────────────────────────────────────────────
+
+class JsonHistoryStore:
+    def __init__(self, history_dir=HISTORY_DIR):
+        self.history_dir = Path(history_dir)
+        self.archive = SegmentArchive(self.history_dir / "archive")
+
+    def save(self, record):
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.history_dir / _file_name(record), "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+
+    def save_many(self, records):
+        for record in records:
+            self.save(record)
+
+    def _locations(self):
+        # source file name -> live path or archive index entry. A record
+        # found in both (compaction stopped between the two steps) is read
+        # from the archive.
+        locations = {path.name: path for path in self.history_dir.glob("*.json")}
+        for entry in self.archive.entries():
+            locations[entry["source"]] = entry
+        return locations
+
+    def _load(self, source, location):
+        try:
+            if isinstance(location, dict):
+                return self.archive.read(location)
+            with open(location, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        record.setdefault("source", source)
+        return record
+
+    def iter_records(self):
+        for source, location in sorted(self._locations().items()):
+            record = self._load(source, location)
+            if record is not None:
+                yield record
+
+    def iter_records_after(self, position=None):
+        # Records written after `position` (see `position`), oldest first.
+        # File names end in the save time, so no file older than the
+        # position has to be opened.
+        locations = self._locations()
+        for source in sorted(locations, key=_file_order):
+            if position is not None and _file_order(source) <= tuple(position):
+                continue
+            record = self._load(source, locations[source])
+            if record is not None:
+                yield record
+
+    def position(self, record):
+        return list(_file_order(record["source"]))
+
+    def query(self, student=None, patient=None, since=None, until=None, limit=None):
+        results = [
+            r for r in self.iter_records()
+            if _matches(r, student, patient, since, until)
+        ]
+        results.sort(key=lambda r: r.get("timestamp", ""), reverse=True)
+        return results[:limit] if limit else results
+
+    def count(self, student=None, patient=None, since=None, until=None):
+        return len(self.query(student, patient, since, until))
+
+    def iter_matching(self, student=None, patient=None, since=None, until=None):
+        # Like `query`, but one record at a time (file order) for exports.
+        # Archived records are filtered on their index entry before reading.
+        for source, location in sorted(self._locations().items()):
+            if isinstance(location, dict) and not _matches(location, student, patient, since, until):
+                continue
+            record = self._load(source, location)
+            if record is not None and _matches(record, student, patient, since, until):
+                yield record
+
+    # Re-grades (regrade.py) are kept inside the original file, under
+    # "regrades" -> prompt version.
+
+    def record_key(self, record):
+        return record["source"]
+
+    def save_regrade(self, record, version, result):
+        path = self.history_dir / record["source"]
+        if not path.exists():
+            # Archived: append the updated record; the newer index line wins.
+            location = self._locations()[record["source"]]
+            stored = self.archive.read(location)
+            stored.setdefault("regrades", {})[version] = result
+            self.archive.append(location["segment"], [stored])
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        stored.setdefault("regrades", {})[version] = result
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+    def regraded_keys(self, version):
+        return {r["source"] for r in self.iter_records() if version in r.get("regrades", {})}
+
+    def iter_regrades(self, version):
+        for record in self.iter_records():
+            result = record.get("regrades", {}).get(version)
+            if result is not None:
+                yield record, result
+
+
+def _file_name(record):
+    timestamp = datetime.fromisoformat(record["timestamp"]).strftime("%Y%m%d_%H%M%S")
+    safe_email = record["student_email"].replace("@", "_at_").replace(".", "_")
+    safe_patient = record["patient"].replace(" ", "_")
+    return f"{safe_email}_{safe_patient}_{timestamp}.json"
+
+
+def _file_order(name):
+    # "<email>_<patient>_YYYYmmdd_HHMMSS.json" -> ("YYYYmmdd_HHMMSS", name)
+    return name[-20:-5], name
+
+
+def _matches(record, student, patient, since, until):
+    ts = record.get("timestamp", "")
+    return (
+        (student is None or record.get("student_email") == student)
+        and (patient is None or record.get("patient") == patient)
+        and (since is None or ts >= since)
+        and (until is None or ts < until)
+    )
+
+
+# ─────────────────────────────────────────────────────────────
+# SQLITE (WAL, indexed)
+# ─────────────────────────────────────────────────────────────
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id            INTEGER PRIMARY KEY,
+    student_email TEXT NOT NULL,
+    patient       TEXT NOT NULL,
+    timestamp     TEXT NOT NULL,
+    source        TEXT UNIQUE,
+    score         INTEGER,
+    record        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_student ON sessions (student_email, timestamp);
+CREATE INDEX IF NOT EXISTS idx_sessions_patient ON sessions (patient, timestamp);
+CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions (timestamp);
+CREATE TABLE IF NOT EXISTS regrades (
+    session_id     INTEGER NOT NULL REFERENCES sessions (id),
+    prompt_version TEXT NOT NULL,
+    timestamp      TEXT NOT NULL,
+    score          INTEGER,
+    result         TEXT NOT NULL,
+    PRIMARY KEY (session_id, prompt_version)
+);
+CREATE TABLE IF NOT EXISTS migrated (
+    source_key TEXT PRIMARY KEY
+);
+"""
+
+
+class SqliteHistoryStore:
+    def __init__(self, db_path=HISTORY_DIR / "history.db"):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+            if "score" not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN score INTEGER")
+
+    def _connect(self):
+        # One connection per thread; the locking mode comes from state.py.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    def save(self, record):
+        self.save_many([record])
+
+    def save_many(self, records):
+        rows = [
+            (
+                r["student_email"],
+                r["patient"],
+                r["timestamp"],
+                r.get("source"),
+                r.get("score"),
+                json.dumps(r, ensure_ascii=False, separators=(",", ":")),
+            )
+            for r in records
+        ]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO sessions "
+                "(student_email, patient, timestamp, source, score, record) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    @contextmanager
+    def batch(self, size=500):
+        # Collects records and writes them in transactions of `size`.
+        pending = []
+
+        def add(record):
+            pending.append(record)
+            if len(pending) >= size:
+                self.save_many(pending)
+                pending.clear()
+
+        try:
+            yield add
+        finally:
+            if pending:
+                self.save_many(pending)
+
+    def _where(self, student, patient, since, until):
+        clauses, params = [], []
+        if student is not None:
+            clauses.append("student_email = ?")
+            params.append(student)
+        if patient is not None:
+            clauses.append("patient = ?")
+            params.append(patient)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def iter_records(self):
+        cursor = self._connect().execute("SELECT id, record FROM sessions ORDER BY id")
+        for row_id, raw in cursor:
+            record = json.loads(raw)
+            record["id"] = row_id
+            yield record
+
+    def iter_records_after(self, position=None):
+        cursor = self._connect().execute(
+            "SELECT id, record FROM sessions WHERE id > ? ORDER BY id", (position or 0,)
+        )
+        for row_id, raw in cursor:
+            record = json.loads(raw)
+            record["id"] = row_id
+            yield record
+
+    def position(self, record):
+        return record["id"]
+
+    def query(self, student=None, patient=None, since=None, until=None, limit=None):
+        where, params = self._where(student, patient, since, until)
+        sql = f"SELECT id, record FROM sessions{where} ORDER BY timestamp DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        results = []
+        for row_id, raw in self._connect().execute(sql, params):
+            record = json.loads(raw)
+            record["id"] = row_id
+            results.append(record)
+        return results
+
+    def count(self, student=None, patient=None, since=None, until=None):
+        where, params = self._where(student, patient, since, until)
+        return self._connect().execute(f"SELECT COUNT(*) FROM sessions{where}", params).fetchone()[0]
+
+    def iter_matching(self, student=None, patient=None, since=None, until=None):
+        # Like `query`, but streamed from the cursor, oldest first, for exports.
+        where, params = self._where(student, patient, since, until)
+        cursor = self._connect().execute(f"SELECT id, record FROM sessions{where} ORDER BY timestamp", params)
+        for row_id, raw in cursor:
+            record = json.loads(raw)
+            record["id"] = row_id
+            yield record
+
+    # Re-grades (regrade.py) go to their own table, keyed by session and
+    # prompt version, so the original record is never rewritten.
+
+    def record_key(self, record):
+        return record["id"]
+
+    def save_regrade(self, record, version, result):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO regrades (session_id, prompt_version, timestamp, score, result) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    record["id"], version, datetime.now().isoformat(), result.get("score"),
+                    json.dumps(result, ensure_ascii=False, separators=(",", ":")),
+                ),
+            )
+
+    def regraded_keys(self, version):
+        return {
+            row[0] for row in self._connect().execute(
+                "SELECT session_id FROM regrades WHERE prompt_version = ?", (version,)
+            )
+        }
+
+    def migrated_keys(self):
+        # Keys (see `migration_key`) of the history/*.json files imported so far.
+        return {row[0] for row in self._connect().execute("SELECT source_key FROM migrated")}
+
+    def mark_migrated(self, keys):
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO migrated (source_key) VALUES (?)", [(k,) for k in keys])
+
+    def iter_regrades(self, version):
+        cursor = self._connect().execute(
+            "SELECT s.id, s.record, r.result FROM regrades r JOIN sessions s ON s.id = r.session_id "
+            "WHERE r.prompt_version = ? ORDER BY s.id",
+            (version,),
+        )
+        for row_id, raw, result in cursor:
+            record = json.loads(raw)
+            record["id"] = row_id
+            yield record, json.loads(result)
+
+
+def migration_key(source):
+    # File names carry the student's e-mail, and maintenance pseudonymises
+    # or deletes the rows, so imports are remembered by a keyed hash.
+    return hmac.new(_anon_salt().encode(), source.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def migrate_json_history(store, history_dir=HISTORY_DIR):
+    # Safe to rerun, also after `maintain`: files imported before are skipped.
+    before = store.count()
+    done = store.migrated_keys()
+    # Rows anonymised before imports were remembered only have the renamed source.
+    renamed = {
+        row[0] for row in store._connect().execute(
+            "SELECT source FROM sessions WHERE source IS NOT NULL AND student_email LIKE ?",
+            (ANONYMOUS_PREFIX + "%",),
+        )
+    }
+    imported = []
+    with store.batch() as add:
+        for record in JsonHistoryStore(history_dir).iter_records():
+            if not {"student_email", "patient", "timestamp"} <= record.keys():
+                continue
+            key = migration_key(record["source"])
+            if key in done:
+                continue
+            if renamed and _file_name(dict(record, student_email=pseudonym(record["student_email"]))) in renamed:
+                imported.append(key)
+                continue
+            add(record)
+            imported.append(key)
+    store.mark_migrated(imported)
+    return store.count() - before
+
+
+# ─────────────────────────────────────────────────────────────
+# MAINTENANCE (compaction and retention)
+# ─────────────────────────────────────────────────────────────
+
+ANONYMOUS_PREFIX = "anon-"
+
+
+def _anon_salt():
+    # Pseudonyms are keyed, so they cannot be reversed by hashing a list of
+    # student e-mails; the key is generated once per installation.
+    salt = get_secret("HISTORY_ANON_SALT", "")
+    if salt:
+        return salt
+    path = HISTORY_DIR / ".anon_salt"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(path, "x", encoding="utf-8") as f:
+            f.write(secrets.token_hex(16))
+    except FileExistsError:
+        pass
+    return path.read_text(encoding="utf-8").strip()
+
+
+def pseudonym(email):
+    if not email or email.startswith(ANONYMOUS_PREFIX):
+        return email
+    digest = hmac.new(_anon_salt().encode(), email.strip().lower().encode(), hashlib.sha256)
+    return ANONYMOUS_PREFIX + digest.hexdigest()[:12]
+
+
+def retention_policy():
+    return {
+        "compact_after_days": int(get_secret("HISTORY_COMPACT_AFTER_DAYS", 1)),
+        "segment": get_secret("HISTORY_SEGMENT", "day"),
+        "anonymize_days": int(get_secret("HISTORY_ANONYMIZE_DAYS", 0)),
+        "retention_days": int(get_secret("HISTORY_RETENTION_DAYS", 0)),
+    }
+
+
+def _policy(anonymize_days, retention_days):
+    # record -> record (possibly pseudonymised) or None (delete)
+    now = datetime.now()
+    delete_before = (now - timedelta(days=retention_days)).isoformat() if retention_days else None
+    anonymize_before = (now - timedelta(days=anonymize_days)).isoformat() if anonymize_days else None
+
+    def apply(record):
+        ts = record.get("timestamp", "")
+        if not ts:
+            return record
+        if delete_before and ts < delete_before:
+            return None
+        if anonymize_before and ts < anonymize_before:
+            record["student_email"] = pseudonym(record.get("student_email", ""))
+            if "source" in record:
+                # The file name carried the e-mail too.
+                record["source"] = _file_name(record)
+        return record
+
+    return apply, delete_before, anonymize_before
+
+
+def maintain(store, compact_after_days=1, segment="day", anonymize_days=0, retention_days=0, dry_run=False):
+    """Compact old history and apply the retention policy; returns counts."""
+    if isinstance(store, JsonHistoryStore):
+        return _maintain_json(store, compact_after_days, segment, anonymize_days, retention_days, dry_run)
+    return _maintain_sqlite(store, anonymize_days, retention_days, dry_run)
+
+
+def _maintain_json(store, compact_after_days, segment, anonymize_days, retention_days, dry_run):
+    apply, delete_before, anonymize_before = _policy(anonymize_days, retention_days)
+    compact_before = (datetime.now() - timedelta(days=compact_after_days)).date().isoformat()
+    key_length = 7 if segment == "month" else 10  # "2025-03" or "2025-03-04"
+    report = {"compacted": 0, "anonymized": 0, "deleted": 0, "segments_rewritten": 0}
+
+    # 1. Live files: apply the policy, then move past days into segments.
+    #    Files are taken in time order, so one segment is filled at a time.
+    pending, pending_key = [], None
+
+    def flush():
+        if pending and not dry_run:
+            store.archive.append(pending_key, [record for record, _ in pending])
+            for _, path in pending:
+                path.unlink(missing_ok=True)
+        report["compacted"] += len(pending)
+        pending.clear()
+
+    for path in sorted(store.history_dir.glob("*.json"), key=lambda p: _file_order(p.name)):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        record.setdefault("source", path.name)
+        ts = record.get("timestamp", "")
+        record = apply(record)
+        if record is None:
+            report["deleted"] += 1
+            if not dry_run:
+                path.unlink(missing_ok=True)
+            continue
+        renamed = record["source"] != path.name
+        report["anonymized"] += renamed
+        if ts and ts[:10] < compact_before:
+            if ts[:key_length] != pending_key:
+                flush()
+                pending_key = ts[:key_length]
+            pending.append((record, path))
+        elif renamed and not dry_run:
+            store.save(record)
+            path.unlink(missing_ok=True)
+    flush()
+
+    # 2. Segments with records the policy now changes are rewritten whole.
+    for name in store.archive.segments():
+        entries = list(store.archive.index(name).values())
+        expired = [e for e in entries if delete_before and e["timestamp"] < delete_before]
+        unnamed = [
+            e for e in entries
+            if anonymize_before and e["timestamp"] < anonymize_before and e not in expired
+            and not e["student_email"].startswith(ANONYMOUS_PREFIX)
+        ]
+        if not expired and not unnamed:
+            continue
+        report["segments_rewritten"] += 1
+        if dry_run:
+            report["deleted"] += len(expired)
+            report["anonymized"] += len(unnamed)
+            continue
+        _, changed, dropped = store.archive.rewrite(name, apply)
+        report["anonymized"] += changed
+        report["deleted"] += dropped
+    return report
+
+
+def _maintain_sqlite(store, anonymize_days, retention_days, dry_run):
+    _, delete_before, anonymize_before = _policy(anonymize_days, retention_days)
+    report = {"anonymized": 0, "deleted": 0, "bytes_before": store.db_path.stat().st_size, "bytes_after": None}
+    conn = store._connect()
+    if delete_before:
+        report["deleted"] = conn.execute(
+            "SELECT COUNT(*) FROM sessions WHERE timestamp < ?", (delete_before,)
+        ).fetchone()[0]
+        if not dry_run:
+            with conn:
+                conn.execute(
+                    "DELETE FROM regrades WHERE session_id IN (SELECT id FROM sessions WHERE timestamp < ?)",
+                    (delete_before,),
+                )
+                conn.execute("DELETE FROM sessions WHERE timestamp < ?", (delete_before,))
+    if anonymize_before:
+        rows = conn.execute(
+            "SELECT id, source, record FROM sessions WHERE timestamp < ? AND student_email NOT LIKE ?",
+            (anonymize_before, ANONYMOUS_PREFIX + "%"),
+        ).fetchall()
+        report["anonymized"] = len(rows)
+        if not dry_run:
+            updates = []
+            for row_id, source, raw in rows:
+                record = json.loads(raw)
+                record["student_email"] = pseudonym(record["student_email"])
+                updates.append((
+                    record["student_email"],
+                    _file_name(record) if source else None,  # migrated file names carry the e-mail
+                    json.dumps(record, ensure_ascii=False, separators=(",", ":")),
+                    row_id,
+                ))
+            with conn:
+                conn.executemany(
+                    "UPDATE sessions SET student_email = ?, source = ?, record = ? WHERE id = ?", updates
+                )
+    if not dry_run:
+        # Give the space of deleted rows back to the file system.
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        report["bytes_after"] = store.db_path.stat().st_size
+    return report
+
+
+# ─────────────────────────────────────────────────────────────
+# PUBLIC API
+# ─────────────────────────────────────────────────────────────
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_history_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = get_secret("HISTORY_BACKEND", "sqlite").lower()
+            if backend == "json":
+                _store = JsonHistoryStore()
+            else:
+                _store = SqliteHistoryStore()
+        return _store
+
+
+def save_conversation(email, patient_name, messages, feedback="", turn_timings=None,
+                      score=None, feedback_sections=None):
+    get_history_store().save(make_record(
+        email, patient_name, messages, feedback, turn_timings, score, feedback_sections
+    ))
+
+
+def check_migrate_after_maintain():
+    """Migrate, maintain, migrate again on scratch copies; returns (ok, report)."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix="history_check_") as tmp:
+        files = JsonHistoryStore(Path(tmp) / "json")
+        now = datetime.now()
+        for i, age in enumerate((2, 100, 100, 400)):
+            record = make_record(f"check{i}@example.bg", "check", [{"role": "user", "content": str(i)}])
+            record["timestamp"] = (now - timedelta(days=age, seconds=i)).isoformat()
+            files.save(record)
+        store = SqliteHistoryStore(Path(tmp) / "history.db")
+        first = migrate_json_history(store, files.history_dir)
+        maintained = maintain(store, anonymize_days=30, retention_days=365)
+        second = migrate_json_history(store, files.history_dir)
+        emails = sorted(r["student_email"] for r in store.iter_records())
+    report = {
+        "imported": (first, 4),
+        "anonymized": (maintained["anonymized"], 2),
+        "deleted": (maintained["deleted"], 1),
+        "reimported": (second, 0),
+        "named_records": (sum(not e.startswith(ANONYMOUS_PREFIX) for e in emails), 1),
+    }
+    return all(got == expected for got, expected in report.values()), report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consultation history tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    migrate = sub.add_parser("migrate", help="import history/*.json into history.db")
+    migrate.add_argument("--dir", default=str(HISTORY_DIR))
+
+    query = sub.add_parser("query", help="list stored consultations")
+    query.add_argument("--student")
+    query.add_argument("--patient")
+    query.add_argument("--since", help="ISO date, e.g. 2025-03-01")
+    query.add_argument("--until")
+    query.add_argument("--limit", type=int, default=50)
+
+    policy = retention_policy()
+    maint = sub.add_parser("maintain", help="compact old history and apply the retention policy")
+    maint.add_argument("--compact-after-days", type=int, default=policy["compact_after_days"])
+    maint.add_argument("--segment", choices=["day", "month"], default=policy["segment"])
+    maint.add_argument("--anonymize-days", type=int, default=policy["anonymize_days"],
+                       help="pseudonymise students in records older than this (0 = never)")
+    maint.add_argument("--retention-days", type=int, default=policy["retention_days"],
+                       help="delete records older than this (0 = keep forever)")
+    maint.add_argument("--dry-run", action="store_true", help="only count what would change")
+
+    sub.add_parser("check", help="verify that migrate after maintain re-imports nothing")
+
+    args = parser.parse_args()
+    if args.command == "check":
+        ok, report = check_migrate_after_maintain()
+        for key, (got, expected) in report.items():
+            print(f"{key}: {got} (expected {expected})")
+        print("OK" if ok else "FAILED")
+        raise SystemExit(0 if ok else 1)
+    if args.command == "migrate":
+        count = migrate_json_history(SqliteHistoryStore(), args.dir)
+        print(f"Imported {count} records.")
+    elif args.command == "maintain":
+        report = maintain(
+            get_history_store(), args.compact_after_days, args.segment,
+            args.anonymize_days, args.retention_days, args.dry_run,
+        )
+        for key, value in report.items():
+            print(f"{key}: {value}")
+        if not args.dry_run and (report["anonymized"] or report["deleted"]):
+            # The class statistics still hold the old names and records.
+            from analytics import get_class_analytics
+
+            stats = get_class_analytics()
+            stats.reset()
+            stats.refresh(force=True)
+    else:
+        for r in get_history_store().query(args.student, args.patient, args.since, args.until, args.limit):
+            print(f"{r['timestamp']}  {r['student_email']}  {r['patient']}  ({len(r['messages'])} съобщения)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Instructor-only pages, shown instead of the consultation when an address from
+`INSTRUCTOR_EMAILS` picks another view in the sidebar.
+"""
+
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+import export
+import metrics
+
+PERIODS = {
+    "Последните 24 часа": 24 * 3600,
+    "Последните 7 дни": 7 * 24 * 3600,
+    "Последните 30 дни": 30 * 24 * 3600,
+    "Всички": None,
+}
+
+
+def render_metrics(client_stats=None, cache_stats=None, scheduler_stats=None, router_stats=None,
+                   reply_cache_stats=None):
+    st.markdown("## Разходи и латентност на AI заявките")
+    st.divider()
+
+    if client_stats:
+        st.caption(
+            "В момента: {in_flight} активни заявки · {requests} изпратени · "
+            "{retries} повторни опита · {throttles} ограничения (429) · "
+            "{limiter_waits} изчаквания в опашката".format(**client_stats)
+        )
+    if scheduler_stats:
+        st.caption(
+            "Опашка: {running}/{capacity} заети слота · чакащи {waiting_interactive} реплики "
+            "и {waiting_batch} оценки · средно {avg_service_time} с на заявка".format(**scheduler_stats)
+        )
+    if cache_stats:
+        st.caption(
+            "Кеш на оценките: {hit_rate:.0%} попадения "
+            "({memory_hits} от паметта, {disk_hits} от диска, {misses} пропуска, "
+            "{evictions} изхвърлени)".format(**cache_stats)
+        )
+    if reply_cache_stats:
+        st.caption(
+            "Кеш на началните реплики: {hit_rate:.0%} попадения ({hits} от {lookups}) · "
+            "спестени {saved_tokens} токена (${saved_cost:.2f}) · {ready} от {entries} "
+            "начала с достатъчно варианти".format(
+                lookups=reply_cache_stats["hits"] + reply_cache_stats["misses"], **reply_cache_stats
+            )
+        )
+
+    if router_stats and router_stats["models"]:
+        hedges = ", ".join(f"{role}: {count}" for role, count in router_stats["hedges"].items())
+        with st.expander(f"Модели от стартирането на сървъра (резервни заявки — {hedges})"):
+            st.dataframe(router_stats["models"], use_container_width=True)
+
+    period = st.selectbox("Период", list(PERIODS))
+    window = PERIODS[period]
+    entries = list(metrics.iter_metrics(since=time.time() - window if window else None))
+    if not entries:
+        st.info("Все още няма записани заявки за този период.")
+        return
+
+    latencies = sorted(e["wall_time"] for e in entries)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Заявки", len(entries))
+    col2.metric("Разход", f"${sum(e['cost'] for e in entries):.2f}")
+    col3.metric("p50", f"{metrics.percentile(latencies, 50):.1f} с")
+    col4.metric("p95", f"{metrics.percentile(latencies, 95):.1f} с")
+
+    tab_case, tab_student, tab_kind, tab_model = st.tabs([
+        "По казус", "По студент", "По вид заявка", "По модел"
+    ])
+    with tab_case:
+        st.dataframe(metrics.summarize(entries, "patient"), use_container_width=True)
+    with tab_student:
+        st.dataframe(metrics.summarize(entries, "student"), use_container_width=True)
+    with tab_kind:
+        st.dataframe(metrics.summarize(entries, "kind"), use_container_width=True)
+    with tab_model:
+        st.dataframe(metrics.summarize(entries, "model"), use_container_width=True)
+
+    st.caption(f"Източник: {metrics.METRICS_FILE.name} (с ротация). Цените са ориентировъчни.")
+
+
+def render_analytics(analytics):
+    st.markdown("## Резултати на курса")
+    st.divider()
+
+    if st.button("Обнови"):
+        analytics.refresh(force=True)
+    else:
+        analytics.refresh()
+    data = analytics.snapshot()
+    total = data["total"]
+    if not total["attempts"]:
+        st.info("Все още няма завършени консултации.")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Консултации", total["attempts"])
+    col2.metric("Студенти", len(data["students"]))
+    col3.metric("Средна оценка", f"{total['score_sum'] / total['scored']:.2f}" if total["scored"] else "—")
+    col4.metric("Средно реплики", f"{total['turns'] / total['attempts']:.1f}")
+
+    col_scores, col_trend = st.columns(2)
+    with col_scores:
+        st.markdown("**Разпределение на оценките**")
+        scores = sorted(total["scores"])
+        st.bar_chart({"оценка": scores, "брой": [total["scores"][s] for s in scores]}, x="оценка", y="брой")
+    with col_trend:
+        st.markdown("**По седмици**")
+        weeks = analytics.rows("weeks", "седмица")
+        st.line_chart(
+            {
+                "седмица": [w["седмица"] for w in weeks],
+                "опити": [w["опити"] for w in weeks],
+                "средна оценка": [w["средна оценка"] for w in weeks],
+            },
+            x="седмица",
+        )
+
+    tab_student, tab_case, tab_week = st.tabs(["По студент", "По казус", "По седмица"])
+    with tab_student:
+        st.dataframe(analytics.rows("students", "студент"), use_container_width=True)
+    with tab_case:
+        st.dataframe(analytics.rows("cases", "казус"), use_container_width=True)
+    with tab_week:
+        st.dataframe(weeks, use_container_width=True)
+
+    st.caption(f"Последно обновяване: {data['updated_at']}. Обработват се само новите записи от историята.")
+
+    render_export(sorted(data["students"]), sorted(data["cases"]))
+
+
+EXPORT_FORMATS = {
+    "Пълни записи (JSONL.gz)": ("jsonl", True, "application/gzip", "jsonl.gz"),
+    "Консултации (CSV)": ("sessions", False, "text/csv", "csv"),
+    "Реплики (CSV)": ("turns", False, "text/csv", "csv"),
+}
+
+
+def render_export(students, cases):
+    with st.expander("Експорт на историята"):
+        col1, col2 = st.columns(2)
+        student = col1.selectbox("Студент", ["Всички"] + students)
+        case = col2.selectbox("Казус", ["Всички"] + cases)
+        col3, col4 = st.columns(2)
+        since = col3.date_input("От", value=None)
+        until = col4.date_input("До (включително)", value=None)
+        label = st.radio("Формат", list(EXPORT_FORMATS), horizontal=True)
+
+        if st.button("Подготви файла"):
+            fmt, compress, mime, extension = EXPORT_FORMATS[label]
+            # Records are streamed to a temporary file; only the finished
+            # (compressed) file is handed to the browser.
+            with tempfile.TemporaryFile() as out:
+                count = export.export(
+                    fmt, out,
+                    student=None if student == "Всички" else student,
+                    patient=None if case == "Всички" else case,
+                    since=since.isoformat() if since else None,
+                    until=(until + timedelta(days=1)).isoformat() if until else None,
+                    compress=compress,
+                )
+                out.seek(0)
+                st.download_button(
+                    f"Изтегли ({count} консултации)", out,
+                    file_name=f"pharmabot-{fmt}-{datetime.now():%Y%m%d}.{extension}", mime=mime,
+                )
+
+
+def render_traces(tracer):
+    st.markdown("## Профилиране на презарежданията")
+    st.divider()
+
+    reruns = tracer.reruns()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Записани презареждания", len(reruns))
+    if col2.button("Запиши в logs/traces.jsonl"):
+        st.toast(f"Записани: {tracer.flush()}")
+    if col3.button("Профилирай следващото"):
+        # Captured with cProfile on this session's next rerun.
+        st.session_state.trace_profile = True
+        st.toast("Следващото презареждане ще бъде профилирано.")
+    if not reruns:
+        st.info("Все още няма записани презареждания.")
+        return
+
+    st.markdown("**Най-бавни презареждания**")
+    slowest = tracer.slowest()
+    st.dataframe(
+        [
+            {
+                "време": time.strftime("%H:%M:%S", time.localtime(r["ts"])),
+                "студент": r["student"],
+                "вид": r["kind"],
+                "изглед": r.get("view", ""),
+                "общо (ms)": round(r["total"] * 1000, 1),
+                "най-бавен етап": max(r["spans"], key=lambda s: s[1])[0] if r["spans"] else "",
+            }
+            for r in slowest
+        ],
+        use_container_width=True,
+    )
+
+    tab_stages, tab_students, tab_profile = st.tabs(["По етапи", "По студент", "cProfile"])
+    with tab_stages:
+        rows = tracer.stage_rows()
+        st.dataframe(rows, use_container_width=True)
+        stage = st.selectbox("Хистограма за етап", [r["етап"] for r in rows])
+        if stage:
+            counts = tracer.histogram(stage)
+            st.bar_chart({"интервал": list(counts), "брой": list(counts.values())}, x="интервал", y="брой")
+    with tab_students:
+        st.dataframe(tracer.student_rows(), use_container_width=True)
+    with tab_profile:
+        profiled = [r for r in reruns if r.get("profile")]
+        if not profiled:
+            st.caption("Натиснете „Профилирай следващото“ и презаредете страницата.")
+        for r in reversed(profiled[-3:]):
+            st.caption(f"{time.strftime('%H:%M:%S', time.localtime(r['ts']))} · {r['kind']} · "
+                       f"{r['total'] * 1000:.0f} ms")
+            st.code(r["profile"])
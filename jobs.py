@@ -0,0 +1,366 @@
+"""
+Background feedback generation.
+
+Grading a consultation is the slowest model call in the app, so it runs on a
+bounded, process-wide worker pool instead of the Streamlit script thread.
+With the async gateway (`MODEL_GATEWAY = "async"`) a job is a coroutine on
+the gateway's event loop instead and holds no thread while it is graded;
+only its file and database writes borrow one briefly.
+Each job is mirrored to `history/.jobs/<id>.json`, which lets a student who
+reloads the page pick the result (or the still-running job) up again. Job
+ids start with a hash of the student and case, so finding a student's jobs
+reads only their files; files older than `SESSION_TTL_HOURS` are deleted, and
+finished jobs are dropped from memory. The process running a job holds a
+lease on it in the shared state backend, so when several app processes share
+the data only one of them grades it.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config import get_secret
+from feedback import (
+    agenerate_feedback,
+    agenerate_structured_feedback,
+    generate_feedback,
+    generate_structured_feedback,
+    parse_feedback,
+    structured_feedback_enabled,
+)
+from history import HISTORY_DIR, save_conversation
+from feedback_cache import feedback_cache_key, get_feedback_cache
+from gateway import AsyncModelGateway
+from metrics import call_context
+from router import route
+from sessions import get_session_store
+from state import get_state_backend, replica_id
+
+JOBS_DIR = HISTORY_DIR / ".jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+PRUNE_INTERVAL = 600
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def job_prefix(email, patient_name):
+    return hashlib.sha1(f"{email}\0{patient_name}".encode("utf-8")).hexdigest()[:16]
+
+
+class FeedbackJobs:
+    def __init__(self, max_workers=8, max_pending=64, jobs_dir=JOBS_DIR, ttl_hours=48):
+        self.max_pending = max_pending
+        self.jobs_dir = jobs_dir
+        self.ttl = ttl_hours * 3600
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="feedback"
+        )
+        self._lock = threading.Lock()
+        self._jobs = {}  # queued and running jobs only; finished ones are read from their file
+        self._discarded = set()
+        self._pending = 0
+        self._last_prune = 0.0
+
+    # ── public API ──────────────────────────────────────────
+
+    def submit(self, client, email, patient_data, messages, turn_timings=None):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFull("Твърде много чакащи оценки. Опитайте отново след малко.")
+            self._pending += 1
+
+        self.prune()
+        job = {
+            "id": f"{job_prefix(email, patient_data['name'])}-{uuid.uuid4().hex}",
+            "status": QUEUED,
+            "email": email,
+            "patient": patient_data["name"],
+            "patient_data": patient_data,
+            "messages": list(messages),
+            "turn_timings": list(turn_timings or []),
+            "submitted_at": datetime.now().isoformat(),
+            "finished_at": None,
+            "feedback": "",
+            "sections": None,
+            "score": None,
+            "progress": None,
+            "error": "",
+        }
+        try:
+            self._store(job)
+            self._claim(job["id"])
+            self._start(client, job["id"])
+        except Exception:
+            self._abandon(job["id"])
+            self._remove(job["id"])
+            raise
+        return job["id"]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self._read(job_id)
+        return job
+
+    def latest_for(self, email, patient_name):
+        # Most recent job of a student for a case, used to resume after a reload.
+        candidates = []
+        if self.jobs_dir.exists():
+            for path in self.jobs_dir.glob(f"{job_prefix(email, patient_name)}-*.json"):
+                job = self.get(path.stem)
+                if job and job["email"] == email and job["patient"] == patient_name:
+                    candidates.append(job)
+        if not candidates:
+            return None
+        return max(candidates, key=lambda j: j["submitted_at"])
+
+    def resume(self, client, job_id):
+        # A job that was queued or running when the server stopped is rerun
+        # from the transcript stored in its file.
+        job = self.get(job_id)
+        if job is None or job["status"] in (DONE, FAILED):
+            return job
+        with self._lock:
+            if job_id in self._jobs:
+                return job
+        if not self._claim(job_id):
+            return job  # another app process is grading it
+        with self._lock:
+            self._pending += 1
+        try:
+            job["status"] = QUEUED
+            self._store(job)
+            self._start(client, job_id)
+        except Exception:
+            self._abandon(job_id)
+            raise
+        return job
+
+    def discard(self, job_id):
+        with self._lock:
+            if self._jobs.pop(job_id, None) is not None:
+                # Still being graded: the worker must not write the file back.
+                self._discarded.add(job_id)
+        self._remove(job_id)
+
+    def prune(self, force=False):
+        """Delete job files not written for the TTL; returns how many."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_prune < PRUNE_INTERVAL:
+                return 0
+            self._last_prune = now
+            active = set(self._jobs)
+        removed = 0
+        if self.jobs_dir.exists():
+            for path in self.jobs_dir.glob("*.json"):
+                try:
+                    if path.stem not in active and now - path.stat().st_mtime > self.ttl:
+                        path.unlink()
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def stats(self):
+        with self._lock:
+            by_status = {}
+            for job in self._jobs.values():
+                by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+            return {"pending": self._pending, **by_status}
+
+    # ── worker ──────────────────────────────────────────────
+
+    def _start(self, client, job_id):
+        if isinstance(client, AsyncModelGateway):
+            client.submit(self._arun(client, job_id))
+        else:
+            self._executor.submit(self._run, client, job_id)
+
+    def _run(self, client, job_id):
+        job = self.get(job_id)
+        try:
+            self._update(job, status=RUNNING)
+            self._finish(job, self._grade(client, job))
+        except Exception as e:
+            self._update(job, status=FAILED, error=str(e))
+        finally:
+            self._release(job_id)
+
+    async def _arun(self, gateway, job_id):
+        # `_run` on the gateway loop; blocking writes go to a thread.
+        job = await asyncio.to_thread(self.get, job_id)
+        try:
+            await asyncio.to_thread(self._update, job, status=RUNNING)
+            result = await self._agrade(gateway, job)
+            await asyncio.to_thread(self._finish, job, result)
+        except Exception as e:
+            await asyncio.to_thread(self._update, job, status=FAILED, error=str(e))
+        finally:
+            await asyncio.to_thread(self._release, job_id)
+
+    def _finish(self, job, result):
+        with self._lock:
+            if job["id"] in self._discarded:
+                return  # the student threw the consultation away meanwhile
+        save_conversation(
+            job["email"],
+            job["patient"],
+            job["messages"],
+            result["text"],
+            job["turn_timings"],
+            score=result["score"],
+            feedback_sections=result["sections"],
+        )
+        self._update(
+            job, status=DONE, feedback=result["text"],
+            sections=result["sections"], score=result["score"], progress=None,
+        )
+        # The consultation is complete; it no longer needs resuming.
+        get_session_store().clear(job["email"], job["patient"])
+
+    def _release(self, job_id):
+        get_state_backend().release("jobs", job_id, replica_id())
+        self._abandon(job_id)
+
+    def _abandon(self, job_id):
+        # The job no longer occupies a place in the queue.
+        with self._lock:
+            self._pending -= 1
+            self._jobs.pop(job_id, None)
+            self._discarded.discard(job_id)
+
+    # ── storage ─────────────────────────────────────────────
+
+    def _cache_key(self, job):
+        # Identical transcript + case + prompt + model is graded only once.
+        return feedback_cache_key(
+            job["messages"], job["patient_data"],
+            route("grading")["model"], structured_feedback_enabled(),
+        )
+
+    def _grade(self, client, job):
+        structured = structured_feedback_enabled()
+        cache = get_feedback_cache()
+        key = self._cache_key(job)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+        with call_context(kind="feedback", student=job["email"], patient=job["patient"]):
+            if structured:
+                result = generate_structured_feedback(
+                    client, job["messages"], job["patient_data"],
+                    on_progress=lambda snapshot: self._progress(job, snapshot),
+                )
+            else:
+                result = parse_feedback(
+                    generate_feedback(client, job["messages"], job["patient_data"])
+                )
+        cache.put(key, result)
+        return result
+
+    async def _agrade(self, gateway, job):
+        structured = structured_feedback_enabled()
+        cache = get_feedback_cache()
+        key = self._cache_key(job)
+        result = await asyncio.to_thread(cache.get, key)
+        if result is not None:
+            return result
+
+        async def progress(snapshot):
+            await asyncio.to_thread(self._progress, job, snapshot)
+
+        with call_context(kind="feedback", student=job["email"], patient=job["patient"]):
+            if structured:
+                result = await agenerate_structured_feedback(
+                    gateway, job["messages"], job["patient_data"], on_progress=progress,
+                )
+            else:
+                result = parse_feedback(
+                    await agenerate_feedback(gateway, job["messages"], job["patient_data"])
+                )
+        await asyncio.to_thread(cache.put, key, result)
+        return result
+
+    def _progress(self, job, snapshot):
+        # Partial text lives in memory only; the file is rewritten when a
+        # whole section has completed.
+        completed = len((job.get("progress") or {}).get("sections", {}))
+        job["progress"] = snapshot
+        if len(snapshot["sections"]) != completed:
+            self._store(job)
+            self._claim(job["id"])  # still alive: renew the lease
+
+    def _claim(self, job_id):
+        # Long enough for a grading call and its retries; a lease left by a
+        # process that died expires and the job can be resumed elsewhere.
+        lease = 2 * route("grading")["timeout"] + 60
+        return get_state_backend().claim("jobs", job_id, replica_id(), lease)
+
+    def _update(self, job, **changes):
+        job.update(changes)
+        if job["status"] in (DONE, FAILED):
+            job["finished_at"] = datetime.now().isoformat()
+        self._store(job)
+
+    def _store(self, job):
+        with self._lock:
+            if job["id"] in self._discarded:
+                return
+            self._jobs[job["id"]] = job
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        path = self.jobs_dir / f"{job['id']}.json"
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        with self._lock:
+            discarded = job["id"] in self._discarded
+        if discarded:
+            # discard() ran while the file was being written.
+            self._remove(job["id"])
+
+    def _remove(self, job_id):
+        try:
+            os.remove(self.jobs_dir / f"{job_id}.json")
+        except FileNotFoundError:
+            pass
+
+    def _read(self, job_id):
+        try:
+            with open(self.jobs_dir / f"{job_id}.json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+def get_feedback_jobs():
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = FeedbackJobs(
+                max_workers=int(get_secret("FEEDBACK_WORKERS", 8)),
+                max_pending=int(get_secret("FEEDBACK_MAX_PENDING", 64)),
+                ttl_hours=float(get_secret("SESSION_TTL_HOURS", 48)),
+            )
+        return _jobs
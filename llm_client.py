@@ -0,0 +1,266 @@
+"""
+Shared OpenAI client for the whole server process.
+
+Streamlit reruns the script on every interaction, so building a new `OpenAI`
+object per rerun throws away its connection pool. Instead one client per API
+key is kept for the lifetime of the process. It is wrapped so that every
+request takes a slot from the fair scheduler (scheduler.py), which bounds
+concurrency and applies per-student quotas, and is retried with jittered
+exponential backoff on 429 / 5xx / connection errors. Each call is reported
+to metrics.py once it completes (for streams: once the stream is drained).
+"""
+
+import random
+import threading
+import time
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+import metrics
+from scheduler import DeadlineExceeded, FairScheduler, current_budget
+from state import get_state_backend
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ClientStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttles = 0
+        self.limiter_waits = 0
+        self.errors = 0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "limiter_waits": self.limiter_waits,
+                "errors": self.errors,
+            }
+
+
+class RateLimitedClient:
+    """Drop-in for the parts of `OpenAI` the app uses (`chat.completions.create`)."""
+
+    def __init__(self, client, max_concurrency=16, max_retries=4,
+                 backoff_base=0.5, backoff_max=20.0, scheduler=None):
+        self.raw = client
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = ClientStats()
+        self.scheduler = scheduler or FairScheduler(max_concurrency)
+        self.chat = _Namespace(completions=_Namespace(create=self.create_chat_completion))
+
+    def create_chat_completion(self, **kwargs):
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        tags = metrics.current_tags()
+        started = time.perf_counter()
+        ticket = self._acquire(tags)
+        released = False
+        attempts = [0]
+        try:
+            result = self._with_retries(self.raw.chat.completions.create, attempts, **kwargs)
+            if kwargs.get("stream"):
+                # The slot stays taken until the caller has drained the stream.
+                released = True
+                return _HeldStream(
+                    result, lambda usage: self._release(ticket, usage),
+                    kwargs.get("model"), started, attempts[0], tags,
+                )
+            usage = getattr(result, "usage", None)
+            self._count_usage(ticket, usage)
+            metrics.record_call(
+                kwargs.get("model"), usage,
+                time.perf_counter() - started, attempts[0], tags=tags,
+            )
+            return result
+        except Exception as e:
+            metrics.record_call(
+                kwargs.get("model"), None, time.perf_counter() - started,
+                attempts[0], error=type(e).__name__, tags=tags,
+            )
+            raise
+        finally:
+            if not released:
+                self._release(ticket)
+
+    def cancel(self, student, kinds=None):
+        # A blocking call cannot be interrupted from outside; it finishes on
+        # its own. The async gateway (gateway.py) overrides this.
+        return 0
+
+    # ── internals ───────────────────────────────────────────
+
+    def _acquire(self, tags):
+        budget = current_budget()
+        ticket, waited = self.scheduler.acquire(
+            tags.get("student"), tags.get("kind"), deadline=budget.deadline if budget else None,
+        )
+        if waited:
+            self.stats.incr("limiter_waits")
+        self.stats.incr("in_flight")
+        if budget is not None:
+            budget.started()
+        return ticket
+
+    def _release(self, ticket, usage=None):
+        self._count_usage(ticket, usage)
+        self.stats.incr("in_flight", -1)
+        self.scheduler.release(ticket)
+
+    def _count_usage(self, ticket, usage):
+        if usage is not None:
+            prompt_tokens, completion_tokens, _ = metrics.usage_fields(usage)
+            self.scheduler.record_usage(ticket, prompt_tokens + completion_tokens)
+
+    def _with_retries(self, fn, attempts, **kwargs):
+        # attempts[0] is left holding the number of retries made.
+        budget = current_budget()
+        attempt = 0
+        while True:
+            attempts[0] = attempt
+            self._fit_timeout(budget, kwargs)
+            self.stats.incr("requests")
+            try:
+                return fn(**kwargs)
+            except Exception as e:
+                retry_after = self._retry_after(e)
+                delay = retry_after or self._backoff(attempt + 1)
+                if retry_after is None or attempt >= self.max_retries or not self._has_time(budget, delay):
+                    self.stats.incr("errors")
+                    raise
+                attempt += 1
+                self.stats.incr("retries")
+                time.sleep(delay)
+
+    def _fit_timeout(self, budget, kwargs):
+        # Each attempt gets only what is left of the call's deadline.
+        if budget is None:
+            return
+        remaining = budget.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Изтече времето за отговор.")
+        kwargs["timeout"] = min(kwargs.get("timeout") or remaining, remaining)
+
+    def _has_time(self, budget, delay):
+        return budget is None or budget.remaining() > delay
+
+    def _backoff(self, attempt):
+        # "Full jitter": a random delay up to the exponential cap, so a class
+        # of students that was throttled together does not retry in lockstep.
+        cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    def _retry_after(self, error):
+        # None -> not retryable; 0 -> retry after computed backoff;
+        # > 0 -> the server told us how long to wait.
+        if isinstance(error, openai.APIConnectionError):
+            return 0
+        if not isinstance(error, openai.APIStatusError):
+            return None
+        if error.status_code == 429:
+            self.stats.incr("throttles")
+        if error.status_code not in RETRYABLE_STATUS:
+            return None
+        header = error.response.headers.get("retry-after") if error.response is not None else None
+        try:
+            return min(float(header), self.backoff_max) if header else 0
+        except ValueError:
+            return 0
+
+
+class _HeldStream:
+    def __init__(self, stream, release, model, started, retries, tags):
+        self._stream = stream
+        self._release = release
+        self._model = model
+        self._started = started
+        self._retries = retries
+        self._tags = tags
+        self._usage = None
+        self._first_token = None
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                if self._first_token is None and getattr(chunk, "choices", None):
+                    self._first_token = time.perf_counter() - self._started
+                if getattr(chunk, "usage", None) is not None:
+                    self._usage = chunk.usage
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            if hasattr(self._stream, "close"):
+                self._stream.close()
+            release(self._usage)
+            metrics.record_call(
+                self._model, self._usage, time.perf_counter() - self._started,
+                self._retries, tags=self._tags, stream=True, ttft=self._first_token,
+            )
+
+    def __del__(self):
+        self.close()
+
+
+class _Namespace:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_shared_client(api_key, max_concurrency=16, max_retries=4,
+                      timeout=60.0, connect_timeout=10.0, max_connections=32,
+                      base_url=None, requests_per_hour=0, tokens_per_hour=0, async_gateway=False):
+    # `base_url` points the client at another OpenAI-compatible endpoint,
+    # e.g. the local mock server used for load tests (mock_llm_server.py).
+    # `async_gateway` runs the requests on an event loop (gateway.py).
+    key = (api_key, base_url, async_gateway)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            )
+            http_timeout = httpx.Timeout(timeout, connect=connect_timeout)
+            scheduler = FairScheduler(
+                max_concurrency, requests_per_hour, tokens_per_hour, counters=get_state_backend(),
+            )
+            if async_gateway:
+                from gateway import AsyncModelGateway
+
+                raw = AsyncOpenAI(
+                    api_key=api_key, base_url=base_url or None, max_retries=0,
+                    http_client=httpx.AsyncClient(limits=limits, timeout=http_timeout),
+                )
+                client = AsyncModelGateway(raw, max_retries=max_retries, scheduler=scheduler)
+            else:
+                raw = OpenAI(
+                    api_key=api_key, base_url=base_url or None, max_retries=0,
+                    http_client=httpx.Client(limits=limits, timeout=http_timeout),
+                )
+                client = RateLimitedClient(raw, max_retries=max_retries, scheduler=scheduler)
+            _clients[key] = client
+        return client
@@ -0,0 +1,214 @@
+"""
+Concurrent-student load test for app.py.
+
+Each simulated student drives the real app script through Streamlit's
+`AppTest` harness: log in, pick a case, send a few messages and request the
+assessment, waiting for the background feedback job to finish. All students
+share this process, exactly like sessions share one Streamlit server, so the
+pooled client, the worker pool and the history store are exercised for real.
+
+Run it against the mock model server, never the real API:
+
+    python mock_llm_server.py --port 8999 &
+    python loadtest.py --students 30 --turns 5 --base-url http://127.0.0.1:8999/v1
+
+The report lists throughput, p50/p95/p99 latency per step and error rates.
+Add `--json results.json` to keep a machine-readable copy. Simulated
+consultations are saved to history like real ones, so run it on a copy of
+the project rather than the live installation.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from config import BASE_DIR
+from metrics import percentile
+
+STUDENT_LINES = [
+    "Здравейте! С какво мога да ви помогна?",
+    "От колко време имате тази кашлица?",
+    "Приемате ли някакви лекарства в момента?",
+    "Имате ли температура или други оплаквания?",
+    "Разбирам. Кога започнахте да приемате лекарството за кръвно?",
+    "Кашлицата може да е страничен ефект. Препоръчвам да се консултирате с лекаря си.",
+]
+
+ASSESS_LABEL = "Приключване и оценка на консултацията"
+CASE_LABEL = "ПАЦИЕНТСКИ КАЗУС"
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.started = time.perf_counter()
+
+    def add(self, step, seconds, ok=True):
+        with self.lock:
+            self.samples.setdefault(step, []).append(seconds)
+            if not ok:
+                self.errors[step] = self.errors.get(step, 0) + 1
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rows = []
+        for step, values in self.samples.items():
+            values = sorted(values)
+            rows.append({
+                "step": step,
+                "count": len(values),
+                "errors": self.errors.get(step, 0),
+                "error_rate": self.errors.get(step, 0) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            })
+        total = sum(r["count"] for r in rows)
+        return {
+            "elapsed": elapsed,
+            "interactions": total,
+            "throughput": total / elapsed if elapsed else 0.0,
+            "errors": sum(r["errors"] for r in rows),
+            "steps": rows,
+        }
+
+
+def _button(at, label):
+    for button in at.button:
+        if button.label == label:
+            return button
+    return None
+
+
+def _failed(at):
+    return bool(at.exception) or bool(at.error)
+
+
+def simulate_student(email, args, recorder):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(BASE_DIR / "app.py"), default_timeout=args.timeout)
+    at.secrets["OPENAI_API_KEY"] = args.api_key
+    at.secrets["OPENAI_BASE_URL"] = args.base_url
+    at.secrets["COURSE_CODE"] = args.course_code
+
+    def step(name, action):
+        started = time.perf_counter()
+        try:
+            action()
+            ok = not _failed(at)
+        except Exception:
+            ok = False
+        recorder.add(name, time.perf_counter() - started, ok)
+        return ok
+
+    if not step("open", at.run):
+        return
+
+    def login():
+        at.text_input[0].input(email)
+        at.text_input[1].input(args.course_code)
+        at.button[0].click().run()
+
+    if not step("login", login):
+        return
+
+    def select_case():
+        # The options are display labels ("Име, 45 г.") but the value is the
+        # case name, so pick a label and select the name it belongs to.
+        selectbox = next(s for s in at.sidebar.selectbox if s.label == CASE_LABEL)
+        label = random.choice(selectbox.options)
+        selectbox.select(label.rsplit(", ", 1)[0]).run()
+
+    if not step("select_case", select_case):
+        return
+
+    for line in random.sample(STUDENT_LINES, min(args.turns, len(STUDENT_LINES))):
+        step("turn", lambda: at.chat_input[0].set_value(line).run())
+        time.sleep(random.uniform(0, args.think_time))
+
+    def assess():
+        button = _button(at, ASSESS_LABEL)
+        if button is None:
+            raise RuntimeError("assessment button not shown")
+        button.click().run()
+        deadline = time.perf_counter() + args.timeout
+        while not at.session_state["feedback_text"]:
+            if time.perf_counter() > deadline or _failed(at):
+                raise RuntimeError("feedback did not arrive")
+            time.sleep(0.5)
+            at.run()
+
+    step("feedback", assess)
+
+
+def pick_emails(count):
+    # Students must pass check_login, so reuse the roster when there is one.
+    roster = []
+    students_file = BASE_DIR / "students.txt"
+    if students_file.exists():
+        with open(students_file, "r", encoding="utf-8") as f:
+            roster = [
+                line.strip().lower()
+                for line in f
+                if line.strip() and not line.startswith("#")
+            ]
+    if not roster:
+        # New addresses on every run: a previous run's finished assessments
+        # would otherwise be resumed and hide the chat.
+        run_id = time.strftime("%m%d%H%M%S")
+        return [f"loadtest{i}-{run_id}@example.bg" for i in range(count)]
+    return [roster[i % len(roster)] for i in range(count)]
+
+
+def run(args):
+    recorder = Recorder()
+    emails = pick_emails(args.students)
+    threads = []
+    for i, email in enumerate(emails):
+        thread = threading.Thread(target=simulate_student, args=(email, args, recorder), daemon=True)
+        threads.append(thread)
+        thread.start()
+        if args.ramp and i < len(emails) - 1:
+            time.sleep(args.ramp / len(emails))
+    for thread in threads:
+        thread.join()
+    return recorder.report()
+
+
+def print_report(report):
+    print(f"\n{report['interactions']} interactions in {report['elapsed']:.1f} s "
+          f"({report['throughput']:.2f}/s), {report['errors']} errors")
+    print(f"{'step':<12}{'count':>7}{'err%':>7}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}")
+    for r in report["steps"]:
+        print(f"{r['step']:<12}{r['count']:>7}{r['error_rate'] * 100:>6.1f}%"
+              f"{r['p50']:>8.2f}{r['p95']:>8.2f}{r['p99']:>8.2f}{r['max']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate N concurrent students against app.py")
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds over which students join")
+    parser.add_argument("--think-time", type=float, default=2.0, help="max pause between turns")
+    parser.add_argument("--timeout", type=float, default=180.0)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8999/v1")
+    parser.add_argument("--api-key", default="mock")
+    parser.add_argument("--course-code", default="loadtest")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
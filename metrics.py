@@ -0,0 +1,162 @@
+"""
+Per-call instrumentation for model requests.
+
+Every request that goes through the shared client (see llm_client.py) is
+recorded as one JSON line in `logs/metrics.jsonl`, rotated by size: model,
+prompt / completion / cached tokens, wall time, retry count, estimated cost
+and whatever tags the caller set with `call_context` (student, patient case,
+kind of call). `summarize` turns those lines into latency percentiles and
+cost per case or per student for the instructor view.
+"""
+
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+from config import BASE_DIR, get_secret
+
+METRICS_DIR = BASE_DIR / "logs"
+METRICS_FILE = METRICS_DIR / "metrics.jsonl"
+
+# USD per 1M tokens: (input, cached input, output)
+PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+}
+
+_tags = contextvars.ContextVar("metrics_tags", default={})
+_logger = None
+
+
+@contextmanager
+def call_context(**tags):
+    # Tags apply to every model call made inside the block (nested blocks merge).
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def current_tags():
+    return dict(_tags.get())
+
+
+def _get_logger():
+    global _logger
+    if _logger is None:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        logger = logging.getLogger("pharmabot.metrics")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        handler = RotatingFileHandler(
+            METRICS_FILE,
+            maxBytes=int(get_secret("METRICS_LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(get_secret("METRICS_LOG_BACKUPS", 5)),
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        _logger = logger
+    return _logger
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    # Dated snapshots ("gpt-4o-2024-08-06") are priced like their base model.
+    price = PRICES.get(model)
+    if price is None:
+        matches = [name for name in PRICES if model.startswith(name)]
+        if not matches:
+            return 0.0
+        price = PRICES[max(matches, key=len)]
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (uncached * price[0] + cached_tokens * price[1] + completion_tokens * price[2]) / 1_000_000
+
+
+def usage_fields(usage):
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    return usage.prompt_tokens or 0, usage.completion_tokens or 0, cached
+
+
+def record_call(model, usage, wall_time, retries=0, error=None, tags=None, **extra):
+    prompt_tokens, completion_tokens, cached_tokens = usage_fields(usage)
+    entry = {
+        "ts": time.time(),
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "wall_time": round(wall_time, 4),
+        "retries": retries,
+        "cost": round(estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens), 6),
+        "error": error,
+        **(tags if tags is not None else current_tags()),
+        **extra,
+    }
+    try:
+        _get_logger().info(json.dumps(entry, ensure_ascii=False))
+    except OSError:
+        pass
+    return entry
+
+
+# ─────────────────────────────────────────────────────────────
+# AGGREGATION
+# ─────────────────────────────────────────────────────────────
+
+def iter_metrics(since=None):
+    # Oldest rotated file first so entries come out roughly in time order.
+    backups = int(get_secret("METRICS_LOG_BACKUPS", 5))
+    paths = [METRICS_FILE.with_name(f"{METRICS_FILE.name}.{i}") for i in range(backups, 0, -1)]
+    paths.append(METRICS_FILE)
+    for path in paths:
+        if not path.exists():
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since is None or entry.get("ts", 0) >= since:
+                    yield entry
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def summarize(entries, key):
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry.get(key) or "—", []).append(entry)
+
+    rows = []
+    for name, items in groups.items():
+        latencies = sorted(e["wall_time"] for e in items)
+        rows.append({
+            key: name,
+            "calls": len(items),
+            "errors": sum(1 for e in items if e.get("error")),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "prompt_tokens": sum(e["prompt_tokens"] for e in items),
+            "completion_tokens": sum(e["completion_tokens"] for e in items),
+            "cached_tokens": sum(e["cached_tokens"] for e in items),
+            "retries": sum(e.get("retries", 0) for e in items),
+            "cost": round(sum(e["cost"] for e in items), 4),
+        })
+    rows.sort(key=lambda r: r["cost"], reverse=True)
+    return rows
@@ -0,0 +1,217 @@
+"""
+Local OpenAI-compatible stand-in for load tests.
+
+Serves `POST /v1/chat/completions` (plain and streaming) with canned Bulgarian
+replies, so the app can be exercised by a whole "lecture hall" without
+spending API credit. Latency, token rate and failures are configurable:
+
+    python mock_llm_server.py --port 8999 --latency 0.4 --tokens-per-sec 40 \\
+        --error-429 0.05 --error-500 0.01 --timeout-rate 0.01
+
+Point the app at it with these secrets:
+
+    OPENAI_BASE_URL = "http://127.0.0.1:8999/v1"
+    OPENAI_API_KEY  = "mock"
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PATIENT_REPLIES = [
+    "Ами, от около три седмици е така. Не знам дали е свързано с нещо.",
+    "Не, температура нямам. Просто тази кашлица не ми дава мира, особено вечер.",
+    "Пия само лекарството за кръвно, което ми изписа докторът преди два месеца.",
+    "Добре, разбирам. А трябва ли да спра хапчетата веднага?",
+    "Благодаря ви, ще се обадя на личния лекар още днес.",
+]
+
+FEEDBACK_REPLY = (
+    "Студентът правилно установява продължителността на симптома и задава въпрос "
+    "за приеманите лекарства. Насочването към лекар е уместно."
+    " ||| "
+    "Използвани са няколко отворени въпроса. Липсва обобщаване в края на разговора; "
+    "емпатията може да бъде изразена по-явно."
+    " ||| "
+    "Започвайте с отворен въпрос, обобщавайте чутото и проверявайте разбирането. "
+    "Обща оценка: 4/5."
+)
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "429": 0, "500": 0, "timeouts": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def make_handler(state):
+    args = state.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *params):
+            if args.verbose:
+                super().log_message(fmt, *params)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                self._json(200, state.counts)
+            else:
+                self._json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._json(404, {"error": {"message": "not found"}})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            state.count("requests")
+
+            roll = random.random()
+            if roll < args.error_429:
+                state.count("429")
+                self._json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit"}},
+                           {"retry-after": "1"})
+                return
+            roll -= args.error_429
+            if roll < args.error_500:
+                state.count("500")
+                self._json(500, {"error": {"message": "Internal error (mock)", "type": "server_error"}})
+                return
+            roll -= args.error_500
+            if roll < args.timeout_rate:
+                state.count("timeouts")
+                time.sleep(args.hang_seconds)
+                return
+
+            text = self._reply_for(body)
+            tokens = [w + " " for w in text.split(" ")]
+            prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 3
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens),
+                "prompt_tokens_details": {"cached_tokens": 0},
+            }
+            time.sleep(max(0.0, random.gauss(args.latency, args.latency * args.jitter)))
+            if body.get("stream"):
+                self._stream(body, tokens, usage)
+            else:
+                time.sleep(len(tokens) / args.tokens_per_sec)
+                self._json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text.strip()},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+
+        # ── helpers ─────────────────────────────────────────
+
+        def _reply_for(self, body):
+            if (body.get("response_format") or {}).get("type") == "json_schema":
+                clinical, communication, recommendations = (
+                    part.strip() for part in FEEDBACK_REPLY.split("|||")
+                )
+                return json.dumps({
+                    "clinical": clinical,
+                    "communication": communication,
+                    "recommendations": recommendations,
+                    "score": 4,
+                }, ensure_ascii=False)
+            prompt = " ".join(m.get("content") or "" for m in body.get("messages", []))
+            if "ТРАНСКРИПТ НА КОНСУЛТАЦИЯТА" in prompt:
+                return FEEDBACK_REPLY
+            return random.choice(PATIENT_REPLIES)
+
+        def _json(self, status, payload, headers=None):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, body, tokens, usage):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            base = {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+            }
+            delay = 1.0 / args.tokens_per_sec
+            for token in tokens:
+                self._event({**base, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+                time.sleep(delay)
+            self._event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._event({**base, "choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+        def _event(self, payload):
+            self.wfile.write(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # a whole lecture hall may connect at once
+
+
+def serve(args):
+    return _Server((args.host, args.port), make_handler(MockState(args)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", type=float, default=0.4, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.25, help="relative std-dev of the latency")
+    parser.add_argument("--tokens-per-sec", type=float, default=40.0)
+    parser.add_argument("--error-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--error-500", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of requests that hang")
+    parser.add_argument("--hang-seconds", type=float, default=120.0)
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    server = serve(args)
+    print(f"Mock LLM listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
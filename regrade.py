@@ -0,0 +1,204 @@
+"""
+Batch re-grading of stored consultations.
+
+After `DEFAULT_FEEDBACK_PROMPT` or a case's `feedback_prompt` changes, past
+consultations can be graded again with the new prompts:
+
+    python regrade.py run --since 2025-02-01 --workers 8 --rate 120
+    python regrade.py compare --version <tag printed by run>
+
+Records are streamed from the history store and graded with the same code
+as the app (`generate_feedback` / `generate_structured_feedback`) through a
+bounded worker pool on the shared, rate-limited client. Each result is
+stored next to the original record under a prompt-version tag, which by
+default is a hash of the feedback prompts, the model and the output format.
+A result is saved as soon as it arrives, so an interrupted run picks up
+where it stopped when started again with the same version.
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cases import get_case_catalog
+from config import get_secret
+from feedback import (
+    DEFAULT_FEEDBACK_PROMPT,
+    FACTS_INSTRUCTIONS,
+    generate_feedback,
+    generate_structured_feedback,
+    parse_feedback,
+    structured_feedback_enabled,
+)
+from feedback_cache import feedback_cache_key, get_feedback_cache
+from history import get_history_store
+from llm_client import get_shared_client
+from metrics import call_context
+from router import route
+from transcript_analysis import analysis_enabled
+
+
+def prompt_version(catalog, model, structured):
+    # Changes whenever any prompt that can affect a grade changes.
+    digest = hashlib.sha256()
+    settings = [DEFAULT_FEEDBACK_PROMPT, FACTS_INSTRUCTIONS, model, structured, analysis_enabled()]
+    digest.update(json.dumps(settings, ensure_ascii=False).encode("utf-8"))
+    for name in sorted(catalog.names()):
+        case = catalog.get(name)
+        digest.update(json.dumps([name, case.get("feedback_prompt", "")], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+class RateLimiter:
+    # Spaces calls evenly to at most `per_minute` (0 = unlimited).
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        time.sleep(slot - now)
+
+
+def grade(client, record, case, model, structured):
+    cache = get_feedback_cache()
+    key = feedback_cache_key(record["messages"], case, model, structured)
+    result = cache.get(key)
+    if result is None:
+        with call_context(kind="regrade", patient=record["patient"]):
+            if structured:
+                result = generate_structured_feedback(client, record["messages"], case)
+            else:
+                result = parse_feedback(generate_feedback(client, record["messages"], case))
+        cache.put(key, result)
+    return result
+
+
+def run(args):
+    store = get_history_store()
+    catalog = get_case_catalog()
+    model = route("grading")["model"]
+    structured = structured_feedback_enabled()
+    version = args.version or prompt_version(catalog, model, structured)
+    print(f"Prompt version: {version}")
+
+    client = get_shared_client(
+        get_secret("OPENAI_API_KEY"),
+        max_concurrency=args.workers,
+        max_retries=int(get_secret("OPENAI_MAX_RETRIES", 4)),
+        timeout=float(get_secret("OPENAI_TIMEOUT", 60)),
+        base_url=get_secret("OPENAI_BASE_URL", "") or None,
+    )
+    limiter = RateLimiter(args.rate)
+    done = store.regraded_keys(version)
+    counts = {"graded": 0, "skipped": 0, "failed": 0, "already_done": len(done)}
+
+    def task(record, case):
+        limiter.wait()
+        store.save_regrade(record, version, grade(client, record, case, model, structured))
+
+    def collect(finished):
+        for future in finished:
+            if future.exception() is not None:
+                counts["failed"] += 1
+                print(f"  грешка: {future.exception()}", file=sys.stderr)
+            else:
+                counts["graded"] += 1
+        if args.progress and (counts["graded"] + counts["failed"]) % args.progress == 0:
+            print(f"  {counts['graded']} оценени, {counts['failed']} грешки")
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for record in store.iter_records():
+            if store.record_key(record) in done or not _selected(record, args):
+                continue
+            case = catalog.get(record["patient"])
+            if case is None or len(record.get("messages", [])) < 2:
+                counts["skipped"] += 1
+                continue
+            pending.add(pool.submit(task, record, case))
+            if len(pending) >= args.workers * 2:
+                # Keep only a bounded window of records in memory.
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            if args.limit and counts["graded"] + counts["failed"] + len(pending) >= args.limit:
+                break
+        finished, _ = wait(pending)
+        collect(finished)
+
+    print(f"Оценени: {counts['graded']}, вече оценени преди: {counts['already_done']}, "
+          f"пропуснати: {counts['skipped']}, грешки: {counts['failed']}")
+    return version, counts
+
+
+def _selected(record, args):
+    ts = record.get("timestamp", "")
+    return (
+        (args.patient is None or record.get("patient") == args.patient)
+        and (args.since is None or ts >= args.since)
+        and (args.until is None or ts < args.until)
+    )
+
+
+def compare(version):
+    # Old vs new score per case, over all records graded with `version`.
+    rows = {}
+    for record, result in get_history_store().iter_regrades(version):
+        old = record.get("score") or parse_feedback(record.get("feedback", ""))["score"]
+        row = rows.setdefault(record["patient"], {"count": 0, "old": [], "new": [], "changed": 0})
+        row["count"] += 1
+        new = result.get("score")
+        if old is not None:
+            row["old"].append(old)
+        if new is not None:
+            row["new"].append(new)
+        if old is not None and new is not None and old != new:
+            row["changed"] += 1
+
+    def mean(values):
+        return sum(values) / len(values) if values else float("nan")
+
+    print(f"{'казус':<30}{'брой':>7}{'стара':>8}{'нова':>8}{'промяна':>9}")
+    for patient, row in sorted(rows.items()):
+        print(f"{patient:<30}{row['count']:>7}{mean(row['old']):>8.2f}{mean(row['new']):>8.2f}{row['changed']:>9}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-grade stored consultations with the current prompts")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="grade history records not yet graded with this version")
+    run_parser.add_argument("--version", help="prompt-version tag (default: hash of the current prompts)")
+    run_parser.add_argument("--workers", type=int, default=8)
+    run_parser.add_argument("--rate", type=float, default=60, help="max requests per minute (0 = no limit)")
+    run_parser.add_argument("--patient")
+    run_parser.add_argument("--since", help="ISO date, e.g. 2025-03-01")
+    run_parser.add_argument("--until")
+    run_parser.add_argument("--limit", type=int, default=0)
+    run_parser.add_argument("--progress", type=int, default=50, help="print progress every N records")
+
+    compare_parser = sub.add_parser("compare", help="old vs new scores for a prompt version")
+    compare_parser.add_argument("--version", required=True)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if not get_secret("OPENAI_API_KEY"):
+            sys.exit("OPENAI_API_KEY is not set.")
+        run(args)
+    else:
+        compare(args.version)
+
+
+if __name__ == "__main__":
+    main()
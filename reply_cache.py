@@ -0,0 +1,175 @@
+"""
+Opt-in cache of patient replies to the usual conversation openers.
+
+Nearly every consultation starts with "Здравейте", "С какво мога да
+помогна?" and the like, and each of those paid for a full patient completion
+with the same system prompt. With `REPLY_CACHE = "true"` the first
+`REPLY_CACHE_TURNS` student messages of a conversation are looked up in an
+in-memory cache scoped to the case (system prompt + model):
+
+- only openers are cached: greetings and offers of help (`OPENER`, e.g.
+  "Здравейте, с какво мога да помогна?"); a conversation is looked up only
+  while every student message in it is one, so questions about the
+  complaint, however short, always go to the model;
+- the key is the conversation so far, normalised (lower case, no
+  punctuation, single spaces): the student's messages and the patient's
+  replies between them, so a cached second reply always follows the first
+  reply the student actually saw; a conversation matches a key when every
+  message is at least `REPLY_CACHE_SIMILARITY` similar to the cached one, so
+  "Здравейте!" and "здравейте" share the same replies;
+- a key serves from the cache only once it holds `REPLY_CACHE_VARIANTS`
+  different model replies, and then picks one at random, so the patients do
+  not all greet the same way;
+- at most `REPLY_CACHE_ENTRIES` keys are kept, least recently used first out.
+
+The metrics page shows the hit rate and the tokens (and dollars) saved.
+"""
+
+import difflib
+import hashlib
+import random
+import re
+import threading
+from collections import OrderedDict
+
+from config import get_secret
+from context import count_message_tokens, count_tokens
+from metrics import estimate_cost
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+# Opening lines, matched against the whole normalised message.
+_GREETING = r"(?:здравейте|здравей|добър ден|добро утро|добър вечер|добре дошли)"
+_OFFER = (
+    r"(?:(?:с )?какво (?:мога да|да) (?:ви )?(?:помогна|бъда полезен|бъда полезна)"
+    r"|как (?:мога да|да) (?:ви )?помогна|какво ви води(?: при нас| насам)?"
+    r"|какво ще обичате|заповядайте|слушам ви)"
+)
+OPENER = re.compile(rf"{_GREETING}(?: {_OFFER})?|{_OFFER}")
+
+
+def reply_cache_enabled():
+    return str(get_secret("REPLY_CACHE", "false")).strip().lower() not in ("0", "false", "no", "off")
+
+
+def normalize(text):
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text.lower())).strip()
+
+
+def is_opener(text):
+    return OPENER.fullmatch(normalize(text)) is not None
+
+
+def case_key(system_prompt, model):
+    return hashlib.sha256(f"{model}\n{system_prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+def similar(a, b, threshold):
+    if a == b:
+        return True
+    matcher = difflib.SequenceMatcher(None, a, b)
+    return matcher.quick_ratio() >= threshold and matcher.ratio() >= threshold
+
+
+class ReplyCache:
+    def __init__(self, max_turns=2, variants=3, max_entries=500, similarity=0.85):
+        self.max_turns = max_turns
+        self.variants = variants
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        # (case, normalised conversation) -> {"replies": [...], "prompt_tokens": n}
+        self._entries = OrderedDict()
+        self._stats = {
+            "hits": 0, "misses": 0, "skipped": 0, "stores": 0, "evictions": 0,
+            "saved_tokens": 0, "saved_cost": 0.0,
+        }
+
+    def lookup(self, system_prompt, model, messages):
+        """A cached reply to the conversation `messages` (ending with the
+        student's new message), or None when the model has to answer."""
+        prefix = self._prefix(messages)
+        if prefix is None:
+            with self._lock:
+                self._stats["skipped"] += 1
+            return None
+        with self._lock:
+            key = self._find(case_key(system_prompt, model), prefix)
+            entry = self._entries.get(key)
+            if entry is None or len(entry["replies"]) < self.variants:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            reply = random.choice(entry["replies"])
+            completion_tokens = count_tokens(reply, model)
+            self._stats["hits"] += 1
+            self._stats["saved_tokens"] += entry["prompt_tokens"] + completion_tokens
+            self._stats["saved_cost"] += estimate_cost(model, entry["prompt_tokens"], completion_tokens)
+            return reply
+
+    def store(self, system_prompt, model, messages, reply):
+        # Called with the model's reply after a miss; fills the key's variants.
+        prefix = self._prefix(messages)
+        if prefix is None or not reply:
+            return
+        prompt_tokens = count_message_tokens([{"role": "system", "content": system_prompt}] + messages, model)
+        with self._lock:
+            case = case_key(system_prompt, model)
+            key = self._find(case, prefix) or (case, prefix)
+            entry = self._entries.setdefault(key, {"replies": [], "prompt_tokens": prompt_tokens})
+            self._entries.move_to_end(key)
+            if len(entry["replies"]) < self.variants and reply not in entry["replies"]:
+                entry["replies"].append(reply)
+                self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["ready"] = sum(1 for e in self._entries.values() if len(e["replies"]) >= self.variants)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    # ── internals ───────────────────────────────────────────
+
+    def _prefix(self, messages):
+        # The normalised conversation, or None once it is past the openers.
+        if not messages or messages[-1]["role"] != "user":
+            return None
+        turns = [m["content"] for m in messages if m["role"] == "user"]
+        if len(turns) > self.max_turns or not all(is_opener(t) for t in turns):
+            return None
+        return tuple(normalize(m["content"]) for m in messages if m["role"] in ("user", "assistant"))
+
+    def _find(self, case, prefix):
+        # Exact key first, then the closest key of the same case and depth.
+        if (case, prefix) in self._entries:
+            return case, prefix
+        for key in reversed(self._entries):
+            if key[0] != case or len(key[1]) != len(prefix):
+                continue
+            if all(similar(a, b, self.similarity) for a, b in zip(key[1], prefix)):
+                return key
+        return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_reply_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ReplyCache(
+                max_turns=int(get_secret("REPLY_CACHE_TURNS", 2)),
+                variants=int(get_secret("REPLY_CACHE_VARIANTS", 3)),
+                max_entries=int(get_secret("REPLY_CACHE_ENTRIES", 500)),
+                similarity=float(get_secret("REPLY_CACHE_SIMILARITY", 0.85)),
+            )
+        return _cache
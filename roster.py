@@ -0,0 +1,187 @@
+"""
+Courses, rosters and login checks.
+
+Several cohorts can share one installation. Each course has its own access
+code, roster file and (optionally) its own set of cases, configured in
+`secrets.toml`:
+
+    [COURSES.fg-2025]
+    title = "Фармацевтични грижи 2025"
+    code = "pharma2025"
+    roster = "rosters/fg-2025.txt"      # same format as students.txt
+    cases = ["Георги Петров"]           # optional: allowed case names
+    case_tags = ["кардиология"]         # optional: ...or cases with these tags
+
+Without `COURSES` there is a single course made of `COURSE_CODE` and
+`students.txt`, as before. Rosters are held as sets and re-read when the
+file changes; codes are compared in constant time, and an email is locked
+out for a while after repeated failed attempts. Failed attempts are counted
+in the shared state backend (state.py), so a lockout holds on every process.
+"""
+
+import hmac
+import threading
+import time
+
+from config import BASE_DIR, get_secret
+from state import MemoryBackend, get_state_backend
+
+DEFAULT_COURSE = "default"
+CHECK_INTERVAL = 2.0
+
+MAX_FAILURES = 5
+FAILURE_WINDOW = 900
+LOCKOUT = 300
+
+
+class Roster:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._emails = frozenset()
+        self._mtime = None
+        self._checked = 0.0
+
+    def emails(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked >= CHECK_INTERVAL:
+                self._checked = now
+                try:
+                    mtime = self.path.stat().st_mtime
+                except FileNotFoundError:
+                    mtime = None
+                if mtime != self._mtime:
+                    self._emails = self._read() if mtime is not None else frozenset()
+                    self._mtime = mtime
+            return self._emails
+
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return frozenset(
+                line.strip().lower()
+                for line in f
+                if line.strip() and not line.startswith("#")
+            )
+
+    def __contains__(self, email):
+        emails = self.emails()
+        # An empty or missing roster lets everyone with the code in (for testing).
+        return not emails or email in emails
+
+
+class Course:
+    def __init__(self, course_id, code, roster_path, title="", cases=None, case_tags=None):
+        self.id = course_id
+        self.title = title or course_id
+        self.code = str(code)
+        self.roster = Roster(roster_path)
+        self.cases = set(cases) if cases else None
+        self.case_tags = set(case_tags) if case_tags else None
+
+    def allows(self, case_entry):
+        # Case index entries (see cases.py) this course may open.
+        if self.cases is None and self.case_tags is None:
+            return True
+        return bool(
+            (self.cases and case_entry["name"] in self.cases)
+            or (self.case_tags and self.case_tags & set(case_entry["tags"]))
+        )
+
+
+class LoginThrottle:
+    # Failures, lockouts and successful logins are events in the shared
+    # counters; failures count from the last lockout or success onwards.
+
+    def __init__(self, max_failures=MAX_FAILURES, window=FAILURE_WINDOW, lockout=LOCKOUT, counters=None):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self.counters = counters or MemoryBackend()
+
+    def retry_in(self, email):
+        locked = self.counters.latest("login_lockouts", email)
+        if locked is None:
+            return 0
+        return max(locked + self.lockout - time.time(), 0)
+
+    def failed(self, email):
+        self.counters.add_event("login_failures", email)
+        since = max(
+            time.time() - self.window,
+            self.counters.latest("login_lockouts", email) or 0,
+            self.counters.latest("login_successes", email) or 0,
+        )
+        count, _, _ = self.counters.window("login_failures", email, since)
+        if count >= self.max_failures:
+            self.counters.add_event("login_lockouts", email)
+
+    def succeeded(self, email):
+        self.counters.add_event("login_successes", email)
+
+
+class Registry:
+    def __init__(self, courses):
+        self.courses = {course.id: course for course in courses}
+        self.throttle = LoginThrottle(
+            max_failures=int(get_secret("LOGIN_MAX_FAILURES", MAX_FAILURES)),
+            lockout=float(get_secret("LOGIN_LOCKOUT_SECONDS", LOCKOUT)),
+            counters=get_state_backend(),
+        )
+
+    def course_for_code(self, code):
+        # Every code is compared, so the time taken does not reveal which
+        # course (if any) matched or how much of a code was right.
+        match = None
+        supplied = str(code).encode("utf-8")
+        for course in self.courses.values():
+            if hmac.compare_digest(supplied, course.code.encode("utf-8")):
+                match = course
+        return match
+
+    def check_login(self, email, code):
+        """Returns (course or None, error message)."""
+        email = email.strip().lower()
+        retry_in = self.throttle.retry_in(email)
+        if retry_in:
+            minutes = max(1, round(retry_in / 60))
+            return None, f"Твърде много неуспешни опити. Опитайте отново след {minutes} мин."
+
+        course = self.course_for_code(code)
+        if course is None:
+            self.throttle.failed(email)
+            return None, "Невалиден код за достъп."
+        if email not in course.roster:
+            self.throttle.failed(email)
+            return None, "Този имейл не е регистриран в системата."
+        self.throttle.succeeded(email)
+        return course, ""
+
+
+def load_courses():
+    configured = get_secret("COURSES", None)
+    if not configured:
+        return [Course(DEFAULT_COURSE, get_secret("COURSE_CODE", "pharma2025"), BASE_DIR / "students.txt")]
+    courses = []
+    for course_id, settings in dict(configured).items():
+        courses.append(Course(
+            course_id,
+            settings["code"],
+            BASE_DIR / settings.get("roster", f"rosters/{course_id}.txt"),
+            title=settings.get("title", ""),
+            cases=settings.get("cases"),
+            case_tags=settings.get("case_tags"),
+        ))
+    return courses
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = Registry(load_courses())
+        return _registry
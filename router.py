@@ -0,0 +1,325 @@
+"""
+Model routing with latency deadlines and hedged requests.
+
+Each kind of call has its own route, configured in `secrets.toml`:
+
+    role      model secret     fallback secret            deadline secret (s)
+    patient   PATIENT_MODEL    PATIENT_FALLBACK_MODEL     PATIENT_DEADLINE   (4)
+    grading   GRADING_MODEL    GRADING_FALLBACK_MODEL     GRADING_DEADLINE   (45)
+    summary   SUMMARY_MODEL    SUMMARY_FALLBACK_MODEL     SUMMARY_DEADLINE   (8)
+
+Unset models fall back to `MODEL_NAME` (and the summary to the patient
+model). The deadline is the latency budget: for streams the time to the
+first token, otherwise the whole answer. It is counted from the moment the
+primary request holds a scheduler slot, so time spent in the queue does not
+trigger a hedge (a hedge would only queue behind it). When the primary
+model misses it (or fails) and the route has a fallback model, a duplicate
+request is sent to the fallback and whichever answers first is used; a
+losing stream is closed. Every call also has one hard timeout
+(`<ROLE>_TIMEOUT`) that covers the wait in the queue, all retries and the
+requests themselves (for streams, until the answer starts), so an upstream
+that never answers cannot hang a student.
+
+`acreate` and `astream` do the same for coroutines on the async gateway
+(gateway.py); there a losing request is cancelled instead of left to finish.
+
+Latency, errors and hedge win rates per model are kept in memory for the
+instructor view (`get_router().snapshot()`).
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from config import get_secret
+from metrics import call_context, percentile
+from scheduler import CallBudget, call_budget
+
+ROLES = {
+    # role: (default deadline, default hard timeout)
+    "patient": (4.0, 60.0),
+    "grading": (45.0, 180.0),
+    "summary": (8.0, 60.0),
+}
+
+LATENCY_SAMPLES = 500
+
+
+def route(role):
+    default_model = get_secret("MODEL_NAME", "gpt-4o")
+    if role == "summary":
+        default_model = get_secret("PATIENT_MODEL", default_model)
+    prefix = role.upper()
+    deadline, timeout = ROLES[role]
+    return {
+        "role": role,
+        "model": get_secret(f"{prefix}_MODEL", default_model),
+        "fallback": get_secret(f"{prefix}_FALLBACK_MODEL", "") or None,
+        "deadline": float(get_secret(f"{prefix}_DEADLINE", deadline)),
+        "timeout": float(get_secret(f"{prefix}_TIMEOUT", timeout)),
+    }
+
+
+class _ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.hedged = 0  # races this model took part in
+        self.wins = 0  # races it won
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+
+class ModelRouter:
+    def __init__(self, max_workers=64):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="router")
+        self._lock = threading.Lock()
+        self._models = {}
+        self._hedges = {role: 0 for role in ROLES}
+
+    # ── public API ──────────────────────────────────────────
+
+    def create(self, client, role, **kwargs):
+        """`chat.completions.create` for a role; returns the winning response."""
+        r = route(role)
+
+        def call(model):
+            return client.chat.completions.create(model=model, timeout=r["timeout"], **kwargs)
+
+        return self._race(r, call, close=None, deadline=time.monotonic() + r["timeout"])
+
+    def stream(self, client, role, **kwargs):
+        """Streaming variant: yields chunks of whichever model starts first."""
+        r = route(role)
+
+        def call(model):
+            stream = client.chat.completions.create(model=model, timeout=r["timeout"], stream=True, **kwargs)
+            chunks = iter(stream)
+            head = []
+            for chunk in chunks:
+                head.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+            return stream, chunks, head
+
+        stream, chunks, head = self._race(
+            r, call, close=lambda result: result[0].close(), deadline=time.monotonic() + r["timeout"],
+        )
+        try:
+            yield from head
+            yield from chunks
+        finally:
+            stream.close()
+
+    async def acreate(self, gateway, role, **kwargs):
+        """`create` for a coroutine on the gateway loop (`AsyncModelGateway`)."""
+        r = route(role)
+
+        async def call(model, handle):
+            return await gateway.acreate(handle=handle, model=model, timeout=r["timeout"], **kwargs)
+
+        return await self._arace(r, call, close=None, deadline=time.monotonic() + r["timeout"])
+
+    async def astream(self, gateway, role, **kwargs):
+        """`stream` for a coroutine on the gateway loop: an async generator."""
+        r = route(role)
+
+        async def call(model, handle):
+            stream = gateway.astream(handle=handle, model=model, timeout=r["timeout"], **kwargs)
+            head = []
+            try:
+                async for chunk in stream:
+                    head.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except BaseException:
+                await stream.aclose()
+                raise
+            return stream, head
+
+        stream, head = await self._arace(
+            r, call, close=lambda result: result[0].aclose(), deadline=time.monotonic() + r["timeout"],
+        )
+        try:
+            for chunk in head:
+                yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def snapshot(self):
+        with self._lock:
+            rows = []
+            for model, s in sorted(self._models.items()):
+                latencies = sorted(s.latencies)
+                rows.append({
+                    "модел": model,
+                    "заявки": s.calls,
+                    "грешки": s.errors,
+                    "p50 (с)": round(percentile(latencies, 50), 2) if latencies else None,
+                    "p95 (с)": round(percentile(latencies, 95), 2) if latencies else None,
+                    "надпревари": s.hedged,
+                    "победи": s.wins,
+                    "дял победи": round(s.wins / s.hedged, 2) if s.hedged else None,
+                })
+            return {"models": rows, "hedges": dict(self._hedges)}
+
+    # ── internals ───────────────────────────────────────────
+
+    def _submit(self, call, model, hedge, budget):
+        # Each request runs in a copy of the caller's context, so metric tags
+        # and the scheduler's student / queue callbacks follow it.
+        def run():
+            with call_context(hedge=hedge), call_budget(budget):
+                return self._timed(call, model)
+        return self._pool.submit(contextvars.copy_context().run, run)
+
+    def _timed(self, call, model):
+        started = time.perf_counter()
+        try:
+            result = call(model)
+        except Exception:
+            self._record(model, error=True)
+            raise
+        self._record(model, latency=time.perf_counter() - started)
+        return result
+
+    def _race(self, r, call, close, deadline):
+        if not r["fallback"]:
+            # Nothing to hedge with: call inline, bounded by the hard timeout.
+            with call_budget(CallBudget(deadline)):
+                return self._timed(call, r["model"])
+
+        # The latency budget starts once the primary holds a slot (or ends).
+        running = threading.Event()
+        primary = self._submit(call, r["model"], hedge=False, budget=CallBudget(deadline, on_slot=running.set))
+        primary.add_done_callback(lambda f: running.set())
+        running.wait(timeout=max(deadline - time.monotonic(), 0))
+        try:
+            return primary.result(timeout=max(min(r["deadline"], deadline - time.monotonic()), 0))
+        except Exception:
+            pass  # over budget, or failed before it: bring in the fallback
+        if deadline - time.monotonic() <= 0:
+            return primary.result()  # the hard timeout ends it; no time for a hedge
+
+        with self._lock:
+            self._hedges[r["role"]] += 1
+        hedge = self._submit(call, r["fallback"], hedge=True, budget=CallBudget(deadline))
+        contenders = {primary: r["model"], hedge: r["fallback"]}
+        pending = set(contenders)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                self._record_race(contenders, winner=future)
+                for loser in pending:
+                    loser.add_done_callback(lambda f: self._discard(f, close))
+                return future.result()
+        raise error
+
+    async def _atimed(self, call, model, hedge, budget):
+        # Tasks run in a copy of the context, so the hedge tag stays with this one.
+        started = time.perf_counter()
+        try:
+            with call_context(hedge=hedge):
+                result = await call(model, {"budget": budget})
+        except Exception:
+            self._record(model, error=True)
+            raise
+        self._record(model, latency=time.perf_counter() - started)
+        return result
+
+    async def _arace(self, r, call, close, deadline):
+        if not r["fallback"]:
+            return await self._atimed(call, r["model"], False, CallBudget(deadline))
+
+        running = asyncio.Event()
+        primary = asyncio.ensure_future(
+            self._atimed(call, r["model"], False, CallBudget(deadline, on_slot=running.set))
+        )
+        primary.add_done_callback(lambda f: running.set())
+        contenders = {primary: r["model"]}
+        winner = None
+        try:
+            # The latency budget starts once the primary holds a slot (or ends).
+            try:
+                await asyncio.wait_for(running.wait(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.wait({primary}, timeout=max(min(r["deadline"], deadline - time.monotonic()), 0))
+            if primary.done() and primary.exception() is None:
+                winner = primary
+                return primary.result()
+            if deadline - time.monotonic() <= 0:
+                winner = primary
+                return await primary  # the hard timeout ends it; no time for a hedge
+
+            with self._lock:
+                self._hedges[r["role"]] += 1
+            hedge = asyncio.ensure_future(self._atimed(call, r["fallback"], True, CallBudget(deadline)))
+            contenders[hedge] = r["fallback"]
+            pending = set(contenders)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                if winner is not None:
+                    self._record_race(contenders, winner=winner)
+                    return winner.result()
+            raise error
+        finally:
+            # Losers are cancelled; one that already completed is closed.
+            for task in contenders:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif close is not None and not task.cancelled() and task.exception() is None:
+                    await close(task.result())
+
+    def _discard(self, future, close):
+        # A losing request that still completed: free its stream.
+        if close is not None and future.exception() is None:
+            try:
+                close(future.result())
+            except Exception:
+                pass
+
+    def _record(self, model, latency=None, error=False):
+        with self._lock:
+            s = self._models.setdefault(model, _ModelStats())
+            s.calls += 1
+            if error:
+                s.errors += 1
+            else:
+                s.latencies.append(latency)
+
+    def _record_race(self, contenders, winner):
+        with self._lock:
+            for future, model in contenders.items():
+                s = self._models.setdefault(model, _ModelStats())
+                s.hedged += 1
+                if future is winner:
+                    s.wins += 1
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
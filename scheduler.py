@@ -0,0 +1,279 @@
+"""
+Fair scheduling and per-student quotas for the shared API key.
+
+Every model call takes a slot from the scheduler before it is sent (see
+llm_client.py). When all slots are busy, waiting calls are served:
+
+    * by class: interactive calls (patient turns, context summaries) before
+      batch calls (feedback), with a 4:1 weighting so grading never starves;
+    * within a class, round-robin across students, so one student firing
+      messages quickly cannot push everyone else to the back of the queue.
+
+A call can carry a `CallBudget` (see `call_budget`): one deadline for the
+wait for a slot, the retries and the request, and a hook that tells the
+caller when the call has actually started (the router hedges on that).
+
+Students are identified by the `student` tag of `metrics.call_context`.
+Interactive requests and their tokens per student are counted over a sliding
+hour and capped by `STUDENT_REQUESTS_PER_HOUR` / `STUDENT_TOKENS_PER_HOUR`
+(0 disables a cap). A request counts once it is granted a slot, so a call
+that gives up in line costs nothing; batch calls are neither capped nor
+counted, so a student who used up the chat quota still gets the assessment.
+The counts live in the shared state backend (state.py), so the caps hold
+across all app processes; the slots and queues are per process.
+"""
+
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from state import MemoryBackend
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+BATCH_KINDS = {"feedback", "regrade"}
+INTERACTIVE_WEIGHT = 4
+
+QUOTA_WINDOW = 3600
+
+_wait_callback = contextvars.ContextVar("scheduler_wait_callback", default=None)
+_budget = contextvars.ContextVar("call_budget", default=None)
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, message, retry_in):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CallBudget:
+    def __init__(self, deadline, on_slot=None):
+        self.deadline = deadline  # time.monotonic() by which the call must be over
+        self.on_slot = on_slot
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def started(self):
+        # The call holds a slot and is about to be sent.
+        if self.on_slot is not None:
+            self.on_slot()
+
+
+@contextmanager
+def call_budget(budget):
+    # Model calls made inside the block share `budget` (None: no deadline).
+    token = _budget.set(budget)
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+
+def current_budget():
+    return _budget.get()
+
+
+@contextmanager
+def on_queue_wait(callback):
+    # `callback(position, eta_seconds)` is called periodically, from the
+    # waiting thread, while a call made inside the block is queued.
+    token = _wait_callback.set(callback)
+    try:
+        yield
+    finally:
+        _wait_callback.reset(token)
+
+
+def current_wait_callback():
+    return _wait_callback.get()
+
+
+class _Ticket:
+    __slots__ = ("student", "cls", "event", "granted", "on_grant")
+
+    def __init__(self, student, cls, on_grant=None):
+        self.student = student
+        self.cls = cls
+        self.event = threading.Event()
+        self.granted = None
+        self.on_grant = on_grant
+
+
+class FairScheduler:
+    def __init__(self, capacity=16, requests_per_hour=0, tokens_per_hour=0, counters=None):
+        self.capacity = capacity
+        self.requests_per_hour = requests_per_hour
+        self.tokens_per_hour = tokens_per_hour
+        self.counters = counters or MemoryBackend()
+        self._lock = threading.Lock()
+        self._running = 0
+        # class -> OrderedDict(student -> deque of tickets); the dict order is
+        # the round-robin order, rotated as students are served.
+        self._queues = {INTERACTIVE: OrderedDict(), BATCH: OrderedDict()}
+        self._interactive_streak = 0
+        self._service_time = 2.0  # EWMA of seconds a slot is held
+
+    # ── admission ───────────────────────────────────────────
+
+    def acquire(self, student, kind, deadline=None):
+        """Block until a slot is granted; returns a handle for `release`.
+
+        With a `deadline` (time.monotonic()), gives up the place in line and
+        raises DeadlineExceeded when no slot was granted by then.
+        """
+        ticket = self.enqueue(student, kind)
+        if ticket.granted is not None:
+            self.record_request(ticket)
+            return ticket, False
+        callback = _wait_callback.get()
+        while True:
+            wait = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if ticket.event.wait(timeout=max(wait, 0)):
+                self.record_request(ticket)
+                return ticket, True
+            if deadline is not None and time.monotonic() >= deadline and self.cancel(ticket):
+                raise DeadlineExceeded("Заявката изчака твърде дълго на опашката.")
+            if callback is not None:
+                callback(*self.position(ticket))
+
+    def enqueue(self, student, kind, on_grant=None):
+        """Take a place in line without waiting (for the async gateway).
+
+        The ticket is either granted on return, or `on_grant()` is called
+        (with the scheduler lock held, so it must not block) once it is;
+        the caller then counts it with `record_request`.
+        """
+        student = student or "—"
+        cls = BATCH if kind in BATCH_KINDS else INTERACTIVE
+        if self._capped(student, cls):
+            self._check_quota(student)
+        with self._lock:
+            ticket = _Ticket(student, cls, on_grant)
+            if self._running < self.capacity and not self._waiting():
+                self._running += 1
+                ticket.granted = time.perf_counter()
+                return ticket
+            self._queues[cls].setdefault(student, deque()).append(ticket)
+            return ticket
+
+    def cancel(self, ticket):
+        # Withdraws a ticket still in line. False when it has already been
+        # granted, in which case the slot must be given back with `release`.
+        with self._lock:
+            queues = self._queues[ticket.cls]
+            tickets = queues.get(ticket.student)
+            if not tickets or ticket not in tickets:
+                return False
+            tickets.remove(ticket)
+            if not tickets:
+                del queues[ticket.student]
+            return True
+
+    def release(self, ticket):
+        held = time.perf_counter() - (ticket.granted or time.perf_counter())
+        with self._lock:
+            self._service_time = 0.8 * self._service_time + 0.2 * held
+            self._running -= 1
+            self._dispatch()
+
+    def record_request(self, ticket):
+        # Called once the ticket holds a slot (a shared-state write).
+        if self._capped(ticket.student, ticket.cls):
+            self.counters.add_event("requests", ticket.student)
+
+    def record_usage(self, ticket, tokens):
+        if tokens and self._capped(ticket.student, ticket.cls):
+            self.counters.add_event("tokens", ticket.student, tokens)
+
+    # ── introspection ───────────────────────────────────────
+
+    def position(self, ticket):
+        # Approximate place in line and expected wait, mirroring the dispatch
+        # order: higher classes first, then one ticket per student per round.
+        with self._lock:
+            queue = self._queues[ticket.cls].get(ticket.student, ())
+            if ticket not in queue:
+                return 0, 0.0
+            my_index = list(queue).index(ticket)
+            ahead = my_index
+            for student, tickets in self._queues[ticket.cls].items():
+                if student != ticket.student:
+                    ahead += min(len(tickets), my_index + 1)
+            if ticket.cls == BATCH:
+                ahead += sum(len(q) for q in self._queues[INTERACTIVE].values())
+            eta = (ahead + 1) * self._service_time / max(self.capacity, 1)
+            return ahead + 1, eta
+
+    def usage(self, student):
+        since = time.time() - QUOTA_WINDOW
+        return {
+            "requests": self.counters.window("requests", student or "—", since)[0],
+            "tokens": int(self.counters.window("tokens", student or "—", since)[1]),
+        }
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "running": self._running,
+                "capacity": self.capacity,
+                "waiting_interactive": sum(len(q) for q in self._queues[INTERACTIVE].values()),
+                "waiting_batch": sum(len(q) for q in self._queues[BATCH].values()),
+                "avg_service_time": round(self._service_time, 2),
+            }
+
+    # ── internals (call with the lock held) ─────────────────
+
+    def _waiting(self):
+        return any(self._queues[INTERACTIVE]) or any(self._queues[BATCH])
+
+    def _dispatch(self):
+        while self._running < self.capacity:
+            cls = self._next_class()
+            if cls is None:
+                return
+            queues = self._queues[cls]
+            student, tickets = next(iter(queues.items()))
+            ticket = tickets.popleft()
+            del queues[student]
+            if tickets:
+                queues[student] = tickets  # back of the round-robin order
+            self._running += 1
+            ticket.granted = time.perf_counter()
+            ticket.event.set()
+            if ticket.on_grant is not None:
+                ticket.on_grant()
+
+    def _next_class(self):
+        interactive, batch = bool(self._queues[INTERACTIVE]), bool(self._queues[BATCH])
+        if interactive and (not batch or self._interactive_streak < INTERACTIVE_WEIGHT):
+            self._interactive_streak += 1
+            return INTERACTIVE
+        if batch:
+            self._interactive_streak = 0
+            return BATCH
+        return None
+
+    # ── quotas (no lock needed: the counters are shared state) ──
+
+    def _capped(self, student, cls):
+        # Untagged calls (maintenance tools) are not a student's, and batch
+        # calls are not under the student's control.
+        return cls == INTERACTIVE and bool(student) and student != "—"
+
+    def _check_quota(self, student):
+        now = time.time()
+        if self.requests_per_hour:
+            count, _, oldest = self.counters.window("requests", student, now - QUOTA_WINDOW)
+            if count >= self.requests_per_hour:
+                raise QuotaExceeded("Достигнат е лимитът на заявки за един час.", oldest + QUOTA_WINDOW - now)
+        if self.tokens_per_hour:
+            _, tokens, oldest = self.counters.window("tokens", student, now - QUOTA_WINDOW)
+            if tokens >= self.tokens_per_hour:
+                raise QuotaExceeded("Достигнат е лимитът на токени за един час.", oldest + QUOTA_WINDOW - now)
@@ -0,0 +1,142 @@
+"""
+Durable in-progress consultations.
+
+Session state only lives as long as the browser tab and the server process.
+Each turn is therefore also appended to `history/sessions.db`, keyed by
+student email and case, so a dropped connection, a refresh or a server
+restart does not cost the student (and the API budget) the whole
+conversation. Consultations not touched for `SESSION_TTL_HOURS` are purged.
+Finished consultations are removed once their assessment is in the history.
+"""
+
+import json
+import threading
+import time
+
+from config import DATA_DIR, get_secret
+from state import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consultations (
+    email        TEXT NOT NULL,
+    patient      TEXT NOT NULL,
+    started_at   REAL NOT NULL,
+    updated_at   REAL NOT NULL,
+    turn_timings TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (email, patient)
+);
+CREATE INDEX IF NOT EXISTS idx_consultations_updated ON consultations (updated_at);
+CREATE TABLE IF NOT EXISTS turns (
+    email   TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    seq     INTEGER NOT NULL,
+    role    TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (email, patient, seq)
+);
+"""
+
+PURGE_INTERVAL = 600
+
+
+class SessionStore:
+    def __init__(self, db_path=DATA_DIR / "history" / "sessions.db", ttl_hours=48):
+        self.db_path = db_path
+        self.ttl = ttl_hours * 3600
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._last_purge = 0.0
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        self.purge_expired()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    def save(self, email, patient, messages, turn_timings=()):
+        # Only turns not yet stored are written, so a save costs one row per
+        # new message rather than a rewrite of the whole transcript.
+        now = time.time()
+        with self._connect() as conn:
+            stored = conn.execute(
+                "SELECT COUNT(*) FROM turns WHERE email = ? AND patient = ?", (email, patient)
+            ).fetchone()[0]
+            if stored > len(messages):
+                # The transcript shrank (a failed turn was dropped): start over.
+                conn.execute("DELETE FROM turns WHERE email = ? AND patient = ?", (email, patient))
+                stored = 0
+            conn.executemany(
+                "INSERT OR REPLACE INTO turns (email, patient, seq, role, content) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (email, patient, seq, m["role"], m["content"])
+                    for seq, m in enumerate(messages[stored:], start=stored)
+                ],
+            )
+            conn.execute(
+                "INSERT INTO consultations (email, patient, started_at, updated_at, turn_timings) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (email, patient) DO UPDATE SET "
+                "updated_at = excluded.updated_at, turn_timings = excluded.turn_timings",
+                (email, patient, now, now, json.dumps(list(turn_timings))),
+            )
+        if now - self._last_purge > PURGE_INTERVAL:
+            self.purge_expired()
+
+    def load(self, email, patient):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT updated_at, turn_timings FROM consultations WHERE email = ? AND patient = ?",
+            (email, patient),
+        ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        messages = [
+            {"role": role, "content": content}
+            for role, content in conn.execute(
+                "SELECT role, content FROM turns WHERE email = ? AND patient = ? ORDER BY seq",
+                (email, patient),
+            )
+        ]
+        return {"messages": messages, "turn_timings": json.loads(row[1]), "updated_at": row[0]}
+
+    def latest(self, email):
+        # Case of the student's most recently active consultation, if any.
+        row = self._connect().execute(
+            "SELECT patient FROM consultations WHERE email = ? AND updated_at > ? "
+            "ORDER BY updated_at DESC LIMIT 1",
+            (email, time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def clear(self, email, patient):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM turns WHERE email = ? AND patient = ?", (email, patient))
+            conn.execute("DELETE FROM consultations WHERE email = ? AND patient = ?", (email, patient))
+
+    def purge_expired(self):
+        self._last_purge = time.time()
+        cutoff = self._last_purge - self.ttl
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM turns WHERE (email, patient) IN "
+                "(SELECT email, patient FROM consultations WHERE updated_at < ?)",
+                (cutoff,),
+            )
+            removed = conn.execute("DELETE FROM consultations WHERE updated_at < ?", (cutoff,)).rowcount
+        return removed
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore(ttl_hours=float(get_secret("SESSION_TTL_HOURS", 48)))
+        return _store
@@ -0,0 +1,335 @@
+"""
+Shared state for running several app processes on the same data.
+
+Streamlit keeps each student's session in the memory of one process, so a
+second process (or node) behind a load balancer needs everything else that
+is shared — history, saved consultations, assessment jobs, the feedback
+cache, the per-student rate-limit counters and failed logins — to live in
+one place:
+
+    DATA_DIR        directory holding history/ and cache/ (default: next to
+                    app.py); put it on a shared volume for several nodes
+    STATE_BACKEND   sqlite (default)  counters and job leases in
+                                      DATA_DIR/history/state.db
+                    memory            in-process only (a single process)
+
+STATE_BACKEND only covers the coordination state: rate-limit counters,
+failed logins and job leases. The data itself is shared through DATA_DIR,
+whatever the backend: history (HISTORY_BACKEND, history.py), saved
+consultations (sessions.db, sessions.py), job files (jobs.py) and the
+feedback cache (cache/feedback/, written with atomic renames).
+    STATE_LOCKING   wal (default)     SQLite write-ahead log: fastest, for
+                                      processes on one machine
+                    file              rollback journal coordinated purely by
+                                      file locks, for a volume shared between
+                                      machines (WAL needs shared memory)
+
+Every SQLite file in the app is opened through `connect`, so the locking
+mode applies to all of them.
+
+    python state.py check --processes 2
+
+runs two processes against the same store at once and verifies that no
+counter update, lease, history record, saved consultation or cached
+assessment was lost (tests/test_state.py runs it under pytest). The stores are created in a
+temporary directory inside DATA_DIR (same volume, same locking), never in
+the live databases.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+from config import DATA_DIR, get_secret
+
+STATE_DB = DATA_DIR / "history" / "state.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    namespace TEXT NOT NULL,
+    key       TEXT NOT NULL,
+    ts        REAL NOT NULL,
+    amount    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_key ON events (namespace, key, ts);
+CREATE TABLE IF NOT EXISTS leases (
+    namespace TEXT NOT NULL,
+    key       TEXT NOT NULL,
+    owner     TEXT NOT NULL,
+    expires   REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+"""
+
+PURGE_INTERVAL = 600
+
+
+def replica_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def connect(path):
+    # One connection per caller thread is the convention everywhere; this only
+    # decides how the file is locked.
+    conn = sqlite3.connect(path, timeout=30)
+    if str(get_secret("STATE_LOCKING", "wal")).strip().lower() == "file":
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute("PRAGMA synchronous=FULL")
+    else:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+# ─────────────────────────────────────────────────────────────
+# IN-PROCESS
+# ─────────────────────────────────────────────────────────────
+
+class MemoryBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}  # (namespace, key) -> deque of (ts, amount)
+        self._leases = {}  # (namespace, key) -> (owner, expires)
+        self._last_purge = 0.0
+
+    def add_event(self, namespace, key, amount=1):
+        now = time.time()
+        with self._lock:
+            self._events.setdefault((namespace, key), deque()).append((now, amount))
+            if now - self._last_purge > PURGE_INTERVAL:
+                self._last_purge = now
+                # Keys that are never read again (e.g. mistyped emails) go too.
+                self._events = {k: e for k, e in self._events.items() if e[-1][0] >= now - 86400}
+
+    def window(self, namespace, key, since):
+        """(count, total, oldest timestamp) of events at or after `since`."""
+        with self._lock:
+            events = self._events.get((namespace, key))
+            while events and events[0][0] < since:
+                events.popleft()
+            if not events:
+                return 0, 0, None
+            return len(events), sum(amount for _, amount in events), events[0][0]
+
+    def latest(self, namespace, key):
+        """Timestamp of the newest event, or None."""
+        with self._lock:
+            events = self._events.get((namespace, key))
+            return events[-1][0] if events else None
+
+    def claim(self, namespace, key, owner, lease):
+        """Take (or renew) a lease; False while someone else holds it."""
+        now = time.time()
+        with self._lock:
+            holder = self._leases.get((namespace, key))
+            if holder and holder[0] != owner and holder[1] > now:
+                return False
+            self._leases[(namespace, key)] = (owner, now + lease)
+            return True
+
+    def release(self, namespace, key, owner):
+        with self._lock:
+            holder = self._leases.get((namespace, key))
+            if holder and holder[0] == owner:
+                del self._leases[(namespace, key)]
+
+
+# ─────────────────────────────────────────────────────────────
+# SINGLE-FILE DATABASE
+# ─────────────────────────────────────────────────────────────
+
+class SqliteBackend:
+    def __init__(self, db_path=STATE_DB):
+        self.db_path = db_path
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._last_purge = 0.0
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path)
+            conn.isolation_level = None  # explicit BEGIN IMMEDIATE below
+            self._local.conn = conn
+        return conn
+
+    def _write(self, sql_and_params):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read-then-write
+        # (a lease check) cannot interleave with another process.
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = sql_and_params(conn)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add_event(self, namespace, key, amount=1):
+        now = time.time()
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO events (namespace, key, ts, amount) VALUES (?, ?, ?, ?)",
+            (namespace, key, now, amount),
+        ))
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            # Counters only ever look back an hour or so.
+            self._write(lambda conn: conn.execute("DELETE FROM events WHERE ts < ?", (now - 86400,)))
+
+    def window(self, namespace, key, since):
+        count, total, oldest = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(amount), 0), MIN(ts) FROM events "
+            "WHERE namespace = ? AND key = ? AND ts >= ?",
+            (namespace, key, since),
+        ).fetchone()
+        return count, total, oldest
+
+    def latest(self, namespace, key):
+        return self._connect().execute(
+            "SELECT MAX(ts) FROM events WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()[0]
+
+    def claim(self, namespace, key, owner, lease):
+        now = time.time()
+
+        def take(conn):
+            row = conn.execute(
+                "SELECT owner, expires FROM leases WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (namespace, key, owner, expires) VALUES (?, ?, ?, ?)",
+                (namespace, key, owner, now + lease),
+            )
+            return True
+
+        return self._write(take)
+
+    def release(self, namespace, key, owner):
+        self._write(lambda conn: conn.execute(
+            "DELETE FROM leases WHERE namespace = ? AND key = ? AND owner = ?", (namespace, key, owner)
+        ))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if str(get_secret("STATE_BACKEND", "sqlite")).strip().lower() == "memory":
+                _backend = MemoryBackend()
+            else:
+                _backend = SqliteBackend()
+        return _backend
+
+
+# ─────────────────────────────────────────────────────────────
+# TWO-INSTANCE CHECK
+# ─────────────────────────────────────────────────────────────
+
+def _check_stores(directory):
+    # The state, history and session databases of the check, all in `directory`.
+    from feedback_cache import FeedbackCache
+    from history import SqliteHistoryStore
+    from sessions import SessionStore
+
+    directory = Path(directory)
+    return (
+        SqliteBackend(directory / "state.db"),
+        SqliteHistoryStore(directory / "history.db"),
+        SessionStore(directory / "sessions.db"),
+        FeedbackCache(memory_entries=0, cache_dir=directory / "cache"),
+    )
+
+
+def _instance(index, iterations, results, directory):
+    # Runs in its own process, like a second Streamlit server would.
+    from history import make_record
+
+    backend, history, sessions, cache = _check_stores(directory)
+    won = 0
+    for i in range(iterations):
+        backend.add_event("check", "student", 1)
+        if backend.claim("check", f"job-{i}", f"instance-{index}", lease=3600):
+            won += 1
+        record = make_record(f"check{index}@example.bg", "check", [{"role": "user", "content": str(i)}])
+        record["source"] = f"check-{index}-{i}"
+        history.save(record)
+        sessions.save(f"check{index}@example.bg", "check", [{"role": "user", "content": str(j)} for j in range(i + 1)])
+        # Each instance writes its own entry and both rewrite a shared one.
+        cache.put(f"check-{index}-{i}", {"score": i})
+        cache.put(f"check-shared-{i}", {"score": i})
+    results.put((index, won))
+
+
+def check(processes, iterations):
+    import multiprocessing
+
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=".state-check-", dir=DATA_DIR) as directory:
+        backend, history, sessions, cache = _check_stores(directory)
+        since = time.time()
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=_instance, args=(i, iterations, results, directory))
+            for i in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # An instance that crashed reports nothing; its leases count as lost.
+        wins = dict(results.get(timeout=10) for worker in workers if worker.exitcode == 0)
+        count, _, _ = backend.window("check", "student", since)
+        records = history.count(patient="check")
+        saved = [
+            len((sessions.load(f"check{i}@example.bg", "check") or {"messages": []})["messages"])
+            for i in range(processes)
+        ]
+        cached = sum(
+            cache.get(key) is not None
+            for j in range(iterations)
+            for key in [f"check-shared-{j}"] + [f"check-{i}-{j}" for i in range(processes)]
+        )
+    return {
+        "events": (count, processes * iterations),
+        "leases": (sum(wins.values()), iterations),
+        "history_records": (records, processes * iterations),
+        "session_turns": (saved, [iterations] * processes),
+        "cached_results": (cached, (processes + 1) * iterations),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared state tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    check_parser = sub.add_parser("check", help="run N instances against the same store at once")
+    check_parser.add_argument("--processes", type=int, default=2)
+    check_parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    report = check(args.processes, args.iterations)
+    ok = all(got == expected for got, expected in report.values())
+    print(json.dumps(report, indent=2))
+    print("OK" if ok else "FAILED: state was lost between instances")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The app is a set of top-level modules next to app.py.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,32 @@
+"""Two app instances against one shared store (see state.py)."""
+
+import multiprocessing
+
+from roster import LoginThrottle
+from state import SqliteBackend, check
+
+
+def test_two_instances_lose_nothing():
+    report = check(processes=2, iterations=100)
+    for name, (got, expected) in report.items():
+        assert got == expected, name
+
+
+def _fail_logins(db_path, attempts):
+    throttle = LoginThrottle(max_failures=4, lockout=60, counters=SqliteBackend(db_path))
+    for _ in range(attempts):
+        throttle.failed("student@example.bg")
+
+
+def test_login_lockout_holds_on_every_instance(tmp_path):
+    db_path = tmp_path / "state.db"
+    workers = [multiprocessing.Process(target=_fail_logins, args=(db_path, 2)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    throttle = LoginThrottle(max_failures=4, lockout=60, counters=SqliteBackend(db_path))
+    assert throttle.retry_in("student@example.bg") > 0
+    assert throttle.retry_in("other@example.bg") == 0
@@ -0,0 +1,224 @@
+"""
+Per-rerun tracing of the Streamlit script.
+
+Every run of app.py (and every fragment rerun) becomes one trace record with
+the student, the view and a list of named spans: CSS, login, case catalog,
+sidebar, message rendering, the model call, saving progress... Spans are two
+`perf_counter` reads and a list append, and records are kept in an
+in-memory ring buffer (`TRACE_BUFFER` reruns, default 2000), so tracing is
+cheap enough to stay on (`TRACING = "false"` turns it off).
+
+The admin debug view (`ADMIN_EMAILS`) shows the slowest reruns, per-stage
+histograms and per-student totals, can flush the buffer to
+`logs/traces.jsonl`, and can capture a cProfile of one flagged rerun.
+"""
+
+import contextvars
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import get_secret
+from metrics import METRICS_DIR, percentile
+
+TRACES_FILE = METRICS_DIR / "traces.jsonl"
+
+# Histogram bucket upper bounds, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_current = contextvars.ContextVar("trace_rerun", default=None)
+
+
+def tracing_enabled():
+    return str(get_secret("TRACING", "true")).strip().lower() not in ("0", "false", "no", "off")
+
+
+def bucket_label(ms):
+    # Numbered so that charts, which sort labels as text, keep the order.
+    for i, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return f"{i + 1:02d}: ≤{bound} ms"
+    return f"{len(BUCKETS) + 1:02d}: >{BUCKETS[-1]} ms"
+
+
+class Tracer:
+    def __init__(self, capacity=2000):
+        self._lock = threading.Lock()
+        self._reruns = deque(maxlen=capacity)
+        self._open = {}  # session id -> its rerun still being recorded
+        self._next_id = 0
+
+    # ── recording (called from the script thread) ───────────
+
+    def begin(self, session, student, kind="script", profile=False):
+        """Start the trace of a rerun of `session`.
+
+        The record is in the buffer from the start and grows with each span,
+        so a rerun cut short by `st.rerun()` or an exception is not lost; the
+        session's previous rerun, if still open, is closed here.
+        """
+        with self._lock:
+            previous = self._open.pop(session, None)
+        if previous is not None:
+            self._close(previous)
+        if not tracing_enabled():
+            _current.set(None)
+            return None
+        now = time.perf_counter()
+        rerun = {
+            "ts": time.time(),
+            "student": student or "—",
+            "kind": kind,
+            "spans": [],
+            "total": 0.0,
+            "open": True,
+            "_start": now,
+            "_mark": now,
+        }
+        if profile:
+            rerun["_profiler"] = cProfile.Profile()
+            rerun["_profiler"].enable()
+        with self._lock:
+            self._next_id += 1
+            rerun["id"] = self._next_id
+            self._reruns.append(rerun)
+            self._open[session] = rerun
+        _current.set(rerun)
+        return rerun
+
+    @contextmanager
+    def span(self, name):
+        rerun = _current.get()
+        if rerun is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(rerun, name, started)
+
+    def mark(self, name):
+        # Closes a top-level stage that ran since the previous mark or span.
+        rerun = _current.get()
+        if rerun is not None:
+            self._add(rerun, name, rerun["_mark"])
+
+    def tag(self, **fields):
+        rerun = _current.get()
+        if rerun is not None:
+            rerun.update(fields)
+
+    def finish(self):
+        """End the current rerun (call before `st.stop()` and at the end of the script)."""
+        rerun = _current.get()
+        if rerun is None:
+            return
+        _current.set(None)
+        with self._lock:
+            for session, open_rerun in list(self._open.items()):
+                if open_rerun is rerun:
+                    del self._open[session]
+        self._close(rerun)
+
+    def _add(self, rerun, name, started):
+        now = time.perf_counter()
+        rerun["spans"].append((name, round(now - started, 5)))
+        rerun["_mark"] = now
+        rerun["total"] = round(now - rerun["_start"], 5)
+
+    def _close(self, rerun):
+        profiler = rerun.pop("_profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+            rerun["profile"] = out.getvalue()
+        rerun["open"] = False
+
+    # ── reading ─────────────────────────────────────────────
+
+    def reruns(self):
+        with self._lock:
+            return list(self._reruns)
+
+    def slowest(self, n=20):
+        return sorted(self.reruns(), key=lambda r: r["total"], reverse=True)[:n]
+
+    def stages(self):
+        # stage -> sorted durations (ms), over all buffered reruns
+        durations = {}
+        for rerun in self.reruns():
+            for name, seconds in rerun["spans"]:
+                durations.setdefault(name, []).append(seconds * 1000)
+        return {name: sorted(values) for name, values in durations.items()}
+
+    def stage_rows(self):
+        rows = []
+        for name, values in self.stages().items():
+            rows.append({
+                "етап": name,
+                "брой": len(values),
+                "p50 (ms)": round(percentile(values, 50), 1),
+                "p95 (ms)": round(percentile(values, 95), 1),
+                "макс. (ms)": round(values[-1], 1),
+                "общо (s)": round(sum(values) / 1000, 2),
+            })
+        rows.sort(key=lambda r: r["общо (s)"], reverse=True)
+        return rows
+
+    def histogram(self, stage):
+        counts = {bucket_label(b): 0 for b in BUCKETS + (BUCKETS[-1] + 1,)}
+        for ms in self.stages().get(stage, []):
+            counts[bucket_label(ms)] += 1
+        return counts
+
+    def student_rows(self):
+        groups = {}
+        for rerun in self.reruns():
+            groups.setdefault(rerun["student"], []).append(rerun["total"] * 1000)
+        rows = []
+        for student, values in groups.items():
+            values.sort()
+            rows.append({
+                "студент": student,
+                "презареждания": len(values),
+                "p50 (ms)": round(percentile(values, 50), 1),
+                "p95 (ms)": round(percentile(values, 95), 1),
+                "макс. (ms)": round(values[-1], 1),
+            })
+        rows.sort(key=lambda r: r["p95 (ms)"], reverse=True)
+        return rows
+
+    def flush(self, path=TRACES_FILE):
+        """Append the finished reruns not yet written to `path` (JSONL); returns how many."""
+        with self._lock:
+            pending = [r for r in self._reruns if not r["open"] and not r.get("_flushed")]
+            for rerun in pending:
+                rerun["_flushed"] = True
+        if pending:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                for rerun in pending:
+                    entry = {k: v for k, v in rerun.items() if not k.startswith("_")}
+                    entry["ts"] = datetime.fromtimestamp(rerun["ts"]).isoformat()
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return len(pending)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer(capacity=int(get_secret("TRACE_BUFFER", 2000)))
+        return _tracer
@@ -0,0 +1,245 @@
+"""
+Deterministic pre-analysis of a consultation transcript.
+
+Counting question types, empathy and summarising phrases, and checking
+which key facts of the case came up, does not need a model. This module does
+it with compiled Bulgarian pattern sets in one pass over the student's turns.
+The result is shown to the student as soon as the consultation ends, and
+is handed to the grading prompt as fixed facts, so the model only has to
+judge rather than count, and can answer more briefly.
+
+Key facts come from the case's `key_points` list when present, otherwise
+from the sentences of `key_info` (rubric sentences about what "the student"
+should do are left to the model).
+
+`python transcript_analysis.py` checks the question and empathy patterns
+against the sample sentences in SAMPLE_QUESTIONS and SAMPLE_EMPATHY
+(non-zero exit on a mismatch).
+"""
+
+import re
+import sys
+
+from config import get_secret
+
+# Sentences of the student's turns: text up to ., ! or ? (keeping the mark).
+SENTENCE = re.compile(r"[^.!?\n]+[.!?]*")
+
+# A greeting or a connective may come before the question itself.
+LEAD_IN = (
+    r"^\W*(?:(?:здравейте|здравей|добър\s+ден|добро\s+утро|добър\s+вечер)\W+)?"
+    r"(?:а\s+|и\s+|добре,?\s+|кажете,?\s+)?"
+)
+# Open questions start with an interrogative or an invitation to tell more.
+# Prepositional forms are spelled out in full, since the pattern ends on \b;
+# "Кажете ми, ..." only introduces the question that follows.
+OPEN_QUESTION = re.compile(
+    LEAD_IN
+    + r"(?:как|какъв|каква|какво|какви|защо|кога|къде|откъде|докъде|колко"
+    r"|кой|коя|кое|кои|чий|чия|чие|чии"
+    r"|(?:от|на|до)\s+колко|от\s+кога|(?:с|в|за|по|от|на)\s+как(?:во|ъв|ва|ви)"
+    r"|разкажете|опишете|споделете|обяснете|кажете\s+ми(?!\s*,))\b",
+    re.IGNORECASE,
+)
+# "Разкажете ми..." asks an open question without a question mark.
+INVITATION = re.compile(
+    LEAD_IN + r"(?:разкажете|опишете|споделете|обяснете|кажете\s+ми(?!\s*,))\b", re.IGNORECASE
+)
+# Yes/no questions: the interrogative particle "ли", or a bare "?" sentence.
+CLOSED_QUESTION = re.compile(r"\bли\b|\?\s*$", re.IGNORECASE)
+
+EMPATHY = re.compile(
+    r"\b(?:разбирам,?\s+(?:ви|ви\s+напълно|притеснението|колко|че)\b"
+    r"|съжалявам|съчувствам|сигурно\s+(?:е|ви\s+е)\s+(?:неприятно|трудно|тежко|притеснително)"
+    r"|(?:напълно\s+)?нормално\s+е\s+да|разбираемо|не\s+се\s+притеснявайте|не\s+се\s+тревожете"
+    r"|благодаря,?\s+че\s+(?:споделихте|ми\s+казахте)|виждам,?\s+че\s+(?:ви\s+)?(?:притеснява|тревожи))",
+    re.IGNORECASE,
+)
+
+SUMMARY = re.compile(
+    r"\b(?:ако\s+(?:правилно\s+)?(?:ви\s+)?разбирам|ако\s+съм\s+разбрал[а]?|правилно\s+ли\s+разбирам"
+    r"|доколкото\s+разбирам|с\s+други\s+думи|да\s+обобщя|нека\s+обобщя|да\s+обобщим|обобщено"
+    r"|значи\s+(?:вие|имате|приемате|от)|казахте,?\s+че|споменахте,?\s+че)",
+    re.IGNORECASE,
+)
+
+WORD = re.compile(r"[а-яa-z0-9ѝ]+", re.IGNORECASE)
+# Sentence breaks in `key_info`: a full stop followed by a capital, so "38.5°C" stays whole.
+KEY_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+(?=[А-ЯA-Z])")
+RUBRIC_SENTENCE = re.compile(r"^\s*(?:студентът|фармацевтът|може\s+да)\b", re.IGNORECASE)
+STOPWORDS = frozenset(
+    "около които която което които този тази това тези като след преди между защото поради "
+    "трябва може могат има няма беше бяха много само също още вече днес пъти дали".split()
+)
+STEM = 4  # Bulgarian inflects word endings; the first letters identify a word well enough.
+
+# (sentence, expected label) — run `python transcript_analysis.py` after
+# changing the question patterns.
+SAMPLE_QUESTIONS = [
+    ("Какъв е проблемът?", "open"),
+    ("Каква е температурата ви?", "open"),
+    ("Какво ви притеснява?", "open"),
+    ("Какви лекарства приемате?", "open"),
+    ("Как се чувствате днес?", "open"),
+    ("С какво мога да помогна?", "open"),
+    ("Здравейте, с какво мога да ви помогна?", "open"),
+    ("Добър ден! С какво мога да ви бъда полезен?", "open"),
+    ("В какви случаи се появява?", "open"),
+    ("За какво ви е нужно лекарството?", "open"),
+    ("От колко време имате тази кашлица?", "open"),
+    ("От кога е така?", "open"),
+    ("Кога започнахте да приемате лекарството?", "open"),
+    ("А защо спряхте хапчетата?", "open"),
+    ("Разкажете ми повече за болката.", "open"),
+    ("Здравейте, разкажете ми какво се случи.", "open"),
+    ("Приемате ли други лекарства?", "closed"),
+    ("Имате ли температура?", "closed"),
+    ("Здравейте, алергични ли сте към нещо?", "closed"),
+    ("Кашлицата суха ли е?", "closed"),
+    ("Само вечер?", "closed"),
+    ("Кажете ми, пушите ли?", "closed"),
+    ("Здравейте.", None),
+    ("Разбирам, благодаря ви.", None),
+    ("Препоръчвам да се консултирате с лекаря си.", None),
+]
+
+# A plain "Разбирам" only acknowledges the answer; it is not empathy.
+SAMPLE_EMPATHY = [
+    ("Разбирам ви, сигурно е неприятно.", True),
+    ("Разбирам колко ви е трудно.", True),
+    ("Разбирам, че това ви притеснява.", True),
+    ("Съжалявам да го чуя.", True),
+    ("Не се притеснявайте, ще намерим решение.", True),
+    ("Разбирам, благодаря ви.", False),
+    ("Разбирам. А от кога?", False),
+    ("Разбирам.", False),
+    ("Разбирам, видях рецептата.", False),
+    ("Добре, разбирам. Приемате ли други лекарства?", False),
+    ("Ако правилно разбирам, болката е от вчера.", False),
+]
+
+
+def analysis_enabled():
+    return str(get_secret("TRANSCRIPT_ANALYSIS", "true")).strip().lower() not in ("0", "false", "no", "off")
+
+
+def _stems(text):
+    return {
+        word[:STEM].lower()
+        for word in WORD.findall(text)
+        if len(word) >= 4 and word.lower() not in STOPWORDS
+    }
+
+
+def key_points(patient_data):
+    if patient_data.get("key_points"):
+        return list(patient_data["key_points"])
+    return [
+        sentence.strip()
+        for sentence in KEY_SENTENCE_BREAK.split(patient_data.get("key_info", ""))
+        if sentence.strip() and not RUBRIC_SENTENCE.match(sentence)
+    ]
+
+
+def question_type(sentence):
+    # "open", "closed" or None for one sentence of a student turn.
+    sentence = sentence.strip()
+    if OPEN_QUESTION.match(sentence) and (sentence.endswith("?") or INVITATION.match(sentence)):
+        return "open"
+    if CLOSED_QUESTION.search(sentence):
+        return "closed"
+    return None
+
+
+def empathy_phrases(text):
+    # "Ако правилно ви разбирам" is a summary, not also an empathic "разбирам".
+    summaries = list(SUMMARY.finditer(text))
+    return [
+        m.group(0) for m in EMPATHY.finditer(text)
+        if not any(s.start() <= m.start() < s.end() for s in summaries)
+    ]
+
+
+def analyze_transcript(messages, patient_data):
+    student_turns = [m["content"] for m in messages if m["role"] == "user"]
+    sentences = [s.strip() for turn in student_turns for s in SENTENCE.findall(turn) if s.strip()]
+
+    open_questions, closed_questions = [], []
+    for sentence in sentences:
+        label = question_type(sentence)
+        if label == "open":
+            open_questions.append(sentence)
+        elif label == "closed":
+            closed_questions.append(sentence)
+
+    student_text = "\n".join(student_turns)
+    summaries = [m.group(0) for m in SUMMARY.finditer(student_text)]
+    empathy = empathy_phrases(student_text)
+
+    # A key fact counts as covered when the student asked about it: one
+    # student turn mentions it, and that turn with the patient's reply to it
+    # contains at least half of its content words. Facts the patient brings
+    # up unprompted do not count for the student.
+    exchanges = []
+    for i, message in enumerate(messages):
+        if message["role"] != "user":
+            continue
+        asked = _stems(message["content"])
+        reply = messages[i + 1] if i + 1 < len(messages) else None
+        answered = _stems(reply["content"]) if reply and reply["role"] == "assistant" else set()
+        exchanges.append((asked, asked | answered))
+    points = []
+    for point in key_points(patient_data):
+        stems = _stems(point)
+        covered = bool(stems) and any(
+            stems & asked and len(stems & together) * 2 >= len(stems) for asked, together in exchanges
+        )
+        points.append({"point": point, "covered": covered})
+
+    questions = len(open_questions) + len(closed_questions)
+    return {
+        "student_turns": len(student_turns),
+        "questions": questions,
+        "open_questions": len(open_questions),
+        "closed_questions": len(closed_questions),
+        "open_ratio": round(len(open_questions) / questions, 2) if questions else 0.0,
+        "empathy": len(empathy),
+        "summaries": len(summaries),
+        "open_examples": open_questions[:3],
+        "empathy_examples": empathy[:3],
+        "summary_examples": summaries[:3],
+        "key_points": points,
+        "key_points_covered": sum(1 for p in points if p["covered"]),
+    }
+
+
+def format_facts(facts):
+    # Plain-text block for the grading prompt.
+    lines = [
+        f"Реплики на студента: {facts['student_turns']}",
+        f"Въпроси: {facts['questions']} (отворени {facts['open_questions']}, затворени {facts['closed_questions']})",
+        f"Емпатични изрази: {facts['empathy']}",
+        f"Обобщаване/парафразиране: {facts['summaries']}",
+    ]
+    if facts["open_examples"]:
+        lines.append("Примери за отворени въпроси: " + " | ".join(facts["open_examples"]))
+    if facts["key_points"]:
+        lines.append(f"Ключова информация, обсъдена в разговора: {facts['key_points_covered']} от {len(facts['key_points'])}")
+        for point in facts["key_points"]:
+            lines.append(f"  [{'x' if point['covered'] else ' '}] {point['point']}")
+    return "\n".join(lines)
+
+
+def main():
+    # python transcript_analysis.py  — check the patterns against the sample sentences
+    checks = [(text, expected, question_type(text)) for text, expected in SAMPLE_QUESTIONS]
+    checks += [(text, expected, bool(empathy_phrases(text))) for text, expected in SAMPLE_EMPATHY]
+    wrong = [(text, expected, got) for text, expected, got in checks if got != expected]
+    for text, expected, got in wrong:
+        print(f"{text!r}: expected {expected}, got {got}")
+    print(f"{len(checks) - len(wrong)}/{len(checks)} sample sentences classified as expected")
+    sys.exit(1 if wrong else 0)
+
+
+if __name__ == "__main__":
+    main()